@@ -0,0 +1,151 @@
+# async_server.py
+# asyncio-Engine für den Chat-Server: alle Clients laufen auf einer Event-Loop statt
+# mit einem eigenen Thread pro Client. Das Protokoll ist identisch, die Handler aus
+# MSG_HANDLERS_Server (server.py) werden direkt auf der Loop ausgeführt.
+#
+# Gelesen wird über asyncio.BufferedProtocol: der Kernel schreibt direkt in den
+# Puffer des FrameDecoders, es gibt keine Zwischenkopie über einen StreamReader.
+
+import asyncio
+
+import outbound
+import ratelimit
+import server
+from protocol import FrameDecoder, ProtokollFehler
+
+
+class AsyncClientConnection:
+    # Verhält sich für die gemeinsamen Handler aus server.py wie ein Socket
+    # (send/close), schreibt aber nur in den Puffer des Transports. Der Puffer
+    # übernimmt die Rolle der Sende-Queue aus outbound.py, mit denselben Grenzen.
+    __slots__ = ('transport', 'closed', 'compress', 'sessions', 'rate_limit', '_slow_timer')
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.closed = False
+        self.compress = False  # Client hat per Msg 12 zlib angemeldet (Msg 13)
+        self.sessions = False  # Client hat per Msg 12 Sitzungs-Tokens angemeldet (Msg 10)
+        self.rate_limit = None  # ratelimit.RateLimit, beim ersten Broadcast angelegt
+        self._slow_timer = None
+        transport.set_write_buffer_limits(high=outbound.QUEUE_HIGH_WATER)
+
+    def send(self, data):
+        if self.closed or self.transport.is_closing():
+            return 0
+        self.transport.write(data)
+        if self.transport.get_write_buffer_size() > outbound.QUEUE_LIMIT:
+            server.trenne_langsamen_client(self)
+        return len(data)
+
+    def queued_bytes(self):
+        return self.transport.get_write_buffer_size()
+
+    def close(self):
+        self.closed = True
+        self.transport.close()
+
+    def abort(self):
+        self.closed = True
+        self._cancel_slow_timer()
+        self.transport.abort()
+
+    def over_high_water(self):
+        # Puffer über QUEUE_HIGH_WATER: bleibt er so, wird der Client getrennt
+        if self._slow_timer is None:
+            loop = asyncio.get_running_loop()
+            self._slow_timer = loop.call_later(outbound.SLOW_CLIENT_TIMEOUT, self._slow_timeout)
+
+    def below_high_water(self):
+        self._cancel_slow_timer()
+
+    def _slow_timeout(self):
+        self._slow_timer = None
+        if not self.closed:
+            server.trenne_langsamen_client(self)
+
+    def _cancel_slow_timer(self):
+        if self._slow_timer is not None:
+            self._slow_timer.cancel()
+            self._slow_timer = None
+
+
+class ClientProtocol(asyncio.BufferedProtocol):
+
+    def __init__(self):
+        self.decoder = FrameDecoder(server.READ_CHUNK_SIZE, zero_copy=True)
+        self.conn = None
+        self.closed = False
+
+    def connection_made(self, transport):
+        server.setze_keepalive(transport.get_extra_info('socket'))
+        self.conn = AsyncClientConnection(transport)
+        server.setze_frist(self.conn, self.decoder, True)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self._process()
+
+    def _process(self):
+        # Höchstens FAIR_QUOTA Nachrichten pro Durchlauf der Loop; der Rest bleibt im
+        # Puffer, bis die anderen Clients dran waren (Lesen solange pausiert)
+        try:
+            fertig = False
+            count = 0
+            for msg_id, payload in self.decoder.messages():
+                fertig = True
+                if server.handel_msg(self.conn, msg_id, payload, self.decoder.last_frame_size) is not None:
+                    self.closed = True
+                    return
+                count += 1
+                if count >= ratelimit.FAIR_QUOTA and self.decoder.buffered():
+                    self.conn.transport.pause_reading()
+                    asyncio.get_running_loop().call_soon(self._resume)
+                    break
+            server.setze_frist(self.conn, self.decoder, fertig)
+        except Exception as e:
+            print(f"Error handling client: {e}")
+            if isinstance(e, ProtokollFehler):
+                server.sende_fehler(self.conn, e.error_code)
+            self.conn.close()
+
+    def _resume(self):
+        if self.closed or self.conn.transport.is_closing():
+            return
+        self.conn.transport.resume_reading()
+        self._process()
+
+    def pause_writing(self):
+        self.conn.over_high_water()
+
+    def resume_writing(self):
+        self.conn.below_high_water()
+
+    def connection_lost(self, exc):
+        server.fristen.cancel(self.conn)
+        self.conn.abort()
+        if not self.closed:
+            self.closed = True
+            server.entferne_client(self.conn)
+
+
+async def serve(host, port, reuse_port=False):
+    loop = asyncio.get_running_loop()
+    server.benachrichtigungen.schedule = loop.call_later  # Flush auf der Loop statt in einem Timer-Thread
+    server.fristen.attach_loop(loop)  # Timeouts ebenfalls auf der Loop
+    if server.cluster is not None:
+        await server.cluster.attach_loop()  # Bus zu den anderen Workern auf derselben Loop
+    srv = await loop.create_server(ClientProtocol, host, port, backlog=server.LISTEN_BACKLOG,
+                                   reuse_address=True, reuse_port=reuse_port or None)
+    print(f"Server listening on {host}:{port} (asyncio)")
+    async with srv:
+        await srv.serve_forever()
+
+
+def main(host=server.SERVER_HOST, port=server.SERVER_PORT, reuse_port=False):
+    try:
+        asyncio.run(serve(host, port, reuse_port))
+    except KeyboardInterrupt:
+        print("\nServer wird heruntergefahren...")
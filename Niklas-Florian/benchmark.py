@@ -0,0 +1,1461 @@
+# benchmark.py
+# Vergleicht die Server-Engines unter Last über Loopback.
+#
+#   python benchmark.py engines --clients 10000
+#
+#   python benchmark.py slow
+#
+# Pro Engine wird server.py als eigener Prozess gestartet, es werden N inaktive
+# TCP-Verbindungen aufgebaut und danach RSS/Threads des Servers sowie die
+# Broadcast-Latenz zwischen zwei registrierten Clients gemessen.
+# 'slow' misst die Broadcast-Latenz gesunder Clients einmal ohne und einmal mit
+# einem Client, der nichts mehr liest, und prüft, ob dieser getrennt wird.
+#
+#   python benchmark.py large --sizes 4093 4094 16384 65535
+#
+# 'large' schickt Broadcasts um und über READ_CHUNK_SIZE (der Lesepuffer des Servers
+# muss wachsen, während Payload-Views aus ihm noch leben) und misst die Latenz;
+# delivered=false heißt, der Sender wurde dabei getrennt.
+#
+#   python benchmark.py join --sizes 1000 10000 50000
+#
+# 'join' läuft ohne Sockets im selben Prozess: bei N registrierten Clients wird
+# gemessen, wie schnell weitere Clients registriert werden (registriere_client),
+# und wie lange allein der Aufbau von Msg 2 dauert, einmal mit dem RosterCache
+# und einmal mit der früheren Neuserialisierung der ganzen Liste. Danach werden die
+# neuen Clients wieder abgemeldet (Leaves pro Sekunde inkl. Msg 5 an alle) und die
+# Kosten eines Leaves allein im RosterCache gemessen.
+#
+#   python benchmark.py workers --workers 1 2 4
+#
+# 'workers' startet den Server mit --workers N und lässt mehrere loadgen.py-Prozesse
+# gleichzeitig Last erzeugen; verglichen werden die summierten Auslieferungen pro
+# Sekunde und die Fan-out-Latenz. Aussagekräftig nur mit mehreren CPU-Kernen.
+#
+#   python benchmark.py storm --clients 10000 --windows 0 0.005
+#
+# 'storm' simuliert den Reconnect-Sturm nach einem Neustart: N Clients registrieren
+# sich gleichzeitig und gehen wieder. Gemessen werden CPU-Zeit und Kontextwechsel
+# des Servers, einmal mit einzeln gesendeten Msg 4/5 (--notify-window 0) und einmal
+# gebündelt.
+#
+#   python benchmark.py codec
+#
+# 'codec' misst ns pro Nachricht beim Kodieren (inline struct.pack wie früher,
+# encode_* aus codec.py) und Dekodieren (inline struct.unpack mit Slices wie
+# früher, FrameDecoder mit Kopien, FrameDecoder zero_copy mit memoryviews). Alle
+# drei Decoder liefern dieselben (msg_id, payload)-Tupel an den Aufrufer.
+#
+#   python benchmark.py resume --sizes 1000 10000 50000 --changes 10
+#
+# 'resume' läuft wie 'join' ohne Sockets: ein Client verliert die Verbindung,
+# währenddessen ändert sich der Roster um --changes Joins/Leaves. Verglichen werden
+# die Bytes, die er beim Wiederkommen bekommt: Neuregistrierung (Msg 2) gegen
+# Fortsetzen mit Token (Msg 11, nur die verpassten Msg 4/5).
+#
+#   python benchmark.py compress --sizes 1000 10000 50000
+#
+# 'compress' läuft ebenfalls ohne Sockets: N Clients mit zlib-Fähigkeit (Msg 12).
+# Gemessen werden Bytes auf der Leitung und CPU-Zeit für Msg 2 (Server: packen pro
+# Level, Client: dekodieren) und für Broadcasts mit chatähnlichem Text an alle N,
+# jeweils unkomprimiert (--compress-min 0) und komprimiert.
+#
+#   python benchmark.py p2p --sessions 200
+#
+# 'p2p' misst die Aufbauzeit von P2P-Chats (Msg 8 per UDP bis zur TCP-Verbindung)
+# mit zwei P2PSessionManagern im selben Prozess, einmal normal und einmal, wenn die
+# erste Msg 8 verloren geht (dann greift die Wiederholung nach RETRY_INTERVAL).
+#
+#   python benchmark.py p2pfile --size-mb 2048
+#
+# 'p2pfile' schickt eine Datei über eine P2P-Sitzung (Msg 17-19, sendfile beim
+# Sender, recv_into ins mmap beim Empfänger) und vergleicht den Durchsatz mit rohem
+# TCP über Loopback (socket.sendfile, Empfänger liest in einen festen Puffer und
+# verwirft ihn bzw. schreibt ihn per write() in eine Datei). Danach wird die
+# Übertragung bei --resume-at abgebrochen und fortgesetzt.
+#
+#   python benchmark.py churn --rounds 5 --idle-timeout 1
+#
+# 'churn' öffnet pro Runde Verbindungen, die nach der Registrierung verstummen,
+# mitten in Msg 1 hängen bleiben oder nie etwas schicken, und misst, wann die
+# anderen Msg 5 bekommen und wie sich Threads und RSS des Servers über die Runden
+# entwickeln (mit --idle-timeout 0 bleiben die stummen Clients stehen).
+#
+#   python benchmark.py roster --sizes 1000 10000 100000
+#
+# 'roster' schickt eine Msg 2 mit N Clients über ein Socket-Paar und misst auf der
+# Client-Seite Zeit und verbleibenden Speicher pro Eintrag: frühere Variante mit
+# vier recv pro Eintrag und einem dict pro Client, FrameDecoder mit dicts und
+# FrameDecoder direkt in die ClientList; dazu die Präfix-Suche nach Namen.
+#
+#   python benchmark.py federation --nodes 3
+#
+# 'federation' startet N Server-Knoten (--peer-port/--peer) über Loopback und misst
+# die Broadcast-Latenz einmal mit Sender und Empfänger auf demselben Knoten und
+# einmal über Knoten hinweg, dazu die Zeit, bis ein Join auf einem anderen Knoten
+# als Msg 4 ankommt, und ob derselbe Name dort danach mit EC 2 abgelehnt wird.
+#
+#   python benchmark.py journal --messages 20000 --producers 8
+#
+# 'journal' schreibt Broadcast-Frames aus mehreren Threads (wie die Lese-Threads der
+# thread-Engine) ins Journal, einmal mit write+fdatasync pro Nachricht im Handler
+# und einmal über Journal.append() mit Group Commit. Gemessen werden die Zeit im
+# Handler, der Durchsatz bis alles synchronisiert ist und die mittlere Gruppengröße;
+# danach tail(N) über den Offset-Index gegen einen Durchlauf von vorne und scan().
+#
+#   python benchmark.py channels --sizes 1000 10000 100000 --members 50
+#
+# 'channels' läuft ohne Sockets: N registrierte Clients, davon --members in einem
+# Channel. Gemessen wird die Zeit pro Nachricht im Handler für eine Channel-Nachricht
+# (Msg 16, Fan-out über den Mitglieder-Index) gegen einen Broadcast (Msg 6, an alle
+# N), jeweils ohne Kompression und ohne Bündelungsfenster.
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import codec
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_udp_ports = itertools.count(40000)  # (IP, UDP-Port) muss pro Client eindeutig sein (EC 1)
+
+_WORDS = ('hallo', 'alle', 'zusammen', 'wer', 'ist', 'heute', 'abend', 'noch', 'online', 'der', 'server',
+          'läuft', 'wieder', 'stabil', 'danke', 'für', 'die', 'info', 'ich', 'bin', 'gleich', 'weg',
+          'treffen', 'wir', 'uns', 'morgen', 'um', 'zehn', 'in', 'raum', 'b', 'und', 'das', 'neue', 'build')
+
+
+def chat_text(size, seed=0):
+    # Reproduzierbarer, chatähnlicher UTF-8-Text mit genau size Bytes; lässt sich
+    # realistischer komprimieren als wiederholte Einzelzeichen
+    rng = random.Random(seed)
+    text = bytearray()
+    while len(text) < size:
+        text += rng.choice(_WORDS).encode('utf-8') + b' '
+    return bytes(text[:size]).decode('utf-8', 'ignore').encode('utf-8').ljust(size, b' ')
+
+
+def raise_fd_limit():
+    # Viele Clients brauchen viele Dateideskriptoren
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def proc_status(pid):
+    # Liest RSS (in KiB) und Thread-Anzahl aus /proc
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                status[key] = int(value.split()[0])
+    return status
+
+
+def proc_cpu(pid):
+    # CPU-Sekunden (user + system) und Kontextwechsel aller Threads eines Prozesses
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    switches = 0
+    for task in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{task}/status') as f:
+                for line in f:
+                    if 'ctxt_switches' in line:  # voluntary_ und nonvoluntary_
+                        switches += int(line.split()[-1])
+        except OSError:
+            pass  # Thread inzwischen beendet
+    return cpu, switches
+
+
+def start_server(port, extra_args):
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'server.py'), '--port', str(port)] + extra_args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server ist nicht gestartet")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Verbindung geschlossen")
+        buf += chunk
+    return bytes(buf)
+
+
+def register(port, name, udp_port, rcvbuf=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.connect(('127.0.0.1', port))
+    sock.sendall(codec.encode_registration(socket.inet_aton('127.0.0.1'), udp_port, name))
+    return sock
+
+
+def read_frame(sock):
+    # Liest genau eine Server-Nachricht und gibt (msg_id, payload) zurück
+    msg_id = recv_exact(sock, 1)[0]
+    if msg_id == 2:
+        count = struct.unpack('!I', recv_exact(sock, 4))[0]
+        payload = []
+        for _ in range(count):
+            ip, port, name_len = struct.unpack('!4sH B', recv_exact(sock, 7))
+            payload.append(recv_exact(sock, name_len))
+        return msg_id, payload
+    if msg_id == 4:
+        _, _, name_len = struct.unpack('!I H B', recv_exact(sock, 7))
+        return msg_id, recv_exact(sock, name_len)
+    if msg_id == 5:
+        return msg_id, recv_exact(sock, recv_exact(sock, 1)[0])
+    if msg_id == 6:
+        return msg_id, recv_exact(sock, struct.unpack('!H', recv_exact(sock, 2))[0])
+    if msg_id == 0:
+        return msg_id, recv_exact(sock, 1)
+    if msg_id == 10:
+        return msg_id, codec.SESSION.unpack(bytes([10]) + recv_exact(sock, codec.SESSION.size - 1))[1:]
+    raise ValueError(f"Unerwartete msg_id {msg_id}")
+
+
+def drain(sock):
+    # Verwirft alles, was gerade ohne Warten lesbar ist (Msg 4/5 usw.)
+    try:
+        while sock.recv(65536, socket.MSG_DONTWAIT):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure_broadcast_latency(port, messages, payload_size=16, prefix='bench', receiver_port=None):
+    # receiver_port: Empfänger auf einem anderen Knoten registrieren (Föderation)
+    sender = register(port, f'{prefix}-sender', next(_udp_ports))
+    read_frame(sender)  # Msg 2
+    receiver = register(receiver_port or port, f'{prefix}-receiver', next(_udp_ports))
+    read_frame(receiver)  # Msg 2
+    if receiver_port:
+        # Erst messen, wenn der Join beim Knoten des Senders angekommen ist
+        while read_frame(sender) != (4, f'{prefix}-receiver'.encode('utf-8')):
+            pass
+
+    padding = 'x' * max(0, payload_size - 16)
+    latencies = []
+    for i in range(messages):
+        payload = f'{i:>15} {padding}'.encode('utf-8')
+        start = time.perf_counter()
+        sender.sendall(struct.pack('!B H', 6, len(payload)) + payload)
+        while True:
+            msg_id, data = read_frame(receiver)
+            if msg_id == 6 and data == payload:
+                break
+        latencies.append((time.perf_counter() - start) * 1e6)
+        drain(sender)
+
+    sender.close()
+    receiver.close()
+    return latencies
+
+
+def bench_engine(engine, clients, messages):
+    port = free_port()
+    proc = start_server(port, ['--engine', engine])
+    try:
+        baseline = proc_status(proc.pid)
+
+        idle = []
+        start = time.perf_counter()
+        for _ in range(clients):
+            idle.append(socket.create_connection(('127.0.0.1', port)))
+        connect_time = time.perf_counter() - start
+        time.sleep(1.0)  # Server die Verbindungen annehmen lassen
+        loaded = proc_status(proc.pid)
+
+        latencies = measure_broadcast_latency(port, messages)
+
+        for sock in idle:
+            sock.close()
+        return {
+            'engine': engine,
+            'idle_clients': clients,
+            'connect_seconds': round(connect_time, 3),
+            'rss_kib_baseline': baseline['VmRSS'],
+            'rss_kib_loaded': loaded['VmRSS'],
+            'rss_bytes_per_client': round((loaded['VmRSS'] - baseline['VmRSS']) * 1024 / max(clients, 1), 1),
+            'threads_loaded': loaded['Threads'],
+            'broadcast_p50_us': round(percentile(latencies, 50), 1),
+            'broadcast_p99_us': round(percentile(latencies, 99), 1),
+        }
+    finally:
+        stop_server(proc)
+
+
+def wait_for_close(sock, timeout):
+    # Liest alles, bis der Server die Verbindung schließt; False bei Timeout
+    sock.settimeout(timeout)
+    try:
+        while sock.recv(1 << 20):
+            pass
+        return True
+    except socket.timeout:
+        return False
+    except OSError:
+        return True
+
+
+def bench_large(engine, sizes, messages):
+    port = free_port()
+    proc = start_server(port, ['--engine', engine])
+
+    def delivered(size):
+        # Ein Broadcast mit Timeout beim Empfänger, damit ein getrennter Sender die
+        # Messung nicht aufhängt
+        sender = register(port, f'probe-{size}-sender', next(_udp_ports))
+        receiver = register(port, f'probe-{size}-receiver', next(_udp_ports))
+        receiver.settimeout(5)
+        try:
+            read_frame(receiver)  # Msg 2
+            payload = b'x' * size
+            sender.sendall(codec.encode_broadcast(payload))
+            while True:
+                msg_id, data = read_frame(receiver)
+                if msg_id == 6 and data == payload:
+                    return True
+                if msg_id == 5 and data == f'probe-{size}-sender'.encode('utf-8'):
+                    return False
+        except OSError:
+            return False
+        finally:
+            sender.close()
+            receiver.close()
+
+    try:
+        rows = []
+        for size in sizes:
+            if not delivered(size):
+                rows.append({'engine': engine, 'payload_bytes': size, 'delivered': False})
+                continue
+            latencies = measure_broadcast_latency(port, messages, size, prefix=f'large-{size}')
+            rows.append({
+                'engine': engine,
+                'payload_bytes': size,
+                'delivered': True,
+                'p50_us': round(percentile(latencies, 50), 1),
+                'p99_us': round(percentile(latencies, 99), 1),
+            })
+        return rows
+    finally:
+        stop_server(proc)
+
+
+def bench_slow(engine, messages, payload_size, slow_timeout):
+    port = free_port()
+    proc = start_server(port, ['--engine', engine, '--slow-client-timeout', str(slow_timeout)])
+    try:
+        healthy = measure_broadcast_latency(port, messages, payload_size, prefix='healthy')
+
+        # Kleiner Empfangspuffer und nie lesen: die Queue im Server läuft voll
+        slow = register(port, 'slow-consumer', next(_udp_ports), rcvbuf=4096)
+        with_slow = measure_broadcast_latency(port, messages, payload_size, prefix='with-slow')
+        time.sleep(slow_timeout + 1)  # erst danach lesen, sonst wäre der Client nicht mehr langsam
+        evicted = wait_for_close(slow, 5)
+        slow.close()
+        return {
+            'engine': engine,
+            'messages': messages,
+            'payload_bytes': payload_size,
+            'p50_us_healthy': round(percentile(healthy, 50), 1),
+            'p99_us_healthy': round(percentile(healthy, 99), 1),
+            'p50_us_with_slow_client': round(percentile(with_slow, 50), 1),
+            'p99_us_with_slow_client': round(percentile(with_slow, 99), 1),
+            'slow_client_evicted': evicted,
+        }
+    finally:
+        stop_server(proc)
+
+
+class NullConnection:
+    # Ersatz für eine Client-Verbindung, der alles verwirft
+    compress = False
+    sessions = False
+    rate_limit = None
+
+    def send(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def legacy_registration_response(clients):
+    # Frühere Variante: Client-Liste bei jedem Join komplett neu packen
+    client_list = b''
+    for nick, (sock, ip, port) in clients.items():
+        client_list += struct.pack('!4sH B', socket.inet_aton(ip), port, len(nick)) + nick.encode('utf-8')
+    return struct.pack('!B I', 2, len(clients)) + client_list
+
+
+def fake_address(i):
+    # Eindeutiges (IP, UDP-Port) auch für mehr als 65535 Clients
+    return struct.pack('!I', 0x7F000001 + i // 60000), 1024 + i % 60000
+
+
+def bench_join(size, joins):
+    import server
+
+    server.registry = server.ClientRegistry()
+    # Direkt befüllen, sonst würde schon das Vorbereiten N² Msg-4-Frames erzeugen
+    for i in range(size):
+        server.registry.add(f'client-{i}', NullConnection(), *fake_address(i))
+
+    def timed(fn, rounds):
+        start = time.perf_counter()
+        for i in range(rounds):
+            fn(i)
+        return (time.perf_counter() - start) / rounds
+
+    legacy_clients = {entry.name: (entry.conn, entry.ip, entry.udp_port) for entry in server.registry.snapshot()}
+    cached_us = timed(lambda i: server.registry.roster.frame(), joins) * 1e6
+    legacy_us = timed(lambda i: legacy_registration_response(legacy_clients), 3) * 1e6  # quadratisch, daher wenige Runden
+
+    sink = io.StringIO()
+    joiners = [NullConnection() for _ in range(joins)]
+    with contextlib.redirect_stdout(sink):
+        start = time.perf_counter()
+        for i, conn in enumerate(joiners):
+            ip, udp_port = fake_address(size + i)
+            server.registriere_client(conn, ip, udp_port, f'joiner-{i}')
+        join_seconds = time.perf_counter() - start
+        msg2_bytes = len(server.registry.roster.frame())
+
+        # Dieselben Clients wieder abmelden (inkl. Msg 5 an alle)
+        start = time.perf_counter()
+        for conn in joiners:
+            server.entferne_client(conn)
+        leave_seconds = time.perf_counter() - start
+
+    # Nur das Herausschneiden aus dem RosterCache, für die ältesten Einträge (vorne im
+    # Puffer, früher der teuerste Fall); danach passt der Roster nicht mehr zur Registry
+    roster_leave_us = timed(lambda i: server.registry.roster.remove(f'client-{i}'), min(joins, size)) * 1e6
+    return {
+        'registered': size,
+        'joins': joins,
+        'joins_per_second': round(joins / join_seconds, 1),
+        'leaves_per_second': round(joins / leave_seconds, 1),
+        'roster_leave_us': round(roster_leave_us, 2),
+        'msg2_build_us_cached': round(cached_us, 1),
+        'msg2_build_us_legacy': round(legacy_us, 1),
+        'msg2_bytes': msg2_bytes,
+    }
+
+
+class CountingConnection(NullConnection):
+    # Zählt die an den Client gesendeten Bytes und merkt sich das Token aus Msg 10
+    sessions = True  # wie ein Client, der CAP_SESSION angemeldet hat
+
+    def __init__(self):
+        self.received = 0
+        self.token = None
+
+    def send(self, data):
+        self.received += len(data)
+        if data[0] == 10 and len(data) == codec.SESSION.size:
+            self.token = codec.SESSION.unpack(data)[1]
+        return len(data)
+
+    def abort(self):
+        pass
+
+
+def bench_resume(size, changes):
+    import server
+
+    server.registry = server.ClientRegistry()
+    server.benachrichtigungen.window = 0
+    for i in range(size):
+        server.registry.add(f'client-{i}', NullConnection(), *fake_address(i))
+
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink):
+        conn = CountingConnection()
+        ip, udp_port = fake_address(size)
+        server.registriere_client(conn, ip, udp_port, 'resumer')
+        token, version = conn.token, server.registry.roster.version
+        server.entferne_client(conn)  # Verbindungsabbruch
+        for i in range(changes):
+            # Abwechselnd Join und Leave, wie auf einem belebten Server
+            if i % 2:
+                server.entferne_client(server.registry.get(f'client-{i}').conn)
+            else:
+                server.registriere_client(NullConnection(), *fake_address(size + 1 + i), f'late-{i}')
+
+        resumed = CountingConnection()
+        start = time.perf_counter()
+        server.handel_sitzung_fortsetzen(resumed, (token, version))
+        resume_us = (time.perf_counter() - start) * 1e6
+        server.entferne_client(resumed)
+
+        # Zum Vergleich dasselbe Wiederkommen als Neuregistrierung (Msg 2 + Msg 10)
+        full = CountingConnection()
+        start = time.perf_counter()
+        server.registriere_client(full, ip, udp_port, 'resumer')
+        full_us = (time.perf_counter() - start) * 1e6
+    return {
+        'registered': size,
+        'changes': changes,
+        'full_bytes': full.received,
+        'resume_bytes': resumed.received,
+        'full_us': round(full_us, 1),
+        'resume_us': round(resume_us, 1),
+    }
+
+
+def bench_compress(size, payload_size, broadcasts):
+    import server
+    from protocol import FrameDecoder
+
+    server.registry = server.ClientRegistry()
+    server.benachrichtigungen.window = 0
+    conns = []
+    for i in range(size):
+        conn = CountingConnection()
+        conn.compress = True
+        conns.append(conn)
+        server.registry.add(f'client-{i}', conn, *fake_address(i))
+
+    def best_us(fn, rounds=3):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best * 1e6, 1)
+
+    def decode(frame):
+        decoder = FrameDecoder()
+        decoder.feed(frame)
+        for _ in decoder.messages():
+            pass
+
+    roster = server.registry.roster.frame()
+    result = {'registered': size, 'msg2_bytes': len(roster), 'msg2_decode_us': best_us(lambda: decode(roster))}
+    for level in (1, 6):
+        compressed = codec.encode_compressed(roster, level)
+        result[f'msg2_bytes_level{level}'] = len(compressed)
+        result[f'msg2_compress_us_level{level}'] = best_us(lambda: codec.encode_compressed(roster, level))
+        result[f'msg2_decode_us_level{level}'] = best_us(lambda: decode(compressed))
+
+    frames = [codec.encode_broadcast(chat_text(payload_size, seed)) for seed in range(broadcasts)]
+    compress_min = server.COMPRESS_MIN
+    for label, threshold in (('plain', 0), ('zlib', compress_min)):
+        server.COMPRESS_MIN = threshold
+        for conn in conns:
+            conn.received = 0
+        start = time.process_time()
+        for frame in frames:
+            server.verteile_frame(frame)
+        cpu = time.process_time() - start
+        result[f'broadcast_bytes_{label}'] = sum(conn.received for conn in conns)
+        result[f'broadcast_cpu_us_per_message_{label}'] = round(cpu / broadcasts * 1e6, 1)
+    server.COMPRESS_MIN = compress_min
+    return result
+
+
+def bench_channels(size, members, messages, payload_size):
+    import server
+
+    server.registry = server.ClientRegistry()
+    server.kanaele = server.ChannelIndex()
+    server.benachrichtigungen.window = 0
+    server.COMPRESS_MIN = 0
+    server.VERBOSE = False
+    entries = [server.registry.add(f'client-{i}', CountingConnection(), *fake_address(i)) for i in range(size)]
+    channel = b'team'
+    for entry in entries[:members]:
+        server.kanaele.join(entry, channel)
+    sender = entries[0].conn
+    payload = chat_text(payload_size)
+
+    def per_message_us(handler, arg, rounds=3):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(messages):
+                handler(sender, arg)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best / messages * 1e6, 2)
+
+    result = {'registered': size, 'members': members}
+    for label, handler, arg in (('channel', server.handel_channel_nachricht, (channel, payload)),
+                                ('broadcast', server.handel_broadcast, payload)):
+        for entry in entries:
+            entry.conn.received = 0
+        result[f'{label}_us_per_message'] = per_message_us(handler, arg)
+        result[f'{label}_recipients'] = sum(1 for entry in entries if entry.conn.received)
+    result['speedup'] = round(result['broadcast_us_per_message'] / result['channel_us_per_message'], 1)
+    return result
+
+
+def bench_workers(engine, workers, loadgens, clients, rate, duration):
+    port = free_port()
+    proc = start_server(port, ['--engine', engine, '--workers', str(workers)])
+    try:
+        time.sleep(0.5)  # Worker brauchen nach dem Fork einen Moment bis zum listen()
+        per_loadgen = clients // loadgens
+        runs = [subprocess.Popen([sys.executable, os.path.join(HERE, 'loadgen.py'), '--port', str(port),
+                                  '--clients', str(per_loadgen), '--id-offset', str(i * per_loadgen),
+                                  '--rate', str(rate / loadgens), '--duration', str(duration)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=HERE)
+                for i in range(loadgens)]
+        results = [json.loads(run.communicate()[0])['result'] for run in runs]
+        broadcasts = [r['broadcast'] for r in results if 'broadcast' in r]
+        return {
+            'engine': engine,
+            'workers': workers,
+            'loadgens': loadgens,
+            'clients': per_loadgen * loadgens,
+            'failed_joins': sum(r['join']['failed'] for r in results),
+            'broadcasts_per_second': round(sum(b['messages_per_second'] for b in broadcasts), 1),
+            'deliveries_per_second': round(sum(b['deliveries_per_second'] for b in broadcasts), 1),
+            'fanout_p99_ms_max': max((b['fanout_latency_ms'].get('p99', 0) for b in broadcasts), default=None),
+        }
+    finally:
+        stop_server(proc)
+
+
+def bench_storm(engine, clients, window):
+    port = free_port()
+    proc = start_server(port, ['--engine', engine, '--notify-window', str(window)])
+    try:
+        cpu_before, switches_before = proc_cpu(proc.pid)
+        start = time.perf_counter()
+        run = subprocess.run([sys.executable, os.path.join(HERE, 'loadgen.py'), '--port', str(port),
+                              '--clients', str(clients), '--concurrency', '1000', '--duration', '0',
+                              '--timeout', '60'], capture_output=True, text=True, cwd=HERE)
+        seconds = time.perf_counter() - start
+        time.sleep(window + 0.5)  # letzte Msg 5 ausliefern lassen
+        cpu_after, switches_after = proc_cpu(proc.pid)
+        result = json.loads(run.stdout)['result']
+        return {
+            'engine': engine,
+            'notify_window': window,
+            'clients': clients,
+            'failed_joins': result['join']['failed'],
+            'join_seconds': result['join']['seconds'],
+            'join_p99_ms': result['join']['latency_ms'].get('p99'),
+            'total_seconds': round(seconds, 3),
+            'server_cpu_seconds': round(cpu_after - cpu_before, 2),
+            'server_context_switches': switches_after - switches_before,
+            'msg4_received': result['messages_received'].get('4', 0),
+        }
+    finally:
+        stop_server(proc)
+
+
+def _legacy_encoders():
+    # Die Ausdrücke, mit denen server.py und client.py vor codec.py kodiert haben
+    ip = socket.inet_aton('127.0.0.1')
+
+    def new_client(name):
+        name_encoded = name.encode('utf-8')
+        ip_as_int = struct.unpack('!I', socket.inet_aton('127.0.0.1'))[0]
+        return struct.pack('!B', 4) + struct.pack('!I H B', ip_as_int, 4000, len(name_encoded)) + name_encoded
+
+    def client_left(name):
+        name_encoded = name.encode('utf-8')
+        return struct.pack('!B B', 5, len(name_encoded)) + name_encoded
+
+    return {
+        0: lambda name, text: struct.pack('!BB', 0, 2),
+        1: lambda name, text: struct.pack('!B4sH B', 1, ip, 4000, len(name.encode('utf-8'))) + name.encode('utf-8'),
+        4: lambda name, text: new_client(name),
+        5: lambda name, text: client_left(name),
+        6: lambda name, text: struct.pack('!B H', 6, len(text)) + text,
+        8: lambda name, text: struct.pack('!B H B', 8, 5000, len(name.encode('utf-8'))) + name.encode('utf-8'),
+        9: lambda name, text: struct.pack('!B H', 9, len(text)) + text,
+    }
+
+
+def _legacy_decode(stream):
+    # Inline-Parsing wie früher: Format-Strings und Slices, die jeweils kopieren. Liefert
+    # dieselben (msg_id, payload) wie der FrameDecoder, damit beide gleich viel tun
+    offset, end = 0, len(stream)
+    while offset < end:
+        msg_id = stream[offset]
+        if msg_id == 0:
+            yield 0, stream[offset + 1]
+            offset += 2
+        elif msg_id in (1, 4):
+            ip, udp_port, name_len = struct.unpack('!4sH B', stream[offset + 1:offset + 8])
+            name = stream[offset + 8:offset + 8 + name_len]
+            offset += 8 + name_len
+            yield msg_id, (ip, udp_port, name)
+        elif msg_id == 5:
+            name = stream[offset + 2:offset + 2 + stream[offset + 1]]
+            offset += 2 + len(name)
+            yield 5, name
+        elif msg_id in (6, 9):
+            msg_len = struct.unpack('!H', stream[offset + 1:offset + 3])[0]
+            text = stream[offset + 3:offset + 3 + msg_len]
+            offset += 3 + msg_len
+            yield msg_id, text
+        elif msg_id == 8:
+            tcp_port, name_len = struct.unpack('!H B', stream[offset + 1:offset + 4])
+            name = stream[offset + 4:offset + 4 + name_len]
+            offset += 4 + name_len
+            yield 8, (tcp_port, name)
+
+
+def legacy_decode_all(stream):
+    for _ in _legacy_decode(stream):
+        pass
+
+
+def bench_codec(messages, payload_size):
+    from protocol import FrameDecoder
+
+    name = 'client-12345'
+    text = b'x' * payload_size
+    ip = socket.inet_aton('127.0.0.1')
+    legacy = _legacy_encoders()
+    encoders = {
+        0: lambda: codec.encode_error(2),
+        1: lambda: codec.encode_registration(ip, 4000, name),
+        4: lambda: codec.encode_new_client(ip, 4000, name),
+        5: lambda: codec.encode_client_left(name),
+        6: lambda: codec.encode_broadcast(text),
+        8: lambda: codec.encode_p2p_request(5000, name),
+        9: lambda: codec.encode_p2p_message(text),
+    }
+
+    def per_message_ns(fn, rounds=5):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter_ns()
+            for _ in range(messages):
+                fn()
+            elapsed = time.perf_counter_ns() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best / messages, 1)
+
+    def decode_ns(decode, stream):
+        best = None
+        for _ in range(5):
+            start = time.perf_counter_ns()
+            decode(stream)
+            elapsed = time.perf_counter_ns() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best / messages, 1)
+
+    def frame_decoder(zero_copy):
+        def decode(stream):
+            decoder = FrameDecoder(len(stream) + 1, zero_copy=zero_copy)
+            decoder.feed(stream)
+            for _ in decoder.messages():
+                pass
+        return decode
+
+    results = []
+    for msg_id, encode in encoders.items():
+        frame = encode()
+        assert bytes(frame) == legacy[msg_id](name, text), msg_id
+        stream = bytes(frame) * messages
+        results.append({
+            'msg_id': msg_id,
+            'frame_bytes': len(frame),
+            'encode_ns_inline': per_message_ns(lambda: legacy[msg_id](name, text)),
+            'encode_ns_codec': per_message_ns(encode),
+            'decode_ns_inline': decode_ns(legacy_decode_all, stream),
+            'decode_ns_frame_decoder': decode_ns(frame_decoder(False), stream),
+            'decode_ns_zero_copy': decode_ns(frame_decoder(True), stream),
+        })
+    return results
+
+
+def legacy_read_roster(sock):
+    # Frühere Client-Variante: vier recv pro Eintrag, ein dict pro Client
+    clients = {}
+    recv_exact(sock, 1)  # Msg-ID
+    count = struct.unpack('!I', recv_exact(sock, 4))[0]
+    for _ in range(count):
+        ip = socket.inet_ntoa(recv_exact(sock, 4))
+        udp_port = struct.unpack('!H', recv_exact(sock, 2))[0]
+        name_len = recv_exact(sock, 1)[0]
+        name = recv_exact(sock, name_len).decode('utf-8')
+        clients[name] = {'ip': ip, 'udp_port': udp_port}
+    return clients
+
+
+def decoder_read_roster(sock, roster=None):
+    # FrameDecoder mit großen Reads; ohne roster wie bisher Tupel-Liste -> dicts
+    from protocol import FrameDecoder
+
+    decoder = FrameDecoder(roster=roster)
+    while True:
+        decoder.recv_from(sock)
+        for msg_id, payload in decoder.messages():
+            if roster is not None:
+                return roster
+            return {str(name, 'utf-8'): {'ip': socket.inet_ntoa(ip), 'udp_port': udp_port}
+                    for ip, udp_port, name in payload}
+
+
+def bench_roster(size, lookups):
+    import threading
+    import tracemalloc
+    from clientlist import ClientList
+    from roster import RosterCache
+
+    cache = RosterCache()
+    for i in range(size):
+        cache.add(f'client-{i}', *fake_address(i))
+    frame = cache.frame()
+
+    def timed_read(read):
+        # Msg 2 über ein Socket-Paar, gemessen bis die Liste komplett eingelesen ist
+        a, b = socket.socketpair()
+        sender = threading.Thread(target=a.sendall, args=(frame,))
+        start = time.perf_counter()
+        sender.start()
+        store = read(b)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        a.close()
+        b.close()
+        return store, elapsed
+
+    def retained_bytes(read):
+        # Speicher, der nach dem Einlesen in der Liste selbst steckt
+        a, b = socket.socketpair()
+        sender = threading.Thread(target=a.sendall, args=(frame,))
+        sender.start()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        store = read(b)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        sender.join()
+        a.close()
+        b.close()
+        del store
+        return used
+
+    variants = (
+        ('recv_per_field', legacy_read_roster),
+        ('decoder_dicts', decoder_read_roster),
+        ('clientlist', lambda sock: decoder_read_roster(sock, ClientList())),
+    )
+    result = {'clients': size, 'msg2_bytes': len(frame)}
+    stores = {}
+    for label, read in variants:
+        stores[label], elapsed = timed_read(read)
+        assert len(stores[label]) == size
+        result[f'{label}_ms'] = round(elapsed * 1e3, 1)
+        result[f'{label}_bytes_per_entry'] = round(retained_bytes(read) / size, 1)
+
+    # Auswahl eines P2P-Partners per Namensanfang: Durchlauf über das dict gegen Präfix-Suche
+    prefixes = [f'client-{random.randrange(size)}' for _ in range(lookups)]
+    dicts, clientlist = stores['decoder_dicts'], stores['clientlist']
+    start = time.perf_counter()
+    for prefix in prefixes:
+        [name for name in dicts if name.startswith(prefix)][:10]
+    result['prefix_scan_us'] = round((time.perf_counter() - start) / lookups * 1e6, 1)
+    clientlist.with_prefix('')  # erstes Sortieren nicht mitmessen
+    start = time.perf_counter()
+    for prefix in prefixes:
+        clientlist.with_prefix(prefix, 10)
+    result['prefix_bisect_us'] = round((time.perf_counter() - start) / lookups * 1e6, 1)
+    return result
+
+
+def bench_churn(engine, rounds, clients, idle_timeout):
+    # Pro Runde: Clients registrieren sich und verstummen, dazu Verbindungen mit halber
+    # Registrierung und solche, die nie etwas schicken. Ein Beobachter hält sich mit
+    # kurzen Broadcasts am Leben und merkt sich, wann Msg 5 für wen ankam.
+    import threading
+
+    port = free_port()
+    proc = start_server(port, ['--engine', engine, '--idle-timeout', str(idle_timeout)])
+    observer = register(port, 'observer', next(_udp_ports))
+    read_frame(observer)  # Msg 2
+    left = {}  # name -> Zeitpunkt von Msg 5
+    stop = False
+
+    def watch():
+        try:
+            while True:
+                msg_id, data = read_frame(observer)
+                if msg_id == 5:
+                    left[data.decode('utf-8')] = time.perf_counter()
+        except (OSError, ValueError):
+            pass
+
+    def keep_alive():
+        while not stop:
+            observer.sendall(codec.encode_broadcast(b'.'))
+            time.sleep(idle_timeout / 3 if idle_timeout else 1.0)
+
+    threading.Thread(target=watch, daemon=True).start()
+    threading.Thread(target=keep_alive, daemon=True).start()
+    try:
+        baseline = proc_status(proc.pid)
+        samples = []
+        latencies = []
+        for r in range(rounds):
+            silent = {}
+            socks = []
+            for i in range(clients):
+                name = f'churn-{r}-{i}'
+                kind = i % 4
+                if kind < 2:
+                    socks.append(register(port, name, next(_udp_ports)))  # registriert, dann still
+                    silent[name] = time.perf_counter()
+                elif kind == 2:
+                    sock = socket.create_connection(('127.0.0.1', port))
+                    sock.sendall(codec.encode_registration(socket.inet_aton('127.0.0.1'), next(_udp_ports), name)[:5])
+                    socks.append(sock)  # halbe Registrierung
+                else:
+                    socks.append(socket.create_connection(('127.0.0.1', port)))  # schickt nie etwas
+            time.sleep(max(idle_timeout, 3.0) + 1.0)  # längste Frist (Msg 1: 3 s) plus Reserve
+            for name, registered in silent.items():
+                if name in left:
+                    latencies.append(left[name] - registered)
+            status = proc_status(proc.pid)
+            samples.append({
+                'round': r,
+                'evicted': f'{sum(name in left for name in silent)}/{len(silent)}',
+                'threads': status['Threads'],
+                'rss_kib': status['VmRSS'],
+            })
+            for sock in socks:
+                sock.close()
+        return {
+            'engine': engine,
+            'idle_timeout': idle_timeout,
+            'clients_per_round': clients,
+            'threads_baseline': baseline['Threads'],
+            'rss_kib_baseline': baseline['VmRSS'],
+            'eviction_p50_s': round(percentile(latencies, 50), 3) if latencies else None,
+            'eviction_max_s': round(max(latencies), 3) if latencies else None,
+            'rounds': samples,
+        }
+    finally:
+        stop = True
+        observer.close()
+        stop_server(proc)
+
+
+def bench_federation(engine, nodes, messages, joins):
+    # nodes Server-Prozesse, voll vermascht über Loopback; jeder Knoten wählt die
+    # vor ihm gestarteten per --peer an
+    ports = [free_port() for _ in range(nodes)]
+    peer_ports = [free_port() for _ in range(nodes)]
+    procs = []
+    try:
+        for i in range(nodes):
+            extra = ['--engine', engine, '--peer-port', str(peer_ports[i]), '--node-id', f'node-{i}']
+            for j in range(i):
+                extra += ['--peer', f'127.0.0.1:{peer_ports[j]}']
+            procs.append(start_server(ports[i], extra))
+
+        local = measure_broadcast_latency(ports[0], messages, prefix='local')
+        remote = measure_broadcast_latency(ports[0], messages, prefix='remote', receiver_port=ports[-1])
+
+        # Join über Knoten: Registrierung auf dem letzten Knoten bis Msg 4 beim ersten,
+        # danach derselbe Name noch einmal auf dem ersten Knoten (muss EC 2 bekommen)
+        watcher = register(ports[0], 'watcher', next(_udp_ports))
+        read_frame(watcher)  # Msg 2
+        join_latencies = []
+        rejected = 0
+        for i in range(joins):
+            name = f'join-{i}'
+            start = time.perf_counter()
+            sock = register(ports[-1], name, next(_udp_ports))
+            while read_frame(watcher) != (4, name.encode('utf-8')):
+                pass
+            join_latencies.append((time.perf_counter() - start) * 1e3)
+            duplicate = register(ports[0], name, next(_udp_ports))
+            if read_frame(duplicate) == (0, bytes([2])):
+                rejected += 1
+            duplicate.close()
+            sock.close()
+        watcher.close()
+        return {
+            'engine': engine,
+            'nodes': nodes,
+            'local_broadcast_p50_us': round(percentile(local, 50), 1),
+            'local_broadcast_p99_us': round(percentile(local, 99), 1),
+            'cross_node_broadcast_p50_us': round(percentile(remote, 50), 1),
+            'cross_node_broadcast_p99_us': round(percentile(remote, 99), 1),
+            'cross_node_join_p50_ms': round(percentile(join_latencies, 50), 3),
+            'cross_node_join_p99_ms': round(percentile(join_latencies, 99), 3),
+            'duplicates_rejected': f'{rejected}/{joins}',
+        }
+    finally:
+        for proc in procs:
+            stop_server(proc)
+
+
+def bench_p2p(sessions, lost):
+    import threading
+    import p2p
+
+    connected = {}  # name -> threading.Event
+
+    def on_event(name, event):
+        if event.startswith('verbunden') and name in connected:
+            connected[name].set()
+
+    def manager(name):
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind(('127.0.0.1', 0))
+        return p2p.P2PSessionManager(name, udp, 0, '127.0.0.1', lambda n, t: None, on_event)
+
+    def setup(requester, peer, name, drop_first=False):
+        connected[name] = threading.Event()
+        requester.request(name, '127.0.0.1', peer.udp_socket.getsockname()[1])
+        if drop_first:
+            peer.udp_socket.setblocking(True)
+            peer.udp_socket.recvfrom(1024)  # erste Msg 8 geht "verloren"
+            peer.udp_socket.setblocking(False)
+            peer.start()
+        if not connected[name].wait(p2p.RETRY_INTERVAL * (p2p.REQUEST_RETRIES + 1)):
+            return None
+        latency = requester.sessions[name].setup_latency
+        requester.close(name)
+        return latency
+
+    requester = manager('a')
+    requester.start()
+    latencies = []
+    for i in range(sessions):
+        # Neuer Peer pro Sitzung, damit jede Sitzung den vollen Handshake durchläuft
+        peer = manager(f'peer-{i}')
+        peer.start()
+        latencies.append(setup(requester, peer, f'peer-{i}'))
+        peer.stop()
+    retried = []
+    for i in range(lost):
+        peer = manager(f'lost-{i}')
+        retried.append(setup(requester, peer, f'lost-{i}', drop_first=True))
+        peer.stop()
+    requester.stop()
+
+    done = [latency * 1e3 for latency in latencies if latency is not None]
+    result = {
+        'sessions': sessions,
+        'failed': sessions - len(done),
+        'setup_p50_ms': round(percentile(done, 50), 3) if done else None,
+        'setup_p99_ms': round(percentile(done, 99), 3) if done else None,
+    }
+    if lost:
+        done = [latency * 1e3 for latency in retried if latency is not None]
+        result['lost_first_failed'] = lost - len(done)
+        result['lost_first_p50_ms'] = round(percentile(done, 50), 3) if done else None
+    return result
+
+
+def bench_p2p_file(size_mb, resume_at):
+    import hashlib
+    import shutil
+    import tempfile
+    import threading
+    import p2p
+
+    size = size_mb * 1024 * 1024
+    directory = tempfile.mkdtemp(prefix='chat-p2pfile-')
+    source = os.path.join(directory, 'datei.bin')
+    block = os.urandom(1024 * 1024)
+    with open(source, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+    def raw_tcp(to_file):
+        listener = socket.create_server(('127.0.0.1', 0))
+        receiver = socket.create_connection(listener.getsockname())
+        sender, _ = listener.accept()
+        listener.close()
+
+        def send():
+            with open(source, 'rb') as f:
+                sender.sendfile(f)
+            sender.close()
+        buf = memoryview(bytearray(1024 * 1024))
+        out = open(os.path.join(directory, 'raw.bin'), 'wb', buffering=0) if to_file else None
+        start = time.perf_counter()
+        thread = threading.Thread(target=send)
+        thread.start()
+        total = 0
+        while True:
+            n = receiver.recv_into(buf)
+            if not n:
+                break
+            if out is not None:
+                out.write(buf[:n])
+            total += n
+        elapsed = time.perf_counter() - start
+        thread.join()
+        receiver.close()
+        if out is not None:
+            out.close()
+            os.remove(out.name)
+        return total / elapsed
+
+    finished = threading.Event()
+    connected = threading.Event()
+    resumed_from = []
+
+    def on_event(name, event):
+        if event.startswith('verbunden'):
+            connected.set()
+
+    def on_progress(name, transfer):
+        if transfer.receiving and transfer.done():
+            resumed_from.append(transfer.resumed_from)
+            finished.set()
+
+    def manager(name, download_dir=p2p.DOWNLOAD_DIR):
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind(('127.0.0.1', 0))
+        return p2p.P2PSessionManager(name, udp, 0, '127.0.0.1', lambda n, t: None, on_event, on_progress,
+                                     download_dir)
+
+    def connect(a, b):
+        connected.clear()
+        a.request('b', '127.0.0.1', b.udp_socket.getsockname()[1])
+        while 'b' not in a.connected() or 'a' not in b.connected():
+            connected.wait(1)
+
+    def transfer(a, b):
+        finished.clear()
+        start = time.perf_counter()
+        a.send_file('b', source)
+        finished.wait()
+        return time.perf_counter() - start
+
+    downloads = os.path.join(directory, 'downloads')
+    target = os.path.join(downloads, 'datei.bin')
+    a, b = manager('a'), manager('b', downloads)
+    a.start()
+    b.start()
+    result = {'size_mb': size_mb, 'raw_tcp_mb_per_second': round(raw_tcp(False) / 1e6, 1),
+              'raw_tcp_to_file_mb_per_second': round(raw_tcp(True) / 1e6, 1)}
+    try:
+        connect(a, b)
+        seconds = transfer(a, b)
+        result['p2p_mb_per_second'] = round(size / seconds / 1e6, 1)
+        result['p2p_vs_raw_to_file'] = round(result['p2p_mb_per_second'] / result['raw_tcp_to_file_mb_per_second'], 2)
+        os.remove(target)
+
+        # Abbruch nach resume_at der Datei, dann dieselbe Datei noch einmal senden
+        a.send_file('b', source)
+        while not any(t.offset >= size * resume_at for _, t in b.transfers()):
+            time.sleep(0.001)
+        a.close('b')
+        while b.connected():
+            time.sleep(0.001)
+        connect(a, b)
+        seconds = transfer(a, b)
+        result['resumed_from_bytes'] = resumed_from[-1]
+        result['resumed_seconds'] = round(seconds, 3)
+        with open(source, 'rb') as f, open(target, 'rb') as g:
+            same = hashlib.sha1(f.read()).digest() == hashlib.sha1(g.read()).digest()
+        result['resumed_file_identical'] = same
+    finally:
+        a.stop()
+        b.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def bench_journal(messages, payload_size, producers, segment_bytes, replay):
+    import collections
+    import shutil
+    import tempfile
+    import threading
+    import zlib
+    from journal import RECORD, Journal
+
+    frame = codec.encode_broadcast(chat_text(payload_size))
+    per_producer = messages // producers
+    directory = tempfile.mkdtemp(prefix='chat-journal-')
+
+    def run_producers(handle):
+        # Zeit pro handle()-Aufruf, gemessen in den Producer-Threads
+        timings = []
+
+        def produce():
+            local = []
+            for _ in range(per_producer):
+                start = time.perf_counter()
+                handle(frame)
+                local.append(time.perf_counter() - start)
+            timings.extend(local)
+        threads = [threading.Thread(target=produce) for _ in range(producers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return timings, time.perf_counter() - start
+
+    def summary(label, timings, seconds):
+        return {
+            f'{label}_handler_us_p50': round(percentile(timings, 50) * 1e6, 1),
+            f'{label}_handler_us_p99': round(percentile(timings, 99) * 1e6, 1),
+            f'{label}_msgs_per_second': round(len(timings) / seconds),
+        }
+
+    result = {'messages': per_producer * producers, 'producers': producers, 'frame_bytes': len(frame)}
+    try:
+        # Früherer Ansatz ohne Journal-Thread: jeder Handler schreibt und synchronisiert selbst
+        fd = os.open(os.path.join(directory, 'sync.log'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        lock = threading.Lock()
+
+        def write_sync(data):
+            record = RECORD.pack(len(data), zlib.crc32(data), time.time()) + data
+            with lock:
+                os.write(fd, record)
+                os.fdatasync(fd)
+        timings, seconds = run_producers(write_sync)
+        os.close(fd)
+        result.update(summary('fsync_per_message', timings, seconds))
+
+        journal = Journal(os.path.join(directory, 'journal'), segment_bytes)
+        start = time.perf_counter()
+        timings, _ = run_producers(journal.append)
+        journal.flush()
+        seconds = time.perf_counter() - start
+        result.update(summary('group_commit', timings, seconds))
+        result['group_commit_commits'] = journal.commits
+        result['group_commit_avg_group'] = round(len(journal) / journal.commits, 1)
+        result['segments'] = len([name for name in os.listdir(journal.directory) if name.endswith('.journal')])
+
+        # Verlauf für einen neuen Client: Offset-Index gegen Durchlauf aller Einträge
+        rounds = 200
+        start = time.perf_counter()
+        for _ in range(rounds):
+            tail = journal.tail(replay)
+        result['tail_index_us'] = round((time.perf_counter() - start) / rounds * 1e6, 1)
+        start = time.perf_counter()
+        scanned = collections.deque((bytes(data) for _, _, data in journal.scan()), maxlen=replay)
+        result['tail_scan_ms'] = round((time.perf_counter() - start) * 1e3, 2)
+        assert list(scanned) == tail
+        start = time.perf_counter()
+        count = sum(1 for _ in journal.scan())
+        result['scan_records_per_second'] = round(count / (time.perf_counter() - start))
+        journal.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks für den Chat-Server')
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    engines = sub.add_parser('engines', help='thread- und asyncio-Engine mit vielen inaktiven Clients vergleichen')
+    engines.add_argument('--clients', type=int, default=10000, help='Anzahl inaktiver Verbindungen (Standard: 10000)')
+    engines.add_argument('--messages', type=int, default=1000, help='Broadcasts für die Latenzmessung (Standard: 1000)')
+    engines.add_argument('--engine', action='append', choices=('thread', 'asyncio'),
+                         help='Nur diese Engine(s) messen (Standard: beide)')
+
+    slow = sub.add_parser('slow', help='Broadcast-Latenz mit einem Client, der nicht mehr liest')
+    slow.add_argument('--messages', type=int, default=2000, help='Broadcasts pro Messung (Standard: 2000)')
+    slow.add_argument('--payload', type=int, default=4096, help='Bytes pro Broadcast (Standard: 4096)')
+    slow.add_argument('--slow-client-timeout', type=float, default=1.0,
+                      help='An den Server durchgereichtes --slow-client-timeout (Standard: 1)')
+    slow.add_argument('--engine', action='append', choices=('thread', 'asyncio'),
+                      help='Nur diese Engine(s) messen (Standard: beide)')
+
+    large = sub.add_parser('large', help='Broadcasts um und über READ_CHUNK_SIZE (wachsender Lesepuffer)')
+    large.add_argument('--sizes', type=int, nargs='+', default=[4093, 4094, 16384, 65535],
+                       help='Bytes pro Broadcast (Standard: 4093 4094 16384 65535)')
+    large.add_argument('--messages', type=int, default=200, help='Broadcasts pro Größe (Standard: 200)')
+    large.add_argument('--engine', action='append', choices=('thread', 'asyncio'),
+                       help='Nur diese Engine(s) messen (Standard: beide)')
+
+    join = sub.add_parser('join', help='Join- und Leave-Durchsatz bei vielen registrierten Clients (ohne Sockets)')
+    join.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                      help='Anzahl bereits registrierter Clients (Standard: 1000 10000 50000)')
+    join.add_argument('--joins', type=int, default=200,
+                      help='Gemessene Registrierungen und Leaves pro Größe (Standard: 200)')
+
+    workers = sub.add_parser('workers', help='Durchsatz mit mehreren Worker-Prozessen (SO_REUSEPORT)')
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                         help='Zu vergleichende Worker-Anzahlen (Standard: 1 2 4)')
+    workers.add_argument('--loadgens', type=int, default=4, help='Parallele loadgen.py-Prozesse (Standard: 4)')
+    workers.add_argument('--clients', type=int, default=1000, help='Clients insgesamt (Standard: 1000)')
+    workers.add_argument('--rate', type=float, default=200.0, help='Broadcasts pro Sekunde insgesamt (Standard: 200)')
+    workers.add_argument('--duration', type=float, default=5.0, help='Dauer der Broadcast-Phase in s (Standard: 5)')
+    workers.add_argument('--engine', choices=('thread', 'asyncio'), default='asyncio',
+                         help='Engine der Worker (Standard: asyncio)')
+
+    storm = sub.add_parser('storm', help='Reconnect-Sturm mit und ohne Bündelung von Msg 4/5')
+    storm.add_argument('--clients', type=int, default=10000, help='Gleichzeitig registrierende Clients (Standard: 10000)')
+    storm.add_argument('--windows', type=float, nargs='+', default=[0.0, 0.005],
+                       help='Zu vergleichende --notify-window-Werte in s (Standard: 0 0.005)')
+    storm.add_argument('--engine', action='append', choices=('thread', 'asyncio'),
+                       help='Nur diese Engine(s) messen (Standard: asyncio)')
+
+    codec_parser = sub.add_parser('codec', help='Kodieren/Dekodieren in ns pro Nachricht')
+    codec_parser.add_argument('--messages', type=int, default=100000, help='Nachrichten pro Messung (Standard: 100000)')
+    codec_parser.add_argument('--payload', type=int, default=64, help='Bytes Text für Msg 6/9 (Standard: 64)')
+
+    resume = sub.add_parser('resume', help='Bytes beim Wiederkommen: Msg 2 gegen Fortsetzen mit Delta (ohne Sockets)')
+    resume.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='Anzahl registrierter Clients (Standard: 1000 10000 50000)')
+    resume.add_argument('--changes', type=int, default=10,
+                        help='Joins/Leaves während der Client weg ist (Standard: 10)')
+
+    compress = sub.add_parser('compress', help='Bytes und CPU-Zeit mit und ohne zlib (Msg 12/13, ohne Sockets)')
+    compress.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                          help='Anzahl registrierter Clients (Standard: 1000 10000 50000)')
+    compress.add_argument('--payload', type=int, default=1024, help='Bytes Text pro Broadcast (Standard: 1024)')
+    compress.add_argument('--broadcasts', type=int, default=20, help='Broadcasts pro Messung (Standard: 20)')
+
+    p2p_parser = sub.add_parser('p2p', help='Aufbauzeit von P2P-Chats (Msg 8 bis TCP-Verbindung)')
+    p2p_parser.add_argument('--sessions', type=int, default=200, help='Gemessene Sitzungen (Standard: 200)')
+    p2p_parser.add_argument('--lost', type=int, default=2,
+                            help='Zusätzliche Sitzungen mit verlorener erster Msg 8 (Standard: 2)')
+
+    churn = sub.add_parser('churn', help='Stumme und halb offene Verbindungen: Trennung per Frist, Threads und RSS')
+    churn.add_argument('--rounds', type=int, default=5, help='Runden (Standard: 5)')
+    churn.add_argument('--clients', type=int, default=200, help='Verbindungen pro Runde (Standard: 200)')
+    churn.add_argument('--idle-timeout', type=float, default=1.0,
+                       help='An den Server durchgereichtes --idle-timeout, 0 = aus (Standard: 1)')
+    churn.add_argument('--engine', action='append', choices=('thread', 'asyncio'),
+                       help='Nur diese Engine(s) messen (Standard: beide)')
+
+    roster_parser = sub.add_parser('roster', help='Msg 2 auf der Client-Seite einlesen: Zeit und Speicher pro Eintrag')
+    roster_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                               help='Anzahl Clients in Msg 2 (Standard: 1000 10000 100000)')
+    roster_parser.add_argument('--lookups', type=int, default=200,
+                               help='Gemessene Präfix-Suchen (Standard: 200)')
+
+    federation = sub.add_parser('federation', help='Broadcast-Latenz zwischen föderierten Server-Knoten (Loopback)')
+    federation.add_argument('--nodes', type=int, default=3, help='Anzahl Server-Prozesse (Standard: 3)')
+    federation.add_argument('--messages', type=int, default=1000, help='Broadcasts pro Messung (Standard: 1000)')
+    federation.add_argument('--joins', type=int, default=200,
+                            help='Gemessene Registrierungen über Knoten hinweg (Standard: 200)')
+    federation.add_argument('--engine', action='append', choices=('thread', 'asyncio'),
+                            help='Nur diese Engine(s) messen (Standard: beide)')
+
+    journal = sub.add_parser('journal', help='Broadcast-Journal: fsync pro Nachricht gegen Group Commit, mmap-Leser')
+    journal.add_argument('--messages', type=int, default=20000, help='Geschriebene Broadcasts (Standard: 20000)')
+    journal.add_argument('--payload', type=int, default=64, help='Bytes Text pro Broadcast (Standard: 64)')
+    journal.add_argument('--producers', type=int, default=8, help='Schreibende Threads (Standard: 8)')
+    journal.add_argument('--segment-size', type=int, default=1024 * 1024,
+                         help='Bytes pro Segment, klein, damit rotiert wird (Standard: 1 MiB)')
+    journal.add_argument('--replay', type=int, default=50, help='Länge des Verlaufs für tail() (Standard: 50)')
+
+    p2pfile = sub.add_parser('p2pfile', help='Dateiübertragung über P2P (Msg 17-19) gegen rohes TCP, mit Fortsetzen')
+    p2pfile.add_argument('--size-mb', type=int, default=1024, help='Dateigröße in MiB (Standard: 1024)')
+    p2pfile.add_argument('--resume-at', type=float, default=0.5,
+                         help='Anteil, nach dem abgebrochen und fortgesetzt wird (Standard: 0.5)')
+
+    channels = sub.add_parser('channels', help='Channel-Nachricht (Msg 16) gegen Broadcast bei N Clients (ohne Sockets)')
+    channels.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                          help='Registrierte Clients (Standard: 1000 10000 100000)')
+    channels.add_argument('--members', type=int, default=50, help='Mitglieder des Channels (Standard: 50)')
+    channels.add_argument('--messages', type=int, default=200, help='Nachrichten pro Messung (Standard: 200)')
+    channels.add_argument('--payload', type=int, default=64, help='Bytes Text pro Nachricht (Standard: 64)')
+
+    args = parser.parse_args()
+    limit = raise_fd_limit()
+
+    if args.scenario == 'engines':
+        if args.clients * 2 + 64 > limit:
+            print(f"Warnung: fd-Limit {limit} reicht evtl. nicht für {args.clients} Clients", file=sys.stderr)
+        for engine in args.engine or ('thread', 'asyncio'):
+            print(json.dumps(bench_engine(engine, args.clients, args.messages)))
+    elif args.scenario == 'slow':
+        for engine in args.engine or ('thread', 'asyncio'):
+            print(json.dumps(bench_slow(engine, args.messages, args.payload, args.slow_client_timeout)))
+    elif args.scenario == 'large':
+        for engine in args.engine or ('thread', 'asyncio'):
+            for row in bench_large(engine, args.sizes, args.messages):
+                print(json.dumps(row))
+    elif args.scenario == 'join':
+        for size in args.sizes:
+            print(json.dumps(bench_join(size, args.joins)))
+    elif args.scenario == 'storm':
+        for engine in args.engine or ('asyncio',):
+            for window in args.windows:
+                print(json.dumps(bench_storm(engine, args.clients, window)))
+    elif args.scenario == 'codec':
+        for row in bench_codec(args.messages, args.payload):
+            print(json.dumps(row))
+    elif args.scenario == 'workers':
+        for count in args.workers:
+            print(json.dumps(bench_workers(args.engine, count, args.loadgens, args.clients, args.rate, args.duration)))
+    elif args.scenario == 'resume':
+        for size in args.sizes:
+            print(json.dumps(bench_resume(size, args.changes)))
+    elif args.scenario == 'compress':
+        for size in args.sizes:
+            print(json.dumps(bench_compress(size, args.payload, args.broadcasts)))
+    elif args.scenario == 'p2p':
+        print(json.dumps(bench_p2p(args.sessions, args.lost)))
+    elif args.scenario == 'churn':
+        for engine in args.engine or ('thread', 'asyncio'):
+            print(json.dumps(bench_churn(engine, args.rounds, args.clients, args.idle_timeout)))
+    elif args.scenario == 'roster':
+        for size in args.sizes:
+            print(json.dumps(bench_roster(size, args.lookups)))
+    elif args.scenario == 'federation':
+        for engine in args.engine or ('thread', 'asyncio'):
+            print(json.dumps(bench_federation(engine, args.nodes, args.messages, args.joins)))
+    elif args.scenario == 'journal':
+        print(json.dumps(bench_journal(args.messages, args.payload, args.producers, args.segment_size, args.replay)))
+    elif args.scenario == 'p2pfile':
+        print(json.dumps(bench_p2p_file(args.size_mb, args.resume_at)))
+    elif args.scenario == 'channels':
+        for size in args.sizes:
+            print(json.dumps(bench_channels(size, args.members, args.messages, args.payload)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# channels.py
+# Channels (Msg 14-16): Nachrichten nur an die Mitglieder statt an alle Clients.
+#
+# Ein Broadcast (Msg 6) kostet pro Nachricht einen Send an jeden verbundenen Client.
+# Für Nachrichten, die nur eine kleine Gruppe betreffen, gibt es Channels: der
+# Index channel -> Mitglieder macht das Verteilen O(Mitglieder), unabhängig davon,
+# wie viele Clients insgesamt verbunden sind. Wie beim Registry-Snapshot iteriert
+# der Fan-out über ein unveränderliches Tupel pro Channel, das nur nach einem
+# Join/Leave neu gebaut wird.
+#
+# Mitglieder sind die ClientEntry-Objekte aus registry.py. Eine fortgesetzte
+# Sitzung (Msg 11, replace_conn) behält damit ihre Channels; nach einem
+# Disconnect (remove) ist der Client aus allen Channels raus.
+#
+# Im Mehrprozess-Betrieb und in der Föderation kennt jeder Prozess nur seine
+# lokalen Mitglieder; Msg-16-Frames gehen über den Bus an alle anderen, die sie
+# an ihre eigenen Mitglieder verteilen.
+
+import threading
+
+EC_ZU_VIELE_CHANNELS = 9
+EC_NICHT_IM_CHANNEL = 10
+
+MAX_CHANNELS_PER_CLIENT = 64
+
+
+class ChannelIndex:
+
+    def __init__(self):
+        self._members = {}  # channel (bytes, UTF-8) -> {ClientEntry: None}, in Beitrittsreihenfolge
+        self._snapshots = {}  # channel -> tuple der Mitglieder, fehlt nach einer Änderung
+        self._by_entry = {}  # ClientEntry -> set der Channels
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._members)
+
+    def channels_of(self, entry):
+        return self._by_entry.get(entry, ())
+
+    def is_member(self, entry, channel):
+        return channel in self._by_entry.get(entry, ())
+
+    def join(self, entry, channel):
+        # False, wenn entry schon in MAX_CHANNELS_PER_CLIENT Channels ist
+        with self._lock:
+            joined = self._by_entry.get(entry)
+            if joined is None:
+                joined = self._by_entry[entry] = set()
+            elif channel in joined:
+                return True
+            if len(joined) >= MAX_CHANNELS_PER_CLIENT:
+                return False
+            joined.add(channel)
+            members = self._members.get(channel)
+            if members is None:
+                members = self._members[channel] = {}
+            members[entry] = None
+            self._snapshots.pop(channel, None)
+        return True
+
+    def leave(self, entry, channel):
+        # False, wenn entry nicht in channel war
+        with self._lock:
+            joined = self._by_entry.get(entry)
+            if joined is None or channel not in joined:
+                return False
+            joined.discard(channel)
+            if not joined:
+                del self._by_entry[entry]
+            self._drop(entry, channel)
+        return True
+
+    def remove(self, entry):
+        # Client ist weg: aus allen Channels austragen
+        with self._lock:
+            for channel in self._by_entry.pop(entry, ()):
+                self._drop(entry, channel)
+
+    def _drop(self, entry, channel):
+        # Mit self._lock aufgerufen
+        members = self._members[channel]
+        del members[entry]
+        if not members:
+            del self._members[channel]  # leere Channels verschwinden
+        self._snapshots.pop(channel, None)
+
+    def members(self, channel):
+        # Unveränderliches Tupel der Mitglieder für den Fan-out, () für unbekannte Channels
+        snapshot = self._snapshots.get(channel)
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshots.get(channel)
+                if snapshot is None:
+                    members = self._members.get(channel)
+                    if members is None:
+                        return ()
+                    snapshot = self._snapshots[channel] = tuple(members)
+        return snapshot
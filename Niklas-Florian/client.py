@@ -1,164 +1,212 @@
 import socket
-import struct
 import threading
 import time
 import argparse
 
+from clientlist import ClientList
+from codec import (CAP_SESSION, CAP_ZLIB, DISCONNECT_FRAME, encode_broadcast, encode_capabilities, encode_channel_join,
+                   encode_channel_leave, encode_channel_message, encode_registration, encode_session_resume)
+from p2p import P2PSessionManager
+from protocol import FrameDecoder, ProtokollFehler
+
 # Globale Variablen
 running = True
-clients = {}  # Hier speichern wir die Client-Informationen als Dictionary
+clients = ClientList()  # Name -> (IP, UDP-Port), Msg 2 liest der FrameDecoder direkt hier ein
 
 SERVER_HOST = None
+SERVER_PORT = 7777
 UDP_PORT = None
 TCP_PORT = None
 IP = "0.0.0.0"
 current_P2P_partner_name = None
 
+# Sitzung beim Server: mit Token und Roster-Version wird nach einem Abbruch per
+# Msg 11 fortgesetzt, der Server schickt dann nur die verpassten Msg 4/5
+registration = None  # (ip, udp_port, nickname) der letzten Registrierung
+session_token = None
+roster_version = 0  # Stand aus Msg 10, +1 pro empfangener Msg 4/5
+RECONNECT_DELAYS = (0.5, 1, 2, 4, 8)  # Wartezeiten in s zwischen den Verbindungsversuchen
+CAPABILITIES = 0  # per Msg 12 vor der Registrierung angemeldet (--compression, --sessions); 0 = keine Msg 12
+channels = set()  # beigetretene Channels (Msg 14), werden nach jeder Msg 10 erneut angemeldet
 
-def recv_with_timeout(client_socket, expected_length, timeout):
-    data = b''  # Leerer Puffer für die empfangenen Daten
-    start_time = time.time()  # Zeitstempel für Timeout
 
-    while len(data) < expected_length:
-        remaining_time = timeout - (time.time() - start_time)
-        if remaining_time <= 0:
-            print("Timeout erreicht, bevor die erwarteten Daten empfangen wurden.")
-            return None
+def receive_messages_server():
+    while running:
+        decoder = FrameDecoder(roster=clients)
+        while running:
+            try:
+                # Ein recv für beliebig viele (auch angefangene) Nachrichten
+                if decoder.recv_from(tcp_socket_server) == 0:
+                    print("Verbindung zum Server geschlossen.")
+                    break
+
+                for msg_id_int, payload in decoder.messages():
+                    handle_server_message(msg_id_int, payload)
+
+            except (OSError, ProtokollFehler) as e:
+                if running:
+                    print(f"Fehler beim Empfangen von Nachrichten: {e}")
+                break
+            except Exception as e:
+                print(f"Fehler beim Empfangen von Nachrichten: {e}")
 
-        # Empfange Daten mit der verbleibenden Zeit
-        chunk = client_socket.recv(min(1024, expected_length - len(data)))
+        if not running or not reconnect_to_server():
+            break
 
-        if not chunk:  # Verbindung wurde geschlossen oder ein Fehler ist aufgetreten
-            print("Verbindung geschlossen oder Fehler beim Empfangen.")
-            return None
-        
-        data += chunk
-    return data
 
-def receive_messages_server():
-    global running
-    while running:
-        try:
-            msg_id = recv_with_timeout(tcp_socket_server, expected_length=1, timeout=2)
-            
-            if msg_id is None or len(msg_id) == 0:
-                print("Keine gültige Nachricht empfangen.")
-                continue
-
-            # Konvertiere msg_id korrekt zu einem Integer
-            msg_id_int = msg_id[0]
-            print(f"Empfangene msg_id: {msg_id_int}")
-
-            if msg_id_int == 2:
-                num_clients_data = recv_with_timeout(tcp_socket_server, expected_length=4, timeout=2)
-                if not num_clients_data:
-                    print("Fehler: Konnte die Anzahl der Clients nicht lesen.")
-                    continue
-                
-                num_clients = struct.unpack('!I', num_clients_data)[0]
-                print(f"Erfolgreich registriert. {num_clients} andere Clients online.")
-                
-                for _ in range(num_clients):
-                    ip_data = recv_with_timeout(tcp_socket_server, expected_length=4, timeout=2)
-                    if not ip_data:
-                        print("Fehler: Konnte Client-IP nicht lesen.")
-                        continue
-                    ip = socket.inet_ntoa(ip_data)
-                    
-                    udp_port_data = recv_with_timeout(tcp_socket_server, expected_length=2, timeout=2)
-                    if not udp_port_data:
-                        print("Fehler: Konnte UDP-Port nicht lesen.")
-                        continue
-                    udp_port = struct.unpack('!H', udp_port_data)[0]
-                    
-                    name_len_data = recv_with_timeout(tcp_socket_server, expected_length=1, timeout=2)
-                    if not name_len_data:
-                        print("Fehler: Konnte Namenslänge nicht lesen.")
-                        continue
-                    name_len = name_len_data[0]
-                    
-                    name_data = recv_with_timeout(tcp_socket_server, expected_length=name_len, timeout=2)
-                    if not name_data:
-                        print("Fehler: Konnte Client-Name nicht lesen.")
-                        continue
-                    name = name_data.decode('utf-8')
-                    
-                    clients[name] = {'ip': ip, 'udp_port': udp_port}
-                    print(f"Client hinzugefügt: {name}, IP: {ip}, UDP Port: {udp_port}")
-            
-            elif msg_id_int == 4:
-                ip = recv_with_timeout(tcp_socket_server, expected_length=4, timeout=2)
-                ip = socket.inet_ntoa(ip)  
-
-                udp_port = recv_with_timeout(tcp_socket_server, expected_length=2, timeout=2)
-                udp_port = struct.unpack('!H', udp_port)[0]  
-                
-                name_len = recv_with_timeout(tcp_socket_server, expected_length=1, timeout=2)
-                name_len = name_len[0] 
-                
-                name = recv_with_timeout(tcp_socket_server, expected_length=name_len, timeout=2)
-                name = name.decode('utf-8')  # Dekodiere Bytes zu String
-                
-                clients[name] = {'ip': ip, 'udp_port': udp_port}
-                print(f"Neuer Client: {name}, IP: {ip}, UDP Port: {udp_port}")
-            elif msg_id_int == 5:
-                name_len = recv_with_timeout(tcp_socket_server, expected_length=1, timeout=2)[0] 
-
-                name = recv_with_timeout(tcp_socket_server, expected_length=name_len, timeout=2).decode('utf-8')
-
-                if name in clients:
-                    del clients[name]
-                    print(f"Client {name} entfernt.")
-                else:
-                    print(f"Client {name} nicht in der Liste gefunden.")
-
-            elif msg_id_int == 6:
-                msg_len = recv_with_timeout(tcp_socket_server, expected_length=2, timeout=2)
-                if msg_len:
-                    msg_len = int.from_bytes(msg_len, 'big')  # Konvertiere 2 Bytes zu Integer
-                    message = recv_with_timeout(tcp_socket_server, expected_length=msg_len, timeout=2).decode('utf-8') 
-                    print(f"Broadcast erhalten: {message}")
-                    
-        except Exception as e:
-            print(f"Fehler beim Empfangen von Nachrichten: {e}")
+def handle_server_message(msg_id_int, payload):
+    global session_token, roster_version
+    print(f"Empfangene msg_id: {msg_id_int}")
+
+    if msg_id_int == 0:
+        print(f"Fehler vom Server - Code: {payload}")
+        if payload == 6:
+            # Sitzung nicht mehr bekannt (z.B. Server neu gestartet): neu registrieren
+            session_token = None
+            tcp_socket_server.sendall(encode_registration(*registration))
+
+    elif msg_id_int == 2:
+        # payload ist clients selbst, der Decoder hat die Liste schon ersetzt
+        print(f"Erfolgreich registriert. {len(payload)} andere Clients online.")
+        if not CAPABILITIES & CAP_SESSION:
+            rejoin_channels()  # ohne Sitzungen kommt keine Msg 10
+
+    elif msg_id_int == 4:
+        ip_data, udp_port, name_data = payload
+        ip = socket.inet_ntoa(ip_data)
+        name = name_data.decode('utf-8')  # Dekodiere Bytes zu String
+
+        clients.add(name, ip_data, udp_port)
+        roster_version += 1
+        print(f"Neuer Client: {name}, IP: {ip}, UDP Port: {udp_port}")
+
+    elif msg_id_int == 5:
+        name = payload.decode('utf-8')
+        roster_version += 1
+
+        if clients.remove(name):
+            print(f"Client {name} entfernt.")
+        else:
+            print(f"Client {name} nicht in der Liste gefunden.")
+
+    elif msg_id_int == 6:
+        message = payload.decode('utf-8')
+        print(f"Broadcast erhalten: {message}")
+
+    elif msg_id_int == 10:
+        session_token, roster_version = payload
+        rejoin_channels()
+
+    elif msg_id_int == 16:
+        channel, message = payload
+        print(f"[#{channel.decode('utf-8')}] {message.decode('utf-8')}")
+
+    elif msg_id_int == 12:
+        print("Kompression aktiv." if payload & CAP_ZLIB else "Server komprimiert nicht.")
+
+
+def rejoin_channels():
+    # Nach einer Neuregistrierung (oder einem Fortsetzen, bei dem der Server den
+    # Eintrag schon verworfen hatte) sind die Channels weg; Msg 14 ist idempotent
+    if channels:
+        tcp_socket_server.sendall(b''.join(encode_channel_join(channel.encode('utf-8'))
+                                           for channel in sorted(channels)))
+
 
 def register_with_server(nickname, server_host, server_port, udp_port):
+    global registration
     try:
         tcp_socket_server.connect((server_host, server_port))
         print(f"Verbunden mit Server {server_host}:{server_port}")
         
         ip = socket.inet_aton(socket.gethostbyname(socket.gethostname()))
-        msg = struct.pack('!B4sH B', 1, ip, udp_port, len(nickname)) + nickname.encode('utf-8')
-        tcp_socket_server.send(msg)
+        registration = (ip, udp_port, nickname)
+        frames = encode_registration(ip, udp_port, nickname)
+        if CAPABILITIES:
+            # Msg 12 vor Msg 1 im selben sendall, damit schon Msg 2 komprimiert kommen kann
+            frames = encode_capabilities(CAPABILITIES) + frames
+        tcp_socket_server.sendall(frames)
         
     except Exception as e:
         print(f"Fehler bei der Registrierung: {e}")
         tcp_socket_server.close()
 
 
+def reconnect_to_server():
+    # Nach einem Verbindungsabbruch: neu verbinden und mit dem Token fortsetzen
+    # (Msg 11); ohne Token bzw. bei EC 6 wird normal registriert (Msg 1)
+    global tcp_socket_server
+    for delay in RECONNECT_DELAYS:
+        time.sleep(delay)
+        if not running:
+            return False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((SERVER_HOST, SERVER_PORT))
+            if CAPABILITIES:
+                sock.sendall(encode_capabilities(CAPABILITIES))
+            if session_token is not None:
+                sock.sendall(encode_session_resume(session_token, roster_version))
+            else:
+                sock.sendall(encode_registration(*registration))
+        except OSError as e:
+            print(f"Neuverbindung fehlgeschlagen: {e}")
+            sock.close()
+            continue
+        tcp_socket_server = sock
+        print(f"Wieder mit Server {SERVER_HOST}:{SERVER_PORT} verbunden.")
+        return True
+    print("Server nicht erreichbar.")
+    return False
+
+
 # Client-Liste anzeigen
 def get_client_list():
     print("\nAktuelle Clients:")
-    for name, info in clients.items():
-        print(f"Name: {name}, IP: {info['ip']}, UDP Port: {info['udp_port']}")
+    for name, ip, udp_port in clients:
+        print(f"Name: {name}, IP: {ip}, UDP Port: {udp_port}")
 
 
 # Broadcast senden
 def send_broadcast(message):
     try:
-        message = message.encode('utf-8')
-        msg = struct.pack('!B H', 6, len(message)) + message
-        tcp_socket_server.send(msg)
+        tcp_socket_server.sendall(encode_broadcast(message.encode('utf-8')))
         print("Broadcast gesendet.")
     except Exception as e:
         print(f"Fehler beim Broadcast: {e}")
 
+# Channels (Msg 14-16)
+def join_channel(channel):
+    try:
+        tcp_socket_server.sendall(encode_channel_join(channel.encode('utf-8')))
+        channels.add(channel)
+        print(f"Channel {channel} beigetreten.")
+    except Exception as e:
+        print(f"Fehler beim Beitreten: {e}")
+
+
+def leave_channel(channel):
+    try:
+        tcp_socket_server.sendall(encode_channel_leave(channel.encode('utf-8')))
+        channels.discard(channel)
+        print(f"Channel {channel} verlassen.")
+    except Exception as e:
+        print(f"Fehler beim Verlassen: {e}")
+
+
+def send_channel_message(channel, message):
+    try:
+        tcp_socket_server.sendall(encode_channel_message(channel.encode('utf-8'), message.encode('utf-8')))
+    except Exception as e:
+        print(f"Fehler beim Senden in den Channel: {e}")
+
+
 # Disconnect vom Server
 def disconnect_from_server():
     global running
     running = False
     try:
-        tcp_socket_server.send(struct.pack('!B', 7))
+        tcp_socket_server.sendall(DISCONNECT_FRAME)
         tcp_socket_server.close()
         print("Vom Server abgemeldet.")
     except Exception as e:
@@ -167,95 +215,41 @@ def disconnect_from_server():
 
 # P2P -----------------------------------
 
-p2p_tcp_socket = None  # Wirst später initialisiert
-
-# Für den Server
-def start_tcp_server_for_p2p():
-    global p2p_tcp_socket
-    p2p_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    p2p_tcp_socket.bind((IP, TCP_PORT))
-    p2p_tcp_socket.listen(1)
-    print(f"P2P-TCP-Server läuft auf Port {TCP_PORT}. Warten auf eingehende Verbindungen...")
+p2p = None  # P2PSessionManager, wird nach der Registrierung gestartet
 
-    conn, addr = p2p_tcp_socket.accept()
-    print(f"Verbindung zu {addr} hergestellt.")
 
-    p2p_tcp_socket = conn
-    # Nachrichten empfangen und senden
-    handle_p2p_messages(conn)
-
-
-# Für den Client
 def start_P2P_chat(target_name):
-    global p2p_tcp_socket
     global current_P2P_partner_name
     if target_name not in clients:
-        print(f"Kein Client mit dem Namen {target_name} gefunden.")
-        return
-
-    target_info = clients[target_name]
-    target_ip = target_info['ip']
-    target_udp_port = target_info['udp_port']
-
-    # TCP-Server für den Initiator starten
-    p2p_tcp_server_thread = threading.Thread(target=start_tcp_server_for_p2p)
-    p2p_tcp_server_thread.start()
-
-    # UDP-Nachricht an den Ziel-Peer senden
-    udp_socket.sendto(struct.pack('!B H', 8, TCP_PORT) + target_name.encode('utf-8'),
-                      (target_ip, target_udp_port))
-
-    # Warten, bis der Peer die TCP-Verbindung akzeptiert
-    time.sleep(2)  # Warte auf eine Verbindung, kann angepasst werden
+        # Eindeutiger Anfang eines Namens reicht
+        matches = clients.with_prefix(target_name, 10)
+        if not target_name or not matches:
+            print(f"Kein Client mit dem Namen {target_name} gefunden.")
+            return
+        if len(matches) > 1:
+            print(f"Mehrere Clients beginnen mit {target_name}: {', '.join(matches)}")
+            return
+        target_name = matches[0]
+
+    ip, udp_port = clients.get(target_name)
+
+    # Msg 8 an den Ziel-Peer; er verbindet sich dann mit unserem P2P-Listener.
+    # Nicht blockierend: "verbunden nach ... ms" kommt, sobald die Verbindung steht,
+    # ohne Antwort wird die Anfrage automatisch wiederholt
+    p2p.request(target_name, ip, udp_port)
 
     current_P2P_partner_name = target_name
-    print(f"P2P-Chat mit {target_name} gestartet.")
+    print(f"P2P-Chat mit {target_name} angefragt.")
 
 
+def send_P2P_message(target_name, message):
+    p2p.send(target_name, message)
 
-def handle_p2p_messages(p2p_connection):
-    global running
-    try:
-        while running:
-            msg_len_data = recv_with_timeout(p2p_connection, expected_length=2, timeout=2)
-            if msg_len_data is None:
-                break
-            
-            msg_len = struct.unpack('!H', msg_len_data)[0]
-            message = recv_with_timeout(p2p_connection, expected_length=msg_len, timeout=2)
-            if message is None:
-                break
-
-            print(f"Nachricht vom P2P-Partner: {message.decode('utf-8')}")
-    except Exception as e:
-        print(f"Fehler beim Nachrichtenempfang im P2P-Chat: {e}")
-    finally:
-        p2p_connection.close()
-        print("P2P-Verbindung geschlossen.")
-
-
-def receive_udp_p2p_request():
-    while running:
-        data, addr = udp_socket.recvfrom(1024)
-        if data:
-            msg_id = data[0]
-            if msg_id == 8:
-                target_tcp_port = struct.unpack('!H', data[1:3])[0]
-                target_name = data[3:].decode('utf-8')
 
-                print(f"P2P-Anfrage von {target_name} erhalten. TCP-Port: {target_tcp_port}")
-
-                # TCP-Verbindung zum Initiator herstellen
-                global p2p_tcp_socket
-                p2p_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                p2p_tcp_socket.connect((addr[0], target_tcp_port))
-
-                global current_P2P_partner_name
-                current_P2P_partner_name = target_name
-                print(f"P2P-Verbindung zu {target_name} hergestellt. {p2p_tcp_socket}")
-
-                # Verbindung starten
-                handle_p2p_messages(p2p_tcp_socket)
+def send_P2P_file(target_name, path):
+    # Fortschritt und Ende meldet der P2PSessionManager; eine abgebrochene Übertragung
+    # derselben Datei setzt der Empfänger beim nächsten Senden fort
+    p2p.send_file(target_name, path)
 
 
 # P2P -----------------------------------
@@ -269,10 +263,21 @@ def main():
     parser.add_argument('--host', type=str, default='127.0.0.1', help='Server-IP-Adresse (Standard: 127.0.0.1)')
     parser.add_argument('--tcp-port', type=int, default=7777, help='Server-TCP-Port (Standard: 7777)')
     parser.add_argument('--udp-port', type=int, default=8888, help='Lokaler UDP-Port (Standard: 8888)')
+    parser.add_argument('--compression', action='store_true',
+                        help='zlib-Kompression beim Server anmelden (Msg 12); nur mit Servern, die Msg 12 kennen')
+    parser.add_argument('--sessions', action='store_true',
+                        help='Sitzungs-Token beim Server anmelden (Msg 12), nach einem Abbruch per Msg 11 fortsetzen; '
+                             'nur mit Servern, die Msg 12 kennen')
+    parser.add_argument('--download-dir', type=str, default='downloads',
+                        help='Verzeichnis für per P2P empfangene Dateien (Standard: downloads)')
     args = parser.parse_args()
 
-    global SERVER_HOST, UDP_PORT, TCP_PORT
+    global SERVER_HOST, UDP_PORT, TCP_PORT, CAPABILITIES, p2p, current_P2P_partner_name
     SERVER_HOST = args.host
+    if args.compression:
+        CAPABILITIES |= CAP_ZLIB
+    if args.sessions:
+        CAPABILITIES |= CAP_SESSION
     UDP_PORT = args.udp_port
     TCP_PORT = args.tcp_port
 
@@ -280,23 +285,28 @@ def main():
     udp_socket.bind((IP, UDP_PORT))
 
     nickname = input("Gib deinen Nickname ein: ")
-    register_with_server(nickname, SERVER_HOST, 7777, UDP_PORT)
+    register_with_server(nickname, SERVER_HOST, SERVER_PORT, UDP_PORT)
 
     receiver_thread = threading.Thread(target=receive_messages_server)
     receiver_thread.start()
 
-    # Empfange P2P-Anfragen über UDP
-    p2p_thread = threading.Thread(target=receive_udp_p2p_request)
-    p2p_thread.start()
+    # Ein Thread für alle P2P-Chats: Msg 8 über UDP, Listener auf TCP_PORT, alle Peers
+    p2p = P2PSessionManager(nickname, udp_socket, TCP_PORT, IP, download_dir=args.download_dir)
+    p2p.start()
+    print(f"P2P-TCP-Server läuft auf Port {TCP_PORT}.")
 
     try:
         while running:
             print("\n1: Broadcast senden")
             print("2: Peer-to-Peer Chat starten")
             print("3: Client-Liste anzeigen")
-            print("5: Aktuellen P2P-Partner anzeigen")
+            print("4: Channel beitreten")
+            print("5: P2P-Chats anzeigen")
             print("6: Nachricht über P2P senden")
             print("7: Disconnect")
+            print("8: Channel verlassen")
+            print("9: Nachricht in Channel senden")
+            print("0: Datei über P2P senden")
             choice = input("Wähle eine Option: ")
 
             if choice == '1':
@@ -306,27 +316,57 @@ def main():
                 target_name = input("Name des Ziel-Clients: ")
                 start_P2P_chat(target_name)
             elif choice == '6':
-                if current_P2P_partner_name:
+                partners = p2p.connected()
+                if partners:
+                    default = current_P2P_partner_name if current_P2P_partner_name in partners else partners[0]
+                    target_name = input(f"Peer ({', '.join(partners)}) [{default}]: ") or default
                     message = input("Nachricht an Peer: ")
-                    msg_data = struct.pack('!H', len(message)) + message.encode('utf-8')
-                    # Hier verwende das globale p2p_tcp_socket
-                    print(f"socket {p2p_tcp_socket}")
-                    p2p_tcp_socket.send(msg_data)
+                    send_P2P_message(target_name, message)
+                    current_P2P_partner_name = target_name
                     print(f"Nachricht an Peer gesendet.")
                 else:
                     print("Kein aktiver P2P-Partner. Verbindungsaufbau erforderlich.")
+            elif choice == '0':
+                partners = p2p.connected()
+                if partners:
+                    default = current_P2P_partner_name if current_P2P_partner_name in partners else partners[0]
+                    target_name = input(f"Peer ({', '.join(partners)}) [{default}]: ") or default
+                    send_P2P_file(target_name, input("Pfad der Datei: "))
+                else:
+                    print("Kein aktiver P2P-Partner. Verbindungsaufbau erforderlich.")
             elif choice == '3':
                 get_client_list()
             elif choice == '5':
-                if current_P2P_partner_name:
-                    print(f"Aktueller P2P-Partner: {current_P2P_partner_name}")
+                partners = p2p.connected()
+                if partners:
+                    print(f"Verbundene P2P-Partner: {', '.join(partners)}")
+                    if current_P2P_partner_name:
+                        print(f"Aktueller P2P-Partner: {current_P2P_partner_name}")
                 else:
                     print("Kein P2P-Partner verbunden.")
+                for name, transfer in p2p.transfers():
+                    direction = "von" if transfer.receiving else "an"
+                    print(f"Datei {transfer.filename} {direction} {name}: {transfer.offset} von {transfer.size} Bytes")
+            elif choice == '4':
+                join_channel(input("Channel: "))
+            elif choice == '8':
+                if channels:
+                    leave_channel(input(f"Channel ({', '.join(sorted(channels))}): "))
+                else:
+                    print("In keinem Channel.")
+            elif choice == '9':
+                if channels:
+                    channel = input(f"Channel ({', '.join(sorted(channels))}): ")
+                    send_channel_message(channel, input("Nachricht: "))
+                else:
+                    print("In keinem Channel. Erst mit 4 beitreten.")
             elif choice == '7':
                 disconnect_from_server()
+                p2p.stop()
                 break
     except KeyboardInterrupt:
         disconnect_from_server()
+        p2p.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,134 @@
+# clientlist.py
+# Client-Liste auf der Client-Seite (Msg 2/4/5), kompakt auch bei sehr großen Rostern.
+#
+# Statt eines dicts pro Eintrag liegen IP und UDP-Port in gepackten Arrays (4 + 2
+# Byte), die Namen in einer Liste und ein Index name -> Position daneben. Leaves
+# tauschen den letzten Eintrag in die Lücke, es bleiben keine Löcher.
+#
+# Msg 2 liest der FrameDecoder (roster=...) über ingest() direkt aus dem Lesepuffer
+# ein, ohne Zwischenliste aus Tupeln. Für die Auswahl des P2P-Partners gibt es eine
+# Präfix-Suche über die sortierten Namen; sortiert wird erst bei der ersten Suche
+# nach einer Msg 2, danach werden Joins/Leaves einsortiert.
+
+import array
+import bisect
+import socket
+import struct
+
+from protocol import ProtokollFehler
+
+_ENTRY = struct.Struct('!IHB')  # wie codec.CLIENT_INFO, die IP aber direkt als Zahl
+
+
+def _ip_str(ip):
+    return socket.inet_ntoa(ip.to_bytes(4, 'big'))
+
+
+class ClientList:
+
+    def __init__(self):
+        self._names = []
+        self._ips = array.array('I')
+        self._ports = array.array('H')
+        self._index = {}  # name -> Position in den drei Spalten
+        self._sorted = None  # sortierte Namen für with_prefix(), None = neu sortieren
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        # (name, ip, udp_port) in Einfügereihenfolge (bis zum ersten Leave)
+        for name, ip, udp_port in zip(self._names, self._ips, self._ports):
+            yield name, _ip_str(ip), udp_port
+
+    def get(self, name):
+        # (ip, udp_port) oder None
+        i = self._index.get(name)
+        if i is None:
+            return None
+        return _ip_str(self._ips[i]), self._ports[i]
+
+    def clear(self):
+        self._names.clear()
+        del self._ips[:]
+        del self._ports[:]
+        self._index.clear()
+        self._sorted = None
+
+    def add(self, name, ip, udp_port):
+        # ip als 4 Byte (inet_aton); ein bekannter Name bekommt die neue Adresse
+        ip = int.from_bytes(ip, 'big')
+        i = self._index.get(name)
+        if i is not None:
+            self._ips[i] = ip
+            self._ports[i] = udp_port
+            return
+        self._index[name] = len(self._names)
+        self._names.append(name)
+        self._ips.append(ip)
+        self._ports.append(udp_port)
+        if self._sorted is not None:
+            bisect.insort(self._sorted, name)
+
+    def remove(self, name):
+        i = self._index.pop(name, None)
+        if i is None:
+            return False
+        last = len(self._names) - 1
+        if i != last:
+            moved = self._names[last]
+            self._names[i] = moved
+            self._ips[i] = self._ips[last]
+            self._ports[i] = self._ports[last]
+            self._index[moved] = i
+        self._names.pop()
+        self._ips.pop()
+        self._ports.pop()
+        if self._sorted is not None:
+            del self._sorted[bisect.bisect_left(self._sorted, name)]
+        return True
+
+    def ingest(self, buf, start, end, limit):
+        # Liest bis zu limit ClientInfo-Einträge aus buf[start:end] (Msg 2); ein
+        # angefangener Eintrag bleibt stehen. Gibt (neues start, Anzahl) zurück.
+        unpack = _ENTRY.unpack_from
+        header = _ENTRY.size
+        names, ips, ports, index = self._names, self._ips, self._ports, self._index
+        count = 0
+        while count < limit and end - start >= header:
+            ip, udp_port, name_len = unpack(buf, start)
+            stop = start + header + name_len
+            if stop > end:
+                break
+            try:
+                name = str(buf[start + header:stop], 'utf-8')
+            except UnicodeDecodeError:
+                raise ProtokollFehler(4, "Name in Msg 2 ist kein UTF-8")
+            i = index.get(name)
+            if i is None:
+                index[name] = len(names)
+                names.append(name)
+                ips.append(ip)
+                ports.append(udp_port)
+            else:
+                ips[i] = ip
+                ports[i] = udp_port
+            start = stop
+            count += 1
+        self._sorted = None
+        return start, count
+
+    def with_prefix(self, prefix, limit=None):
+        # Namen, die mit prefix beginnen, alphabetisch; O(log n) bis zum ersten Treffer
+        if self._sorted is None:
+            self._sorted = sorted(self._names)
+        names = self._sorted
+        matches = []
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix) or len(matches) == limit:
+                break
+            matches.append(names[i])
+        return matches
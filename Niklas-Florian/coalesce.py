@@ -0,0 +1,67 @@
+# coalesce.py
+# Gebündelte Join-/Leave-Benachrichtigungen (Msg 4 und 5) des Servers.
+#
+# Ohne Bündelung erzeugt jeder Join einen kleinen Msg-4-Frame pro anderem Client,
+# beim Reconnect-Sturm nach einem Neustart also N² einzelne Sends. Stattdessen
+# werden alle Msg 4/5 eines kurzen Zeitfensters hintereinander in einen Puffer
+# geschrieben und danach mit einem einzigen send() pro Empfänger verteilt.
+#
+# Ein Client, der sich innerhalb des Fensters registriert hat, kennt alle früheren
+# Joins schon aus seinem Msg 2; er bekommt nur den Teil des Puffers ab seiner
+# eigenen Registrierung (ein memoryview-Ausschnitt, keine Kopie). Vor jedem
+# Broadcast wird geflusht, damit die Reihenfolge pro Client erhalten bleibt.
+
+import threading
+
+
+def _thread_timer(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+
+class NotificationCoalescer:
+
+    def __init__(self, window, deliver):
+        # deliver(pending, joined, counts) verteilt einen fertigen Puffer (server.py)
+        self.window = window
+        self.deliver = deliver
+        self.schedule = _thread_timer  # asyncio-Engine: loop.call_later
+        self.lock = threading.RLock()  # auch für Registrierung + Msg 2 + Msg 4 am Stück
+        self._flush_lock = threading.RLock()  # hält die Reihenfolge zweier Flushes ein
+        self._pending = bytearray()
+        self._joined = {}  # conn -> Offset im Puffer, ab dem der Client Msg 4/5 braucht
+        self._counts = []  # (offset, msg_id) pro Frame, für die Metriken
+        self._scheduled = False
+
+    def add(self, msg_id, frame, joined_conn=None):
+        # joined_conn: neuer Client, der diesen und alle früheren Frames nicht bekommt
+        with self.lock:
+            self._counts.append((len(self._pending), msg_id))
+            self._pending += frame
+            if joined_conn is not None:
+                self._joined[joined_conn] = len(self._pending)
+            if not self._scheduled:
+                self._scheduled = True
+                self.schedule(self.window, self.flush)
+
+    def mark_joined(self, conn):
+        # conn kennt den Stand bis hierher schon (fortgesetzte Sitzung, Msg 11)
+        with self.lock:
+            if self._pending:
+                self._joined[conn] = len(self._pending)
+
+    def flush(self):
+        with self._flush_lock:
+            with self.lock:
+                self._scheduled = False
+                if not self._pending:
+                    return
+                pending = bytes(self._pending)
+                joined = self._joined
+                counts = self._counts
+                self._pending = bytearray()
+                self._joined = {}
+                self._counts = []
+            # Senden ohne self.lock: ein dabei getrennter Client erzeugt selbst wieder Msg 5
+            self.deliver(pending, joined, counts)
@@ -0,0 +1,145 @@
+# codec.py
+# Vorkompilierte Structs für alle Nachrichten aus der README.
+#
+# struct.pack('!4sH B', ...) schlägt das Format bei jedem Aufruf erneut im Cache des
+# struct-Moduls nach; die Structs hier werden einmal beim Import gebaut und von
+# Server, Client und FrameDecoder (protocol.py) gemeinsam benutzt.
+#
+# Kodiert wird mit encode_*(): fertiger Frame als bytes (Header packen + Nutzdaten
+# anhängen). Das ist in CPython der schnellste Weg; pack_into in einen
+# wiederverwendeten Puffer war wegen Aufruf- und Slice-Overhead etwa 3x langsamer
+# (benchmark.py codec), und Frames in Sende-Queues müssen ohnehin unveränderlich sein.
+#
+# Msg 13 ist ein Container: ein oder mehrere ganze Frames, zlib-komprimiert. Der
+# Server benutzt ihn nur für Clients, die per Msg 12 CAP_ZLIB angemeldet haben.
+
+import struct
+import zlib
+
+ERROR = struct.Struct('!BB')  # Msg 0: msg_id, error_code
+CLIENT_INFO = struct.Struct('!4sH B')  # ip, udp_port, name_len (+ name)
+REGISTRATION = struct.Struct('!B4sH B')  # Msg 1: msg_id + ClientInfo
+ROSTER_HEADER = struct.Struct('!B I')  # Msg 2: msg_id, Anzahl (+ ClientInfo * Anzahl)
+NEW_CLIENT = struct.Struct('!B4sH B')  # Msg 4: msg_id + ClientInfo
+CLIENT_LEFT = struct.Struct('!B B')  # Msg 5: msg_id, name_len (+ name)
+BROADCAST = struct.Struct('!B H')  # Msg 6: msg_id, msg_len (+ msg)
+DISCONNECT = struct.Struct('!B')  # Msg 7: msg_id
+P2P_REQUEST = struct.Struct('!B H B')  # Msg 8: msg_id, tcp_port, name_len (+ name)
+P2P_MESSAGE = struct.Struct('!B H')  # Msg 9: msg_id, msg_len (+ msg)
+SESSION = struct.Struct('!B 16s I')  # Msg 10/11: msg_id, token, roster_version
+CAPABILITIES = struct.Struct('!B B')  # Msg 12: msg_id, flags
+COMPRESSED = struct.Struct('!B I')  # Msg 13: msg_id, data_len (+ zlib-Daten ganzer Frames)
+CHANNEL = struct.Struct('!B B')  # Msg 14/15: msg_id, channel_len (+ channel)
+CHANNEL_MESSAGE = struct.Struct('!B B H')  # Msg 16: msg_id, channel_len, msg_len (+ channel + msg)
+FILE_OFFER = struct.Struct('!B I Q Q B')  # Msg 17: msg_id, transfer_id, size, version, name_len (+ name)
+FILE_ACCEPT = struct.Struct('!B I Q')  # Msg 18: msg_id, transfer_id, offset
+FILE_CHUNK = struct.Struct('!B I Q I')  # Msg 19: msg_id, transfer_id, offset, data_len (+ Dateidaten)
+FILE_REJECT = struct.Struct('!B I')  # Msg 20: msg_id, transfer_id
+
+CAP_ZLIB = 0x01  # Client kann Msg 13 entpacken
+CAP_SESSION = 0x02  # Client will nach der Registrierung ein Sitzungs-Token (Msg 10)
+
+TOKEN_SIZE = 16
+
+DISCONNECT_FRAME = DISCONNECT.pack(7)  # Msg 7 hat keine Nutzdaten
+_ERROR_FRAMES = tuple(ERROR.pack(0, code) for code in range(256))
+
+
+def encode_error(error_code):  # Msg 0
+    return _ERROR_FRAMES[error_code]
+
+
+def encode_client_info(ip, udp_port, name):
+    # ClientInfo ohne Msg-ID (Einträge von Msg 2); ip als 4 Byte (inet_aton)
+    name_encoded = name.encode('utf-8')
+    return CLIENT_INFO.pack(ip, udp_port, len(name_encoded)) + name_encoded
+
+
+def encode_registration(ip, udp_port, name):  # Msg 1
+    name_encoded = name.encode('utf-8')
+    return REGISTRATION.pack(1, ip, udp_port, len(name_encoded)) + name_encoded
+
+
+def encode_new_client(ip, udp_port, name):  # Msg 4
+    name_encoded = name.encode('utf-8')
+    return NEW_CLIENT.pack(4, ip, udp_port, len(name_encoded)) + name_encoded
+
+
+def encode_client_left(name):  # Msg 5
+    name_encoded = name.encode('utf-8')
+    return CLIENT_LEFT.pack(5, len(name_encoded)) + name_encoded
+
+
+def encode_broadcast(message):  # Msg 6; message als bytes oder memoryview
+    return BROADCAST.pack(6, len(message)) + message
+
+
+def encode_p2p_request(tcp_port, name):  # Msg 8
+    name_encoded = name.encode('utf-8')
+    return P2P_REQUEST.pack(8, tcp_port, len(name_encoded)) + name_encoded
+
+
+def encode_p2p_message(message):  # Msg 9; message als bytes
+    return P2P_MESSAGE.pack(9, len(message)) + message
+
+
+def encode_session_token(token, version):  # Msg 10
+    return SESSION.pack(10, token, version)
+
+
+def encode_session_resume(token, version):  # Msg 11
+    return SESSION.pack(11, token, version)
+
+
+def encode_capabilities(flags):  # Msg 12
+    return CAPABILITIES.pack(12, flags)
+
+
+def encode_channel_join(channel):  # Msg 14; channel als bytes (UTF-8)
+    return CHANNEL.pack(14, len(channel)) + channel
+
+
+def encode_channel_leave(channel):  # Msg 15
+    return CHANNEL.pack(15, len(channel)) + channel
+
+
+def encode_channel_message(channel, message):  # Msg 16; beides als bytes oder memoryview
+    return CHANNEL_MESSAGE.pack(16, len(channel), len(message)) + channel + message
+
+
+def encode_file_offer(transfer_id, size, version, name):  # Msg 17
+    name_encoded = name.encode('utf-8')
+    return FILE_OFFER.pack(17, transfer_id, size, version, len(name_encoded)) + name_encoded
+
+
+def encode_file_accept(transfer_id, offset):  # Msg 18
+    return FILE_ACCEPT.pack(18, transfer_id, offset)
+
+
+def encode_file_chunk(transfer_id, offset, data_len):
+    # Nur der Header von Msg 19; die data_len Bytes Dateidaten folgen direkt (sendfile)
+    return FILE_CHUNK.pack(19, transfer_id, offset, data_len)
+
+
+def encode_file_reject(transfer_id):  # Msg 20
+    return FILE_REJECT.pack(20, transfer_id)
+
+
+def encode_compressed(frames, level=1):
+    # Msg 13 mit frames (ganze Frames hintereinander); None, wenn es nicht kleiner wird
+    data = zlib.compress(frames, level)
+    if COMPRESSED.size + len(data) >= len(frames):
+        return None
+    return COMPRESSED.pack(13, len(data)) + data
+
+
+def decode_p2p_request(datagram):
+    # Msg 8 aus einem UDP-Datagramm: (tcp_port, name als memoryview) oder None
+    view = memoryview(datagram)
+    if len(view) < P2P_REQUEST.size:
+        return None
+    msg_id, tcp_port, name_len = P2P_REQUEST.unpack_from(view)
+    if msg_id != 8 or len(view) - P2P_REQUEST.size < name_len:
+        return None
+    return tcp_port, view[P2P_REQUEST.size:P2P_REQUEST.size + name_len]
+
@@ -0,0 +1,130 @@
+# deadlines.py
+# Zentrale Fristen für alle Client-Verbindungen des Servers.
+#
+# Blockierende Sockets merken nicht, wenn ein Client mitten in einer Nachricht
+# verstummt; ohne Frist bleibt sein Thread (bzw. sein Eintrag) für immer hängen.
+# Jede Verbindung hat deshalb höchstens eine Frist, die nach jedem Read neu gesetzt
+# wird (server.setze_frist). Alle Fristen liegen in einem Heap und werden von einem
+# einzigen Thread bzw. einem einzigen Timer auf der asyncio-Loop abgearbeitet.
+#
+# Das häufigste Update, eine Frist nach hinten schieben (Idle-Timeout nach jedem
+# Read), ändert nur den Eintrag im dict; der alte Heap-Eintrag wird beim Ablaufen
+# auf die neue Zeit umgehängt. Der Heap wächst also nicht mit jedem Read, überholte
+# Einträge werden spätestens beim Kompaktieren entfernt.
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class DeadlineScheduler:
+
+    def __init__(self):
+        self._heap = []  # (zeitpunkt, seq, key), kann überholte Einträge enthalten
+        self._deadlines = {}  # key -> [zeitpunkt, seq, callback]
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._woken = False
+        self._loop = None
+        self._timer = None  # asyncio.TimerHandle für die früheste Frist
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def set(self, key, delay, callback, keep=False):
+        # callback(key) in delay Sekunden; ersetzt eine bestehende Frist von key.
+        # keep=True lässt eine laufende Frist mit demselben callback unverändert.
+        when = time.monotonic() + delay
+        with self._cond:
+            current = self._deadlines.get(key)
+            if current is not None and current[2] is callback:
+                if keep:
+                    return
+                if when >= current[0]:
+                    current[0] = when  # nur nach hinten: Heap-Eintrag bleibt, wird beim Ablaufen umgehängt
+                    return
+            seq = next(self._seq)
+            self._deadlines[key] = [when, seq, callback]
+            heapq.heappush(self._heap, (when, seq, key))
+            if len(self._heap) > 2 * len(self._deadlines) + 1024:
+                self._compact()
+            if self._heap[0][1] == seq:
+                self._wake(delay)  # neue früheste Frist
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def run_due(self):
+        # Ruft die Callbacks aller abgelaufenen Fristen auf
+        due = []
+        with self._cond:
+            now = time.monotonic()
+            heap = self._heap
+            while heap:
+                when, seq, key = heap[0]
+                current = self._deadlines.get(key)
+                if current is None or current[1] != seq:
+                    heapq.heappop(heap)  # aufgehoben oder ersetzt
+                elif when > now:
+                    break
+                elif current[0] > now:
+                    heapq.heapreplace(heap, (current[0], seq, key))  # inzwischen nach hinten geschoben
+                else:
+                    heapq.heappop(heap)
+                    del self._deadlines[key]
+                    due.append((key, current[2]))
+        for key, callback in due:
+            try:
+                callback(key)
+            except Exception as e:
+                print(f"Fehler beim Ablauf einer Frist: {e}")
+
+    def next_delay(self):
+        # Sekunden bis zur frühesten Frist (evtl. überholt, dann nur zu früh), None = keine
+        with self._cond:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def _compact(self):
+        self._heap = [(current[0], current[1], key) for key, current in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    # Anbindung an die Engines
+
+    def start_thread(self):
+        # thread-Engine: ein Thread für alle Fristen
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def attach_loop(self, loop):
+        # asyncio-Engine: Callbacks laufen auf der Loop, set()/cancel() nur von dort
+        self._loop = loop
+
+    def _wake(self, delay):
+        # Mit self._cond aufgerufen
+        if self._loop is None:
+            self._woken = True
+            self._cond.notify()
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_later(delay, self._on_timer)
+
+    def _run(self):
+        while True:
+            self.run_due()
+            delay = self.next_delay()
+            with self._cond:
+                if not self._woken:
+                    self._cond.wait(delay)
+                self._woken = False
+
+    def _on_timer(self):
+        self._timer = None
+        self.run_due()
+        delay = self.next_delay()
+        with self._cond:
+            if delay is not None and self._timer is None:
+                self._timer = self._loop.call_later(delay, self._on_timer)
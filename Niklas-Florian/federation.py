@@ -0,0 +1,417 @@
+# federation.py
+# Föderation mehrerer Server-Knoten (--peer-port, --peer).
+#
+# Jeder Knoten ist ein eigener server.py-Prozess (auch auf verschiedenen Hosts), die
+# Clients werden z.B. per Round-Robin-DNS auf die Knoten verteilt. Die Knoten sind
+# untereinander voll vermascht über TCP verbunden und benutzen dasselbe Framing und
+# dieselben Nachrichtentypen wie der Worker-Bus (workers.py), nur ohne Broker:
+#
+#   HELLO       erster Frame jeder Knotenverbindung: Knoten-ID
+#   CLAIM       Name/(IP, Port) bei allen verbundenen Knoten reservieren
+#   CLAIM_OK    Knoten stimmt zu und hält den Namen frei, bis JOIN oder LEAVE kommt
+#   CLAIM_FAIL  mit Error-Code ablehnen (EC 1/2)
+#   JOIN        Client dieses Knotens ist registriert (Msg 4 bei den anderen)
+#   LEAVE       Client ist weg bzw. Claim zurückgenommen (Msg 5)
+#   BROADCAST   fertig kodierter Msg-6-Frame für alle Clients des Empfängers
+#   CHANNEL     fertig kodierter Msg-16-Frame für die Channel-Mitglieder des Empfängers
+#
+# Eine Registrierung ist erst abgeschlossen, wenn alle verbundenen Knoten zugestimmt
+# haben. Beanspruchen zwei Knoten gleichzeitig denselben Namen, gewinnt der Knoten
+# mit der kleineren ID. Nach einem Verbindungsaufbau schicken sich zwei Knoten ihre
+# lokalen Clients als JOIN (Abgleich nach Neustart oder Netztrennung); ist ein Name
+# dabei doppelt vergeben, behält ihn ebenfalls der kleinere Knoten, der andere trennt
+# seinen Client mit EC 2. Fällt eine Verbindung weg, gelten die Clients des anderen
+# Knotens als getrennt, bis er wieder erreichbar ist.
+#
+# Netzwerk läuft in einem eigenen Thread mit selectors; Aufrufe in server.py laufen
+# bei der asyncio-Engine über call_soon_threadsafe auf der Event-Loop.
+
+import asyncio
+import collections
+import errno
+import itertools
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from codec import encode_client_info
+from registry import EC_NICKNAME_NICHT_UNIQUE
+from workers import (BUS_BROADCAST, BUS_CHANNEL, BUS_CLAIM, BUS_CLAIM_FAIL, BUS_CLAIM_OK, BUS_JOIN, BUS_LEAVE,
+                     BusDecoder, decode_client_info, encode_bus)
+
+BUS_HELLO = 7
+
+RECONNECT_INTERVAL = 1.0  # Sekunden zwischen zwei Verbindungsversuchen zu einem Knoten
+
+_REQ_ID = struct.Struct('!I')
+
+
+class _PeerLink:
+    __slots__ = ('sock', 'address', 'dialed', 'connecting', 'node_id', 'decoder', 'outbuf')
+
+    def __init__(self, sock, address, dialed):
+        self.sock = sock
+        self.address = address
+        self.dialed = dialed  # von uns aufgebaut (--peer), sonst angenommen
+        self.connecting = dialed
+        self.node_id = None  # bekannt nach HELLO
+        self.decoder = BusDecoder()
+        self.outbuf = bytearray()
+
+
+class _Claim:
+    __slots__ = ('conn', 'ip', 'udp_port', 'name', 'resume', 'waiting')
+
+    def __init__(self, conn, ip, udp_port, name, resume, waiting):
+        self.conn = conn
+        self.ip = ip
+        self.udp_port = udp_port
+        self.name = name
+        self.resume = resume
+        self.waiting = waiting  # Knoten-IDs, deren Antwort noch fehlt
+
+
+class Federation:
+    # Wird in server.cluster eingetragen, Schnittstelle wie WorkerBus:
+    # claim(), leave(), broadcast(), start_thread(), attach_loop().
+
+    def __init__(self, server_module, node_id, host, port, peers):
+        self.server = server_module
+        self.node_id = node_id
+        self.links = {}  # node_id -> _PeerLink, nur nach HELLO
+        self.owners = {}  # name -> node_id der Clients anderer Knoten
+        self.granted = {}  # name -> node_id, zugestimmte Claims ohne JOIN
+        self.claims = {}  # req_id -> _Claim (eigene offene Claims)
+        self.claimed_names = {}  # name -> req_id
+        self._req_ids = itertools.count(1)
+        self._calls = collections.deque()
+        self._loop = None
+        self._links_by_sock = {}  # sock -> _PeerLink, auch vor HELLO
+        self._next_dial = {address: 0.0 for address in peers}  # (host, port) -> nächster Versuch
+        self._dial_nodes = {}  # (host, port) -> node_id, sobald bekannt
+        self.selector = selectors.DefaultSelector()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self._accept)
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, self._run_calls)
+
+    # Aufrufe aus server.py (beliebiger Thread)
+
+    def claim(self, conn, name, ip, udp_port, resume=None):
+        self._call(self._claim, conn, name, ip, udp_port, resume)
+
+    def leave(self, name):
+        self._call(self._send_all, encode_bus(BUS_LEAVE, name.encode('utf-8')))
+
+    def broadcast(self, frame):
+        self._call(self._send_all, encode_bus(BUS_BROADCAST, frame))
+
+    def publish(self, frame):
+        self._call(self._send_all, encode_bus(BUS_CHANNEL, frame))
+
+    # Anbindung an die Engines
+
+    def start_thread(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        print(f"Föderation: Knoten {self.node_id}, lauscht auf Port {self.listener.getsockname()[1]}")
+
+    async def attach_loop(self):
+        # asyncio-Engine: Aufrufe in server.py laufen auf dieser Loop
+        self._loop = asyncio.get_running_loop()
+        self.start_thread()
+
+    def _deliver(self, fn, *args):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(fn, *args)
+        else:
+            fn(*args)
+
+    def _call(self, fn, *args):
+        self._calls.append((fn, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass  # Loop ist ohnehin schon geweckt
+
+    # Event-Loop
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            due = [when for address, when in self._next_dial.items() if not self._dial_connected(address)]
+            timeout = max(0.0, min(due) - now) if due else None
+            for key, events in self.selector.select(timeout):
+                key.data(key.fileobj, events)
+            self._dial_due()
+
+    def _run_calls(self, sock, events):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            fn, args = self._calls.popleft()
+            fn(*args)
+
+    def _dial_connected(self, address):
+        if any(link.address == address for link in self._links_by_sock.values() if link.dialed):
+            return True
+        node_id = self._dial_nodes.get(address)
+        return node_id is not None and node_id in self.links
+
+    def _dial_due(self):
+        now = time.monotonic()
+        for address, when in self._next_dial.items():
+            if when <= now and not self._dial_connected(address):
+                self._next_dial[address] = now + RECONNECT_INTERVAL
+                self._dial(address)
+
+    def _dial(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Claims sind kleine Frames mit Antwort
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            return
+        link = _PeerLink(sock, address, dialed=True)
+        link.outbuf += encode_bus(BUS_HELLO, self.node_id.encode('utf-8'))
+        self._links_by_sock[sock] = link
+        self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self._link_io)
+
+    def _accept(self, listener, events):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except (BlockingIOError, OSError):
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            link = _PeerLink(sock, addr, dialed=False)
+            self._links_by_sock[sock] = link
+            self.selector.register(sock, selectors.EVENT_READ, self._link_io)
+            self._send(link, encode_bus(BUS_HELLO, self.node_id.encode('utf-8')))
+
+    def _link_io(self, sock, events):
+        link = self._links_by_sock.get(sock)
+        if link is None:
+            return
+        if events & selectors.EVENT_WRITE:
+            if link.connecting:
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    self._close(link)
+                    return
+                link.connecting = False
+            self._flush(link)
+        if events & selectors.EVENT_READ:
+            try:
+                data = sock.recv(65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self._close(link)
+                return
+            link.decoder.feed(data)
+            for kind, payload in link.decoder.messages():
+                if link.sock is None:
+                    return  # beim Verarbeiten geschlossen
+                self._handle(link, kind, payload)
+
+    def _send(self, link, data):
+        # Nicht blockierend; Rest wird gepuffert und bei EVENT_WRITE nachgeschoben
+        if link.sock is None:
+            return
+        if not link.outbuf and not link.connecting:
+            try:
+                sent = link.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                return
+            if sent == len(data):
+                return
+            data = data[sent:]
+        link.outbuf += data
+        self.selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self._link_io)
+
+    def _flush(self, link):
+        if link.outbuf:
+            try:
+                sent = link.sock.send(link.outbuf)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._close(link)
+                return
+            del link.outbuf[:sent]
+        if not link.outbuf:
+            self.selector.modify(link.sock, selectors.EVENT_READ, self._link_io)
+
+    def _send_all(self, data):
+        for link in list(self.links.values()):
+            self._send(link, data)
+
+    def _close(self, link):
+        if link.sock is None:
+            return
+        self.selector.unregister(link.sock)
+        del self._links_by_sock[link.sock]
+        link.sock.close()
+        link.sock = None
+        if link.node_id is not None and self.links.get(link.node_id) is link:
+            self._node_lost(link.node_id)
+
+    # Protokoll zwischen den Knoten
+
+    def _handle(self, link, kind, payload):
+        if link.node_id is None:
+            if kind != BUS_HELLO:
+                self._close(link)
+                return
+            self._hello(link, payload.decode('utf-8'))
+        elif kind == BUS_BROADCAST:
+            self._deliver(self.server.fremder_broadcast, payload)
+        elif kind == BUS_CHANNEL:
+            self._deliver(self.server.fremde_channel_nachricht, payload)
+        elif kind == BUS_CLAIM:
+            self._peer_claim(link, payload)
+        elif kind in (BUS_CLAIM_OK, BUS_CLAIM_FAIL):
+            req_id = _REQ_ID.unpack_from(payload)[0]
+            claim = self.claims.get(req_id)
+            if claim is None:
+                return  # schon abgeschlossen (z.B. nach einer früheren Ablehnung)
+            if kind == BUS_CLAIM_FAIL:
+                self._finish_claim(req_id, payload[_REQ_ID.size])
+            else:
+                claim.waiting.discard(link.node_id)
+                if not claim.waiting:
+                    self._finish_claim(req_id)
+        elif kind == BUS_JOIN:
+            ip, udp_port, name = decode_client_info(payload)
+            self._peer_join(link.node_id, name, ip, udp_port)
+        elif kind == BUS_LEAVE:
+            self._peer_leave(link.node_id, payload.decode('utf-8'))
+
+    def _hello(self, link, node_id):
+        if node_id == self.node_id:
+            print(f"Föderation: {link.address} ist dieser Knoten selbst, wird ignoriert.")
+            self._next_dial.pop(link.address, None)
+            self._close(link)
+            return
+        link.node_id = node_id
+        if link.dialed:
+            self._dial_nodes[link.address] = node_id
+        current = self.links.get(node_id)
+        if current is not None:
+            # Beide Knoten haben sich gegenseitig verbunden: auf beiden Seiten bleibt die
+            # Verbindung, die der Knoten mit der kleineren ID aufgebaut hat
+            if current.dialed == (self.node_id < node_id):
+                link.node_id = None  # kein Knotenverlust beim Schließen
+                self._close(link)
+                return
+            self.links[node_id] = link
+            current.node_id = None
+            self._close(current)
+            return
+        self.links[node_id] = link
+        print(f"Föderation: Knoten {node_id} verbunden.")
+        # Abgleich: eigene Clients und offene Claims auch beim neuen Knoten anmelden
+        for entry in self.server.registry.snapshot():
+            self._send(link, encode_bus(BUS_JOIN, encode_client_info(entry.ip_bytes, entry.udp_port, entry.name)))
+        for req_id, claim in self.claims.items():
+            claim.waiting.add(node_id)
+            self._send(link, encode_bus(BUS_CLAIM, _REQ_ID.pack(req_id) +
+                                        encode_client_info(claim.ip, claim.udp_port, claim.name)))
+
+    def _node_lost(self, node_id):
+        del self.links[node_id]
+        print(f"Föderation: Verbindung zu Knoten {node_id} verloren.")
+        for name in [name for name, owner in self.owners.items() if owner == node_id]:
+            del self.owners[name]
+            self._deliver(self.server.fremder_client_getrennt, name)
+        for name in [name for name, owner in self.granted.items() if owner == node_id]:
+            del self.granted[name]
+        for req_id, claim in list(self.claims.items()):
+            claim.waiting.discard(node_id)
+            if not claim.waiting:
+                self._finish_claim(req_id)
+
+    def _claim(self, conn, name, ip, udp_port, resume):
+        if name in self.claimed_names or name in self.granted or name in self.owners:
+            self._deliver(self.server.sende_fehler, conn, EC_NICKNAME_NICHT_UNIQUE)
+            return
+        if not self.links:
+            self._deliver(self.server.registrierung_abschliessen, conn, ip, udp_port, name, resume)
+            return
+        req_id = next(self._req_ids) & 0xFFFFFFFF
+        self.claims[req_id] = _Claim(conn, ip, udp_port, name, resume, set(self.links))
+        self.claimed_names[name] = req_id
+        self._send_all(encode_bus(BUS_CLAIM, _REQ_ID.pack(req_id) + encode_client_info(ip, udp_port, name)))
+
+    def _finish_claim(self, req_id, error_code=None):
+        claim = self.claims.pop(req_id)
+        del self.claimed_names[claim.name]
+        if error_code is not None or claim.conn.closed:
+            # Zustimmungen der anderen Knoten zurücknehmen
+            self._send_all(encode_bus(BUS_LEAVE, claim.name.encode('utf-8')))
+            if error_code is not None:
+                self._deliver(self.server.sende_fehler, claim.conn, error_code)
+            return
+        self._send_all(encode_bus(BUS_JOIN, encode_client_info(claim.ip, claim.udp_port, claim.name)))
+        self._deliver(self.server.registrierung_abschliessen, claim.conn, claim.ip, claim.udp_port, claim.name,
+                      claim.resume)
+
+    def _peer_claim(self, link, payload):
+        req_id = payload[:_REQ_ID.size]
+        ip, udp_port, name = decode_client_info(payload, _REQ_ID.size)
+        error_code = self.server.registry.check(name, ip, udp_port)
+        if error_code is None and (name in self.owners or name in self.granted):
+            error_code = EC_NICKNAME_NICHT_UNIQUE
+        if error_code is None and name in self.claimed_names and self.node_id < link.node_id:
+            error_code = EC_NICKNAME_NICHT_UNIQUE  # gleichzeitiger eigener Claim, kleinere ID gewinnt
+        if error_code is not None:
+            self._send(link, encode_bus(BUS_CLAIM_FAIL, req_id + bytes([error_code])))
+            return
+        self.granted[name] = link.node_id
+        self._send(link, encode_bus(BUS_CLAIM_OK, req_id))
+
+    def _peer_join(self, node_id, name, ip, udp_port):
+        if self.granted.get(name) == node_id:
+            del self.granted[name]
+        owner = self.owners.get(name)
+        if owner is None:
+            entry = self.server.registry.get(name)
+            if entry is not None and entry.conn is not None:
+                owner = self.node_id
+        if owner == node_id:
+            return  # schon bekannt
+        if owner is not None and owner < node_id:
+            return  # Name bleibt beim bisherigen Knoten, der andere gibt ihn ab
+        self.owners[name] = node_id
+        if owner == self.node_id:
+            self._deliver(self.server.namenskonflikt, name, ip, udp_port)
+        elif owner is not None:
+            self._deliver(self.server.fremder_client_getrennt, name)
+            self._deliver(self.server.fremder_client_verbunden, name, ip, udp_port)
+        else:
+            self._deliver(self.server.fremder_client_verbunden, name, ip, udp_port)
+
+    def _peer_leave(self, node_id, name):
+        if self.granted.get(name) == node_id:
+            del self.granted[name]
+        if self.owners.get(name) == node_id:
+            del self.owners[name]
+            self._deliver(self.server.fremder_client_getrennt, name)
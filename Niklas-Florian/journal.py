@@ -0,0 +1,326 @@
+# journal.py
+# Append-only Journal aller verteilten Broadcasts (Msg-6-Frames, --journal DIR).
+#
+# Das Journal besteht aus Segmenten <erste seq>.journal; jeder Eintrag ist
+# RECORD (Länge, CRC32, Zeitstempel) gefolgt vom unveränderten Frame. Erreicht ein
+# Segment segment_bytes, wird ein neues angefangen, das alte bekommt eine .index-
+# Datei mit den Offsets seiner Einträge und wird nicht mehr verändert.
+#
+# Schreiben: append() hängt den Frame nur an eine Liste, ein eigener Thread schreibt
+# alles Angesammelte mit einem write() und einem fdatasync() (Group Commit). Während
+# ein fsync läuft, sammeln sich die nächsten Broadcasts; die Kosten verteilen sich so
+# von selbst auf viele Nachrichten, ohne dass der Broadcast-Handler wartet.
+#
+# Lesen: pro Segment ein mmap und ein array('Q') mit den Offsets aller Einträge.
+# tail(n) (Verlauf für neue Clients) und scan() (Historie) greifen damit direkt auf
+# den n-ten Eintrag zu, ohne Segmente in den Speicher zu laden. Beim Öffnen werden
+# Segmente ohne .index einmal durchlaufen; ein abgerissener letzter Eintrag (Absturz
+# mitten im write) wird dabei abgeschnitten.
+#
+#   python journal.py DIR --tail 20
+
+import argparse
+import array
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD = struct.Struct('!I I d')  # Länge des Frames, CRC32 des Frames, Zeitstempel (Unix-Zeit)
+
+SEGMENT_BYTES = 64 * 1024 * 1024  # Größe, ab der ein neues Segment angefangen wird
+MAX_SEGMENTS = 0  # Älteste Segmente darüber hinaus löschen, 0 = alle behalten
+MAX_PENDING = 100000  # Ungeschriebene Einträge, darüber wird verworfen (Platte hängt)
+
+
+def _segment_name(base):
+    return f'{base:020d}.journal'
+
+
+class Segment:
+    __slots__ = ('base', 'path', 'offsets', 'size', '_map')
+
+    def __init__(self, base, path):
+        self.base = base  # seq des ersten Eintrags
+        self.path = path
+        self.offsets = array.array('Q')  # Offset jedes geschriebenen Eintrags
+        self.size = 0  # geschriebene und synchronisierte Bytes
+        self._map = None
+
+    def view(self):
+        # mmap über alles Geschriebene; wächst das Segment, wird neu gemappt (ein
+        # altes mmap bleibt gültig, solange noch ein Leser darauf zeigt)
+        if self._map is None or len(self._map) < self.size:
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def record(self, view, i):
+        # (Zeitstempel, Frame als memoryview) des i-ten Eintrags
+        offset = self.offsets[i]
+        length, _, stamp = RECORD.unpack_from(view, offset)
+        start = offset + RECORD.size
+        return stamp, view[start:start + length]
+
+    def recover(self, use_index=True, truncate=True):
+        # Offsets aus der .index-Datei oder durch einmaliges Durchlaufen; schneidet
+        # einen unvollständigen oder beschädigten letzten Eintrag ab
+        size = os.path.getsize(self.path)
+        index_path = self.path[:-len('.journal')] + '.index'
+        if use_index and os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                self.offsets.frombytes(f.read())
+            self.size = size
+            return
+        if size == 0:
+            return
+        view = self.view()
+        offset = 0
+        while offset + RECORD.size <= size:
+            length, crc, _ = RECORD.unpack_from(view, offset)
+            end = offset + RECORD.size + length
+            if end > size or zlib.crc32(view[offset + RECORD.size:end]) != crc:
+                break
+            self.offsets.append(offset)
+            offset = end
+        view.release()
+        self._map = None
+        if offset < size and truncate:
+            print(f"Journal: {size - offset} Bytes am Ende von {self.path} verworfen")
+            os.truncate(self.path, offset)
+        self.size = offset
+
+    def seal(self):
+        # Segment ist voll: Offsets für den nächsten Start ablegen
+        index_path = self.path[:-len('.journal')] + '.index'
+        with open(index_path + '.tmp', 'wb') as f:
+            self.offsets.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + '.tmp', index_path)
+
+
+class Journal:
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_segments=MAX_SEGMENTS, readonly=False):
+        # readonly: nur lesen (z.B. neben einem laufenden Server), kein Schreib-Thread
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.readonly = readonly
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.dropped = 0
+        self.commits = 0  # fsyncs bisher, zusammen mit len() die mittlere Gruppengröße
+        self._segments = []
+        self._pending = []  # (frame, zeitstempel), noch nicht beim Schreib-Thread
+        self._writing = []  # Gruppe, die gerade geschrieben wird
+        self._cond = threading.Condition()
+        self._closed = False
+        self._fd = None
+        self._thread = None
+        self._open_segments()
+        if not readonly:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __len__(self):
+        # Anzahl aller je angehängten Einträge = seq des nächsten
+        with self._cond:
+            return self._next_seq()
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending) + len(self._writing)
+
+    def _next_seq(self):
+        last = self._segments[-1]
+        return last.base + len(last.offsets) + len(self._writing) + len(self._pending)
+
+    def _open_segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.journal'))
+        for name in names:
+            segment = Segment(int(name[:-len('.journal')]), os.path.join(self.directory, name))
+            # Dem Index des letzten Segments nicht trauen: es wird weiter beschrieben
+            segment.recover(use_index=name != names[-1], truncate=not self.readonly)
+            self._segments.append(segment)
+        if self.readonly:
+            if not self._segments:
+                self._segments.append(Segment(0, None))
+            return
+        if not self._segments:
+            self._segments.append(self._create_segment(0))
+        self._fd = os.open(self._segments[-1].path, os.O_WRONLY | os.O_APPEND)
+
+    def _create_segment(self, base):
+        path = os.path.join(self.directory, _segment_name(base))
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)  # Neuer Verzeichniseintrag überlebt einen Absturz
+        finally:
+            os.close(dir_fd)
+        return Segment(base, path)
+
+    # Schreiben
+
+    def append(self, frame):
+        # Aus dem Broadcast-Handler: nur anhängen, geschrieben wird im eigenen Thread
+        if not isinstance(frame, bytes):
+            frame = bytes(frame)
+        with self._cond:
+            if self._closed or self.readonly:
+                return False
+            if len(self._pending) >= MAX_PENDING:
+                self.dropped += 1
+                return False
+            self._pending.append((frame, time.time()))
+            if len(self._pending) == 1:
+                self._cond.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        # Wartet, bis alles bisher Angehängte geschrieben und synchronisiert ist
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            target = self._next_seq()
+            while self._segments[-1].base + len(self._segments[-1].offsets) < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        if self._thread is None:
+            return
+        self.flush(5.0)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(5.0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    os.close(self._fd)
+                    return
+                self._writing, self._pending = self._pending, []
+                batch = self._writing
+            try:
+                self._commit(batch)
+            except OSError as e:
+                print(f"Journal: Schreiben fehlgeschlagen, {len(batch)} Einträge verloren: {e}")
+                with self._cond:
+                    self.dropped += len(batch)
+                    self._writing = []
+                    self._cond.notify_all()
+
+    def _commit(self, batch):
+        segment = self._segments[-1]
+        if segment.size >= self.segment_bytes:
+            segment = self._rotate(segment)
+        buf = bytearray()
+        offsets = array.array('Q')
+        for frame, stamp in batch:
+            offsets.append(segment.size + len(buf))
+            buf += RECORD.pack(len(frame), zlib.crc32(frame), stamp)
+            buf += frame
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(self._fd, view):]
+        os.fdatasync(self._fd)  # Eine Synchronisierung für die ganze Gruppe
+        with self._cond:
+            segment.offsets.extend(offsets)
+            segment.size += len(buf)
+            self._writing = []
+            self.commits += 1
+            self._cond.notify_all()
+
+    def _rotate(self, segment):
+        segment.seal()
+        fresh = self._create_segment(segment.base + len(segment.offsets))
+        fd = os.open(fresh.path, os.O_WRONLY | os.O_APPEND)
+        os.close(self._fd)
+        with self._cond:
+            self._fd = fd
+            self._segments.append(fresh)
+            expired = []
+            if self.max_segments and len(self._segments) > self.max_segments:
+                expired = self._segments[:-self.max_segments]
+                del self._segments[:-self.max_segments]
+        for old in expired:
+            os.remove(old.path)
+            index_path = old.path[:-len('.journal')] + '.index'
+            if os.path.exists(index_path):
+                os.remove(index_path)
+        return fresh
+
+    # Lesen
+    #
+    # Leser mappen ihre Segmente noch unter _cond: _rotate löscht abgelaufene Segmente
+    # erst, nachdem es sie unter derselben Sperre aus _segments genommen hat, und ein
+    # bestehendes mmap bleibt auch nach dem Löschen der Datei gültig.
+
+    def tail(self, n):
+        # Die letzten n Frames (bytes), älteste zuerst; enthält auch noch nicht
+        # geschriebene Einträge
+        if n <= 0:
+            return []
+        with self._cond:
+            unwritten = [frame for frame, _ in self._writing + self._pending][-n:]
+            need = n - len(unwritten)
+            ranges = []
+            for segment in reversed(self._segments):
+                if need <= 0:
+                    break
+                count = len(segment.offsets)
+                take = min(need, count)
+                if take:
+                    ranges.append((segment, segment.view(), count - take, count))
+                need -= take
+        frames = []
+        for segment, view, lo, hi in reversed(ranges):
+            for i in range(lo, hi):
+                frames.append(bytes(segment.record(view, i)[1]))
+        return frames + unwritten
+
+    def scan(self, start=0):
+        # (seq, zeitstempel, frame als memoryview) aller geschriebenen Einträge ab seq
+        # start; die Views zeigen ins mmap und gelten nur bis zum nächsten Eintrag
+        with self._cond:
+            segments = [(segment, segment.view(), len(segment.offsets)) for segment in self._segments
+                        if segment.offsets and segment.base + len(segment.offsets) > start]
+        for segment, view, count in segments:
+            for i in range(max(0, start - segment.base), count):
+                stamp, frame = segment.record(view, i)
+                yield segment.base + i, stamp, frame
+
+
+def main():
+    # Historie auf der Konsole, ohne das Journal in den Speicher zu laden
+    from codec import BROADCAST
+
+    parser = argparse.ArgumentParser(description='Broadcast-Journal des Chat-Servers ausgeben')
+    parser.add_argument('directory', help='Verzeichnis des Journals (--journal des Servers)')
+    parser.add_argument('--tail', type=int, help='Nur die letzten N Einträge')
+    parser.add_argument('--from', dest='start', type=int, default=0, help='Ab dieser Nummer (Standard: 0)')
+    args = parser.parse_args()
+
+    journal = Journal(args.directory, readonly=True)
+    start = args.start
+    if args.tail is not None:
+        start = max(start, len(journal) - args.tail)
+    for seq, stamp, frame in journal.scan(start):
+        text = str(frame[BROADCAST.size:], 'utf-8', 'replace')
+        print(f"{seq:>8} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp))} {text}")
+    journal.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+# loadgen.py
+# Skriptbarer Lastgenerator für server.py (ohne input()-Menü).
+#
+#   python loadgen.py --spawn asyncio --clients 1000 --rate 200 --duration 10 --output result.json
+#   python loadgen.py --port 7777 --server-pid 1234 --clients 500 --churn-rate 20
+#
+# Simuliert N Clients über Loopback in einem Prozess (asyncio, FrameDecoder und
+# Encoder aus protocol.py wie client.py) und fährt drei Phasen:
+#   join       alle Clients registrieren sich gleichzeitig (Join-Sturm)
+#   broadcast  Msg 6 mit fester Gesamtrate, jeder Empfänger misst die Latenz
+#   churn      Clients gehen per Msg 7 oder harter Trennung und kommen neu dazu
+# Mit --flood-rate flutet der zuletzt registrierte Client während der Broadcast-Phase, um
+# Sendelimit (--rate-limit, EC 8) und faire Verteilung des Servers zu prüfen.
+# Ergebnis (Latenzen p50/p99/p999, Nachrichten/s, RSS des Servers) wird als JSON
+# geschrieben, damit Läufe verschiedener Versionen vergleichbar bleiben.
+
+import argparse
+import asyncio
+import json
+import random
+import struct
+import subprocess
+import sys
+import time
+
+from benchmark import chat_text, free_port, proc_status, raise_fd_limit, start_server, stop_server
+from codec import CAP_ZLIB, DISCONNECT_FRAME, encode_broadcast, encode_capabilities, encode_registration
+from protocol import FrameDecoder
+
+PAYLOAD_PREFIX = b'LG '  # Nur eigene Broadcasts auswerten
+FLOOD_PREFIX = b'FL '  # Broadcasts des Flooders (--flood-rate)
+FLOOD_WRITE_LIMIT = 1 << 20  # Flooder pausiert, solange so viel ungesendet im Puffer liegt
+
+
+def percentiles_ms(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1e3, 3)
+    return {'count': len(values), 'p50': pick(0.50), 'p99': pick(0.99), 'p999': pick(0.999),
+            'max': round(values[-1] * 1e3, 3)}
+
+
+class Stats:
+
+    def __init__(self):
+        self.join_latencies = []
+        self.rejoin_latencies = []
+        self.fanout_latencies = []
+        self.received = {}  # msg_id -> Anzahl
+        self.errors = {}  # error_code -> Anzahl
+        self.broadcasts_sent = 0
+        self.flood_received = 0
+        self.bytes_received = 0  # über alle Clients, wie auf der Leitung (ggf. komprimiert)
+
+
+class SimClient(asyncio.BufferedProtocol):
+
+    def __init__(self, stats, name, ip, udp_port, compress=False):
+        loop = asyncio.get_running_loop()
+        self.stats = stats
+        self.name = name
+        self.ip = ip
+        self.udp_port = udp_port
+        self.compress = compress
+        self.decoder = FrameDecoder()
+        self.transport = None
+        self.registered = loop.create_future()
+        self.lost = loop.create_future()
+        self._join_started = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self.stats.bytes_received += nbytes
+        now = time.monotonic_ns()
+        received = self.stats.received
+        for msg_id, payload in self.decoder.messages():
+            received[msg_id] = received.get(msg_id, 0) + 1
+            if msg_id == 6:
+                if payload.startswith(PAYLOAD_PREFIX):
+                    sent_ns = int(payload.split(b' ', 3)[2])
+                    self.stats.fanout_latencies.append((now - sent_ns) / 1e9)
+                elif payload.startswith(FLOOD_PREFIX):
+                    self.stats.flood_received += 1
+            elif msg_id == 2:
+                if not self.registered.done():
+                    self.registered.set_result((now - self._join_started) / 1e9)
+            elif msg_id == 0:
+                self.stats.errors[payload] = self.stats.errors.get(payload, 0) + 1
+                if not self.registered.done():
+                    self.registered.set_exception(ConnectionError(f"Fehler-Code {payload}"))
+
+    def connection_lost(self, exc):
+        if not self.registered.done():
+            self.registered.set_exception(ConnectionError("Verbindung vor Msg 2 verloren"))
+        if not self.lost.done():
+            self.lost.set_result(None)
+
+    def register(self):
+        self._join_started = time.monotonic_ns()
+        if self.compress:
+            self.transport.write(encode_capabilities(CAP_ZLIB))  # vor Msg 1, damit schon Msg 2 komprimiert kommt
+        self.transport.write(encode_registration(self.ip, self.udp_port, self.name))
+        return self.registered
+
+    def broadcast(self, seq, padding):
+        text = b'LG %d %d ' % (seq, time.monotonic_ns()) + padding
+        self.transport.write(encode_broadcast(text))
+
+    def disconnect(self, graceful):
+        if graceful:
+            self.transport.write(DISCONNECT_FRAME)
+            self.transport.close()
+        else:
+            self.transport.abort()
+
+
+class LoadGenerator:
+
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.clients = []
+        self._serial = args.id_offset
+        self.rss_samples = []
+
+    def _next_identity(self):
+        # Eindeutiger Name und eindeutiges (IP, UDP-Port) pro simuliertem Client
+        i = self._serial
+        self._serial += 1
+        ip = struct.pack('!I', 0x7F000001 + i // 60000)
+        return f'lg-{i}', ip, 1024 + i % 60000
+
+    async def connect_client(self):
+        loop = asyncio.get_running_loop()
+        name, ip, udp_port = self._next_identity()
+        _, client = await loop.create_connection(
+            lambda: SimClient(self.stats, name, ip, udp_port, self.args.compress), self.args.host, self.args.port)
+        latency = await asyncio.wait_for(client.register(), self.args.timeout)
+        return client, latency
+
+    async def join_phase(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one():
+            async with semaphore:
+                return await self.connect_client()
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one() for _ in range(self.args.clients)), return_exceptions=True)
+        seconds = time.perf_counter() - start
+        failures = 0
+        for result in results:
+            if isinstance(result, BaseException):
+                failures += 1
+                continue
+            client, latency = result
+            self.clients.append(client)
+            self.stats.join_latencies.append(latency)
+        return {
+            'clients': self.args.clients,
+            'failed': failures,
+            'seconds': round(seconds, 3),
+            'joins_per_second': round(len(self.clients) / seconds, 1) if seconds else None,
+            'latency_ms': percentiles_ms(self.stats.join_latencies),
+        }
+
+    async def flood(self, flooder, padding, stop):
+        # Sendet mit args.flood_rate, in Schüben alle 10 ms; nimmt der Server nichts
+        # mehr an, wird der Schub übersprungen statt den Puffer endlos zu füllen
+        rate = self.args.flood_rate
+        text = FLOOD_PREFIX + padding
+        frame = encode_broadcast(text)
+        sent = skipped = 0
+        start = time.perf_counter()
+        while not stop.is_set():
+            due = int((time.perf_counter() - start) * rate) - sent - skipped
+            if due > 0:
+                if flooder.transport.get_write_buffer_size() < FLOOD_WRITE_LIMIT:
+                    flooder.transport.write(frame * due)
+                    sent += due
+                else:
+                    skipped += due
+            await asyncio.sleep(0.01)
+        return sent, skipped
+
+    async def broadcast_phase(self):
+        args = self.args
+        flooder = self.clients[-1] if args.flood_rate > 0 else None
+        candidates = self.clients[:-1] if flooder else self.clients
+        senders = candidates[:max(1, min(args.senders, len(candidates)))]
+        padding = chat_text(max(0, args.payload - 32))
+        interval = 1.0 / args.rate
+        before = len(self.stats.fanout_latencies)
+        errors_before = self.stats.errors.get(8, 0)
+        flood_stop = asyncio.Event()
+        flood_task = asyncio.create_task(self.flood(flooder, padding, flood_stop)) if flooder else None
+
+        start = time.perf_counter()
+        next_send = start
+        seq = 0
+        while time.perf_counter() - start < args.duration:
+            senders[seq % len(senders)].broadcast(seq, padding)
+            seq += 1
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif seq % 100 == 0:
+                await asyncio.sleep(0)  # Empfang nicht aushungern
+        sent_seconds = time.perf_counter() - start
+        if flood_task:
+            flood_stop.set()
+            flood_sent, flood_skipped = await flood_task
+
+        # Auf die letzten Auslieferungen warten
+        expected = seq * (len(self.clients) - 1)
+        deadline = time.perf_counter() + args.timeout
+        while len(self.stats.fanout_latencies) - before < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        self.stats.broadcasts_sent += seq
+
+        delivered = len(self.stats.fanout_latencies) - before
+        result = {
+            'senders': len(senders),
+            'target_rate': args.rate,
+            'sent': seq,
+            'messages_per_second': round(seq / sent_seconds, 1),
+            'expected_deliveries': expected,
+            'delivered': delivered,
+            'deliveries_per_second': round(delivered / sent_seconds, 1),
+            'fanout_latency_ms': percentiles_ms(self.stats.fanout_latencies[before:]),
+        }
+        if flood_task:
+            result['flood'] = {
+                'target_rate': args.flood_rate,
+                'sent': flood_sent,
+                'skipped': flood_skipped,
+                'delivered': self.stats.flood_received,
+                'rate_limit_errors': self.stats.errors.get(8, 0) - errors_before,
+            }
+        return result
+
+    async def churn_phase(self):
+        args = self.args
+        graceful = abrupt = failed = 0
+        interval = 1.0 / args.churn_rate
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.churn_duration and self.clients:
+            victim = self.clients.pop(random.randrange(len(self.clients)))
+            if random.random() < args.graceful_ratio:
+                victim.disconnect(graceful=True)
+                graceful += 1
+            else:
+                victim.disconnect(graceful=False)
+                abrupt += 1
+            try:
+                client, latency = await self.connect_client()
+                self.clients.append(client)
+                self.stats.rejoin_latencies.append(latency)
+            except (OSError, asyncio.TimeoutError):
+                failed += 1
+            await asyncio.sleep(interval)
+        return {
+            'graceful_leaves': graceful,
+            'abrupt_leaves': abrupt,
+            'failed_rejoins': failed,
+            'rejoin_latency_ms': percentiles_ms(self.stats.rejoin_latencies),
+        }
+
+    async def sample_rss(self, pid):
+        while True:
+            try:
+                self.rss_samples.append(proc_status(pid)['VmRSS'])
+            except (OSError, KeyError):
+                return
+            await asyncio.sleep(0.5)
+
+    async def run(self, server_pid):
+        sampler = asyncio.create_task(self.sample_rss(server_pid)) if server_pid else None
+        result = {'join': await self.join_phase()}
+        if self.args.duration > 0 and len(self.clients) > 1:
+            result['broadcast'] = await self.broadcast_phase()
+        if self.args.churn_rate > 0:
+            result['churn'] = await self.churn_phase()
+        for client in self.clients:
+            client.disconnect(graceful=True)
+        await asyncio.sleep(0.2)
+        if sampler:
+            sampler.cancel()
+        if self.rss_samples:
+            result['server_rss_kib'] = {'start': self.rss_samples[0], 'peak': max(self.rss_samples),
+                                        'end': self.rss_samples[-1]}
+        result['bytes_received'] = self.stats.bytes_received
+        result['messages_received'] = {str(k): v for k, v in sorted(self.stats.received.items())}
+        result['errors'] = {str(k): v for k, v in sorted(self.stats.errors.items())}
+        return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lastgenerator für den Chat-Server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Server-IP-Adresse (Standard: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=7777, help='Server-TCP-Port (Standard: 7777)')
+    parser.add_argument('--spawn', choices=('thread', 'asyncio'),
+                        help='Eigenen server.py mit dieser Engine auf einem freien Port starten')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='Zusätzliches Argument für den gestarteten Server (mehrfach möglich)')
+    parser.add_argument('--server-pid', type=int, help='PID des Servers für RSS-Messung (bei --spawn automatisch)')
+    parser.add_argument('--clients', type=int, default=200, help='Anzahl simulierter Clients (Standard: 200)')
+    parser.add_argument('--concurrency', type=int, default=256, help='Gleichzeitige Registrierungen (Standard: 256)')
+    parser.add_argument('--senders', type=int, default=10, help='Clients, die Broadcasts senden (Standard: 10)')
+    parser.add_argument('--rate', type=float, default=100.0, help='Broadcasts pro Sekunde insgesamt (Standard: 100)')
+    parser.add_argument('--payload', type=int, default=64, help='Bytes pro Broadcast (Standard: 64)')
+    parser.add_argument('--duration', type=float, default=5.0, help='Dauer der Broadcast-Phase in s, 0 = aus (Standard: 5)')
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help='Der letzte Client flutet mit so vielen Broadcasts/s, 0 = aus (Standard: 0)')
+    parser.add_argument('--churn-rate', type=float, default=0.0, help='Leave+Rejoin pro Sekunde, 0 = aus (Standard: 0)')
+    parser.add_argument('--churn-duration', type=float, default=5.0, help='Dauer der Churn-Phase in s (Standard: 5)')
+    parser.add_argument('--graceful-ratio', type=float, default=0.5,
+                        help='Anteil der Leaves per Msg 7, der Rest trennt hart (Standard: 0.5)')
+    parser.add_argument('--compress', action='store_true',
+                        help='Clients melden per Msg 12 zlib an (komprimierte Msg 2 und Broadcasts)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Timeout für Registrierung/Auslieferung (Standard: 10)')
+    parser.add_argument('--id-offset', type=int, default=0,
+                        help='Erste Client-Nummer, für mehrere Lastgeneratoren gegen einen Server (Standard: 0)')
+    parser.add_argument('--output', type=str, help='Ergebnis zusätzlich in diese JSON-Datei schreiben')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    proc = None
+    server_pid = args.server_pid
+    if args.spawn:
+        args.port = free_port()
+        proc = start_server(args.port, ['--engine', args.spawn] + args.server_arg)
+        server_pid = proc.pid
+    try:
+        result = asyncio.run(LoadGenerator(args).run(server_pid))
+    finally:
+        if proc:
+            stop_server(proc)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'config': {k: v for k, v in vars(args).items() if k not in ('output',)},
+        'result': result,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# metrics.py
+# Laufzeit-Metriken des Servers im Prometheus-Textformat.
+#
+# Zähler und Histogramme werden direkt im Dispatch (handel_msg) und in den
+# Fan-out-Schleifen aktualisiert; Gauges (z. B. verbundene Clients, Queue-Tiefen)
+# werden erst beim Abruf über eine Callback-Funktion berechnet. Mit
+# start_http_server() sind sie unter http://<host>:<port>/metrics abrufbar.
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Obergrenzen der Histogramm-Buckets in Sekunden
+LATENCY_BUCKETS = (50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 1.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # letzter Eintrag: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, label) -> Wert
+        self._histograms = {}  # (name, label) -> Histogram
+        self._help = {}  # name -> (typ, hilfetext, labelname)
+        self._gauges = []  # (name, hilfetext, callback)
+
+    def describe(self, name, kind, help_text, label=None):
+        self._help[name] = (kind, help_text, label)
+
+    def inc(self, name, label=None, value=1):
+        key = (name, label)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, label=None):
+        key = (name, label)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, help_text, callback):
+        self._gauges.append((name, help_text, callback))
+
+    def counter_value(self, name, label=None):
+        return self._counters.get((name, label), 0)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            histograms = sorted(((key, h.counts[:], h.sum, h.count, h.buckets) for key, h in self._histograms.items()),
+                                key=lambda item: (item[0][0], str(item[0][1])))
+
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, help_text, _ = self._help.get(name, ('untyped', '', None))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def labels(name, label, extra=''):
+            label_name = self._help.get(name, (None, None, None))[2]
+            parts = []
+            if label is not None and label_name:
+                parts.append(f'{label_name}="{label}"')
+            if extra:
+                parts.append(extra)
+            return '{' + ','.join(parts) + '}' if parts else ''
+
+        for (name, label), value in counters:
+            header(name)
+            lines.append(f'{name}{labels(name, label)} {value}')
+
+        for (name, label), counts, total, count, buckets in histograms:
+            header(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%g"' % bound
+                lines.append(f'{name}_bucket{labels(name, label, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{name}_bucket{labels(name, label, le)} {count}')
+            lines.append(f'{name}_sum{labels(name, label)} {total:.9f}')
+            lines.append(f'{name}_count{labels(name, label)} {count}')
+
+        for name, help_text, callback in self._gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {callback()}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def start_http_server(metrics, host, port):
+    # Beantwortet GET /metrics in einem eigenen Daemon-Thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keine Zeile pro Abruf
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,158 @@
+# outbound.py
+# Ausgehende Warteschlange pro Client für die thread-Engine.
+#
+# Handler rufen nur noch send(frame) auf, das den fertig kodierten Frame in eine
+# Queue hängt und sofort zurückkehrt. Ein eigener Writer-Thread pro Verbindung
+# schreibt die Queue mit nicht blockierenden Sends in den Socket. Ein Client, der
+# nicht mehr liest, hält dadurch niemanden mehr auf: bleibt seine Queue länger als
+# SLOW_CLIENT_TIMEOUT über QUEUE_HIGH_WATER (oder überschreitet sie QUEUE_LIMIT),
+# wird on_slow(conn) aufgerufen und der Server trennt ihn.
+#
+# Alle eingereihten Frames gehen mit einem sendmsg() als iovec-Liste raus, ohne sie
+# vorher zu einem Puffer zusammenzukopieren.
+
+import collections
+import itertools
+import os
+import select
+import socket
+import threading
+import time
+
+QUEUE_HIGH_WATER = 256 * 1024  # Bytes in der Queue, ab denen ein Client als langsam gilt
+QUEUE_LIMIT = 4 * 1024 * 1024  # Bytes in der Queue, ab denen sofort getrennt wird
+SLOW_CLIENT_TIMEOUT = 5.0  # Sekunden, die ein Client über QUEUE_HIGH_WATER bleiben darf
+
+_POLL_INTERVAL = 0.25  # Sekunden zwischen zwei Prüfungen, während der Socket voll ist
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')  # Höchstzahl Puffer pro sendmsg()
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+
+
+class ClientConnection:
+
+    def __init__(self, sock, on_slow):
+        self.sock = sock
+        self.on_slow = on_slow
+        self.closed = False
+        self.compress = False  # Client hat per Msg 12 zlib angemeldet (Msg 13)
+        self.sessions = False  # Client hat per Msg 12 Sitzungs-Tokens angemeldet (Msg 10)
+        self.rate_limit = None  # ratelimit.RateLimit, beim ersten Broadcast angelegt
+        self._aborted = False
+        self._queue = collections.deque()
+        self._queued_bytes = 0  # noch nicht gesendete Bytes inkl. des laufenden Batches
+        self._over_since = None
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def send(self, frame):
+        # Gleiche Signatur wie socket.send, blockiert aber nie
+        with self._cond:
+            if self.closed:
+                return 0
+            self._queue.append(frame)
+            self._queued_bytes += len(frame)
+            slow = self._is_slow()
+            self._cond.notify()
+        if slow:
+            self.on_slow(self)
+        return len(frame)
+
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    def close(self):
+        # Bereits eingereihte Frames werden noch (nicht blockierend) gesendet
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def abort(self):
+        # Sofort trennen, Queue verwerfen; weckt auch einen blockierten Leser
+        with self._cond:
+            self.closed = True
+            self._aborted = True
+            self._cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _is_slow(self):
+        # Muss mit self._cond aufgerufen werden
+        if self._queued_bytes <= QUEUE_HIGH_WATER:
+            self._over_since = None
+            return False
+        if self._queued_bytes > QUEUE_LIMIT:
+            return True
+        now = time.monotonic()
+        if self._over_since is None:
+            self._over_since = now
+        return now - self._over_since > SLOW_CLIENT_TIMEOUT
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue and not self.closed:
+                        self._cond.wait()
+                    if self._aborted:
+                        break
+                    closing = self.closed
+                    batch = list(self._queue)
+                    self._queue.clear()
+
+                if batch:
+                    if closing:
+                        # Letzter Versuch ohne zu warten, dann wird geschlossen
+                        self.sock.sendmsg(batch[:_IOV_MAX], [], socket.MSG_DONTWAIT)
+                        break
+                    if not self._send_all(batch):
+                        break
+                    with self._cond:
+                        self._queued_bytes -= sum(len(frame) for frame in batch)
+                        self._is_slow()
+                if closing:
+                    break
+        except OSError:
+            pass  # Verbindung weg, der Leser-Thread räumt den Client auf
+        finally:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def _send_all(self, batch):
+        # Vektorisiert senden; nach einem Teil-Send geht es im angefangenen Frame weiter
+        pending = collections.deque(memoryview(frame) for frame in batch)
+        poller = None
+        while pending:
+            try:
+                sent = self.sock.sendmsg(list(itertools.islice(pending, _IOV_MAX)), [], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                # Sendepuffer im Kernel voll: warten, bis der Client wieder liest
+                if poller is None:
+                    poller = select.poll()
+                    poller.register(self.sock, select.POLLOUT)
+                poller.poll(_POLL_INTERVAL * 1000)
+                with self._cond:
+                    if self._aborted:
+                        return False
+                    slow = self._is_slow()
+                if slow:
+                    self.on_slow(self)
+                    return False
+                continue
+            while sent:
+                head = pending[0]
+                if sent < len(head):
+                    pending[0] = head[sent:]
+                    break
+                sent -= len(head)
+                pending.popleft()
+        return True
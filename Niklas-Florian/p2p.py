@@ -0,0 +1,736 @@
+# p2p.py
+# Peer-to-Peer-Sitzungen des Clients.
+#
+# Ein einziger Thread bedient über selectors alles, was zu P2P gehört: den UDP-Socket
+# (Msg 8), einen dauerhaft offenen TCP-Listener und beliebig viele Peer-Verbindungen
+# (Msg 9). Sitzungen stehen in einer Tabelle nach Peer-Namen; mehrere Chats laufen
+# also gleichzeitig, ohne Thread pro Peer.
+#
+# Ablauf einer Sitzung zwischen A (fragt an) und B:
+#   A -> B  Msg 8 per UDP mit A's TCP-Port und A's Namen
+#   B -> A  TCP-Connect auf diesen Port, erster Frame ist wieder eine Msg 8 mit B's
+#           Namen, damit A die Verbindung der richtigen Sitzung zuordnen kann
+#           (kommt stattdessen gleich Msg 9, wird über die IP zugeordnet)
+#   A <-> B Msg 9 in beide Richtungen
+#
+# Der Handshake blockiert nicht: die Sitzung ist verbunden, sobald B's Verbindung
+# eintrifft. Bleibt sie aus (UDP verliert Pakete), wird die Msg 8 laut README bis zu
+# REQUEST_RETRIES-mal im Abstand von RETRY_INTERVAL wiederholt. Die Zeit von der
+# Anfrage bis zur Verbindung steht danach in session.setup_latency.
+#
+# Dateien (send_file) gehen über dieselbe Verbindung in Stücken von CHUNK_SIZE:
+#   A -> B  Msg 17 bietet die Datei an (Name, Größe, Version = mtime)
+#   B -> A  Msg 18 nimmt sie ab einem Offset an (Fortsetzen) oder Msg 20 lehnt ab
+#   A -> B  Msg 19 pro Stück: Header, danach die Dateidaten per os.sendfile direkt
+#           aus dem Page Cache; zwischen zwei Stücken gehen wartende Msg 9 raus
+# B schreibt in DOWNLOAD_DIR/<name>.part, das vorab in voller Größe angelegt
+# (posix_fallocate) und per mmap eingeblendet wird; recv_into liest die Daten ohne
+# Zwischenpuffer direkt dorthin. Am Ende der .part-Datei stehen Version und Anzahl
+# der empfangenen Bytes. Bricht die Verbindung ab, bleibt sie liegen und ein erneutes
+# send_file derselben, unveränderten Datei macht an dieser Stelle weiter.
+#
+# Alle öffentlichen Methoden sind thread-sicher: sie reihen einen Aufruf ein und
+# wecken die Loop über ein Socket-Paar.
+
+import collections
+import errno
+import itertools
+import mmap
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from codec import (decode_p2p_request, encode_file_accept, encode_file_chunk, encode_file_offer, encode_file_reject,
+                   encode_p2p_message, encode_p2p_request)
+from protocol import FrameDecoder, ProtokollFehler
+
+CONNECTING = 'verbinde'  # TCP-Connect zum Anfragenden läuft
+PENDING = 'angefragt'  # Msg 8 gesendet, Peer hat sich noch nicht verbunden
+CONNECTED = 'verbunden'
+
+REQUEST_RETRIES = 3  # Wiederholungen der Msg 8 ohne Antwort (README)
+RETRY_INTERVAL = 2.0  # Sekunden zwischen zwei Wiederholungen
+
+CHUNK_SIZE = 4 * 1024 * 1024  # Dateidaten pro Msg 19
+PROGRESS_INTERVAL = 1.0  # Sekunden zwischen zwei Fortschrittsmeldungen pro Übertragung
+DOWNLOAD_DIR = 'downloads'
+PROGRESS = struct.Struct('!Q Q')  # Ende der .part-Datei: Version, empfangene Bytes
+
+
+class P2PSession:
+    __slots__ = ('name', 'state', 'sock', 'address', 'initiator', 'decoder', 'outbuf',
+                 'started', 'attempts', 'deadline', 'setup_latency',
+                 'outgoing', 'incoming', 'uploads', 'sending', 'receiving')
+
+    def __init__(self, name, state, address, initiator):
+        self.name = name
+        self.state = state
+        self.sock = None
+        self.address = address  # (ip, udp_port) bei PENDING, sonst TCP-Adresse
+        self.initiator = initiator  # Name dessen, der die Msg 8 gesendet hat
+        self.decoder = FrameDecoder(4096)
+        self.outbuf = bytearray()
+        self.started = time.perf_counter()
+        self.attempts = 0  # gesendete Msg 8 (nur PENDING)
+        self.deadline = None  # nächste Wiederholung bzw. Aufgeben (nur PENDING)
+        self.setup_latency = None  # Sekunden von der Anfrage bis zur Verbindung
+        self.outgoing = {}  # transfer_id -> FileTransfer, von uns angeboten
+        self.incoming = {}  # transfer_id (des Peers) -> FileTransfer, wird empfangen
+        self.uploads = collections.deque()  # angenommene Übertragungen, die gesendet werden
+        self.sending = None  # [transfer, Rest des Msg-19-Headers, Ende] des laufenden Stücks
+        self.receiving = None  # (transfer, Ende) eines Stücks, dessen Daten noch fehlen
+
+
+class FileTransfer:
+    __slots__ = ('id', 'filename', 'path', 'size', 'version', 'receiving', 'offset', 'resumed_from',
+                 'fd', 'map', 'view', 'started', 'reported')
+
+    def __init__(self, transfer_id, filename, path, size, version, receiving):
+        self.id = transfer_id
+        self.filename = filename
+        self.path = path  # Quelle bzw. Ziel (ohne .part)
+        self.size = size
+        self.version = version
+        self.receiving = receiving
+        self.offset = 0  # gesendete bzw. empfangene Bytes
+        self.resumed_from = 0  # Offset aus Msg 18
+        self.fd = None
+        self.map = None  # Empfänger: mmap über Daten und PROGRESS
+        self.view = None
+        self.started = time.perf_counter()
+        self.reported = self.started
+
+    def done(self):
+        return self.offset == self.size
+
+    def rate(self):
+        # Bytes/s seit der Annahme, ohne den fortgesetzten Teil
+        elapsed = time.perf_counter() - self.started
+        return (self.offset - self.resumed_from) / elapsed if elapsed > 0 else 0.0
+
+    def advance(self, n):
+        self.offset += n
+        if self.receiving:
+            PROGRESS.pack_into(self.map, self.size, self.version, self.offset)
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+if hasattr(os, 'sendfile'):
+    def _send_file_data(sock, transfer, count):
+        return os.sendfile(sock.fileno(), transfer.fd, transfer.offset, count)
+else:
+    def _send_file_data(sock, transfer, count):
+        # Ohne sendfile: aus einem mmap der Quelle senden, ebenfalls ohne Kopie in Python
+        if transfer.view is None:
+            transfer.map = mmap.mmap(transfer.fd, transfer.size, access=mmap.ACCESS_READ)
+            transfer.view = memoryview(transfer.map)
+        return sock.send(transfer.view[transfer.offset:transfer.offset + count])
+
+
+def _print_message(name, text):
+    print(f"Nachricht von {name}: {text}")
+
+
+def _print_event(name, event):
+    print(f"P2P {name}: {event}")
+
+
+def _print_progress(name, transfer):
+    rate = transfer.rate() / 1e6
+    if transfer.done():
+        print(f"P2P {name}: {transfer.filename} fertig ({transfer.size} Bytes, {rate:.1f} MB/s)")
+    else:
+        print(f"P2P {name}: {transfer.filename} {transfer.offset * 100 // transfer.size} % ({rate:.1f} MB/s)")
+
+
+class P2PSessionManager:
+
+    def __init__(self, own_name, udp_socket, tcp_port, host='0.0.0.0',
+                 on_message=_print_message, on_event=_print_event, on_progress=_print_progress,
+                 download_dir=DOWNLOAD_DIR):
+        self.own_name = own_name
+        self.udp_socket = udp_socket
+        self.on_message = on_message
+        self.on_event = on_event
+        self.on_progress = on_progress  # (name, FileTransfer), höchstens alle PROGRESS_INTERVAL und am Ende
+        self.download_dir = download_dir
+        self.sessions = {}  # name -> P2PSession
+        self._transfer_ids = itertools.count(1)
+        self._incoming = {}  # angenommene Verbindungen, die sich noch nicht ausgewiesen haben
+        self._calls = collections.deque()
+        self._running = True
+        self.selector = selectors.DefaultSelector()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, tcp_port))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.tcp_port = self.listener.getsockname()[1]
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+        udp_socket.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self._accept)
+        self.selector.register(udp_socket, selectors.EVENT_READ, self._read_udp)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, self._run_calls)
+        self._thread = None
+
+    # Thread-sichere Schnittstelle
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def request(self, name, ip, udp_port):
+        # Chat mit name anfragen (Msg 8 an dessen UDP-Port); kehrt sofort zurück,
+        # on_event meldet die Verbindung oder das Aufgeben
+        self._call(self._request, name, ip, udp_port, time.perf_counter())
+
+    def send(self, name, text):
+        # text als str; wird als Msg 9 gesendet, sobald die Sitzung verbunden ist
+        self._call(self._send, name, encode_p2p_message(text.encode('utf-8')))
+
+    def send_file(self, name, path):
+        # Datei an den verbundenen Peer name anbieten; kehrt sofort zurück, on_progress
+        # meldet den Fortschritt
+        self._call(self._send_file, name, path)
+
+    def close(self, name):
+        self._call(self._close_session, name, "beendet")
+
+    def stop(self):
+        self._call(self._stop)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(2)
+
+    def connected(self):
+        return [name for name, session in list(self.sessions.items()) if session.state == CONNECTED]
+
+    def transfers(self):
+        # (Peer, FileTransfer) aller laufenden Übertragungen in beide Richtungen
+        return [(name, transfer) for name, session in list(self.sessions.items())
+                for transfer in list(session.outgoing.values()) + list(session.incoming.values())]
+
+    def _call(self, fn, *args):
+        self._calls.append((fn, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass  # Loop ist ohnehin schon geweckt
+
+    # Event-Loop
+
+    def run(self):
+        while self._running:
+            for key, events in self.selector.select(self._next_timeout()):
+                key.data(key.fileobj, events)
+            self._check_requests()
+        for session in list(self.sessions.values()):
+            self._drop(session)
+        for sock in list(self._incoming):
+            self._unregister(sock)
+        self.selector.close()
+        self.listener.close()
+
+    def _run_calls(self, sock, events):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            fn, args = self._calls.popleft()
+            fn(*args)
+
+    def _stop(self):
+        self._running = False
+
+    def _request(self, name, ip, udp_port, started):
+        session = self.sessions.get(name)
+        if session is not None and session.state != PENDING:
+            self.on_event(name, "bereits verbunden")
+            return
+        session = P2PSession(name, PENDING, (ip, udp_port), self.own_name)
+        session.started = started
+        self.sessions[name] = session
+        self._send_request(session)
+
+    def _send_request(self, session):
+        session.attempts += 1
+        session.deadline = time.monotonic() + RETRY_INTERVAL
+        try:
+            self.udp_socket.sendto(encode_p2p_request(self.tcp_port, self.own_name), session.address)
+        except OSError as e:
+            self.on_event(session.name, f"Anfrage nicht gesendet ({e})")
+
+    def _next_timeout(self):
+        # Zeit bis zur nächsten fälligen Wiederholung, None = ohne Timeout warten
+        deadlines = [s.deadline for s in self.sessions.values() if s.state == PENDING]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _check_requests(self):
+        now = time.monotonic()
+        for session in [s for s in self.sessions.values() if s.state == PENDING and s.deadline <= now]:
+            if session.attempts > REQUEST_RETRIES:
+                del self.sessions[session.name]
+                self.on_event(session.name, f"keine Antwort nach {session.attempts} Anfragen")
+            else:
+                self._send_request(session)
+
+    def _send(self, name, frame):
+        session = self.sessions.get(name)
+        if session is None or session.state != CONNECTED:
+            self.on_event(name, "keine verbundene Sitzung")
+            return
+        self._write(session, frame)
+
+    # UDP: eingehende Chat-Anfragen
+
+    def _read_udp(self, sock, events):
+        while True:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                return
+            request = decode_p2p_request(data)
+            if request is None:
+                continue
+            tcp_port, name_data = request
+            try:
+                name = str(name_data, 'utf-8')
+            except UnicodeDecodeError:
+                continue
+            self._connect(name, (addr[0], tcp_port))
+
+    def _connect(self, name, address):
+        # Antwort auf eine Msg 8: nicht blockierend zum Anfragenden verbinden
+        session = self.sessions.get(name)
+        if session is not None and session.state in (CONNECTING, CONNECTED) and session.initiator == name:
+            return  # Wiederholte Anfrage derselben Sitzung
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.on_event(name, f"Verbindung fehlgeschlagen ({errno.errorcode.get(err, err)})")
+            return
+        connecting = P2PSession(name, CONNECTING, address, name)
+        connecting.sock = sock
+        # Erster Frame weist uns beim Anfragenden aus
+        connecting.outbuf += encode_p2p_request(self.tcp_port, self.own_name)
+        self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                               lambda s, ev, c=connecting: self._session_io(c, ev))
+        self._adopt(connecting)
+
+    # TCP
+
+    def _accept(self, listener, events):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except BlockingIOError:
+                return
+            except OSError:
+                return
+            sock.setblocking(False)
+            self._incoming[sock] = (addr, FrameDecoder(4096))
+            self.selector.register(sock, selectors.EVENT_READ, self._identify)
+
+    def _identify(self, sock, events):
+        # Erster Frame einer angenommenen Verbindung: zu welcher Sitzung gehört sie?
+        addr, decoder = self._incoming[sock]
+        try:
+            if decoder.recv_from(sock) == 0:
+                self._unregister(sock)
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            self._unregister(sock)
+            return
+        try:
+            first = next(decoder.messages(), None)
+        except ProtokollFehler:
+            self._unregister(sock)
+            return
+        if first is None:
+            return
+        msg_id, payload = first
+        name = None
+        if msg_id == 8:
+            try:
+                name = str(payload[1], 'utf-8')
+            except UnicodeDecodeError:
+                pass
+        elif msg_id == 9:
+            name = self._pending_by_ip(addr[0])
+        if name is None:
+            self._unregister(sock)
+            return
+
+        del self._incoming[sock]
+        session = P2PSession(name, CONNECTED, addr, self.own_name)
+        session.sock = sock
+        session.decoder = decoder
+        pending = self.sessions.get(name)
+        if pending is not None and pending.state == PENDING:
+            session.started = pending.started
+            session.setup_latency = time.perf_counter() - pending.started
+        self.selector.modify(sock, selectors.EVENT_READ, lambda s, ev: self._session_io(session, ev))
+        if not self._adopt(session):
+            return
+        if msg_id == 9:
+            self.on_message(name, str(payload, 'utf-8', 'replace'))
+        self._read_frames(session)
+
+    def _pending_by_ip(self, ip):
+        # Ersatz, wenn der Peer sich nicht per Msg 8 ausweist: älteste Anfrage an diese IP
+        for name, session in self.sessions.items():
+            if session.state == PENDING and session.address[0] == ip:
+                return name
+        return None
+
+    def _adopt(self, session):
+        # Neue Verbindung in die Tabelle; bei zwei Verbindungen zum selben Peer (beide
+        # haben gleichzeitig angefragt) gewinnt auf beiden Seiten die, deren Anfragender
+        # den kleineren Namen hat
+        current = self.sessions.get(session.name)
+        if current is not None and current.sock is not None:
+            winner = min(current.initiator, session.initiator)
+            if current.initiator == winner:
+                self._drop(session)
+                return False
+            self._drop(current)
+        self.sessions[session.name] = session
+        if session.state == CONNECTED:
+            self._report_connected(session)
+        return True
+
+    def _report_connected(self, session):
+        if session.setup_latency is None:
+            session.setup_latency = time.perf_counter() - session.started
+        self.on_event(session.name, f"verbunden nach {session.setup_latency * 1e3:.1f} ms")
+
+    def _session_io(self, session, events):
+        if events & selectors.EVENT_WRITE:
+            if session.state == CONNECTING:
+                err = session.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    self._close_session(session.name, f"Verbindung fehlgeschlagen ({errno.errorcode.get(err, err)})",
+                                        session)
+                    return
+                session.state = CONNECTED
+                self._report_connected(session)
+            self._flush(session)
+        if events & selectors.EVENT_READ and session.sock is not None:
+            try:
+                if session.receiving is not None:
+                    # Dateidaten einer Msg 19: direkt ins mmap, am Decoder vorbei
+                    if self._recv_chunk(session) == 0:
+                        self._close_session(session.name, "vom Peer beendet", session)
+                    return
+                if session.decoder.recv_from(session.sock) == 0:
+                    self._close_session(session.name, "vom Peer beendet", session)
+                    return
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self._close_session(session.name, f"Fehler: {e}", session)
+                return
+            self._read_frames(session)
+
+    def _read_frames(self, session):
+        try:
+            for msg_id, payload in session.decoder.messages():
+                if msg_id == 9:
+                    self.on_message(session.name, str(payload, 'utf-8', 'replace'))
+                elif msg_id == 19:
+                    self._chunk_started(session, *payload)
+                elif msg_id == 17:
+                    self._file_offered(session, *payload)
+                elif msg_id == 18:
+                    self._file_accepted(session, *payload)
+                elif msg_id == 20:
+                    self._file_rejected(session, *payload)
+                if session.sock is None:
+                    return  # Sitzung wurde dabei geschlossen
+        except ProtokollFehler as e:
+            self._close_session(session.name, f"Protokollfehler: {e}", session)
+
+    # Dateien senden
+
+    def _send_file(self, name, path):
+        session = self.sessions.get(name)
+        if session is None or session.state != CONNECTED:
+            self.on_event(name, "keine verbundene Sitzung")
+            return
+        filename = os.path.basename(path)
+        if not filename or len(filename.encode('utf-8')) > 255:
+            self.on_event(name, f"ungültiger Dateiname {filename!r}")
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            self.on_event(name, f"Datei nicht lesbar ({e})")
+            return
+        info = os.fstat(fd)
+        transfer = FileTransfer(next(self._transfer_ids), filename, path, info.st_size, info.st_mtime_ns, False)
+        transfer.fd = fd
+        session.outgoing[transfer.id] = transfer
+        self._write(session, encode_file_offer(transfer.id, transfer.size, transfer.version, filename))
+
+    def _file_accepted(self, session, transfer_id, offset):  # Msg 18
+        transfer = session.outgoing.get(transfer_id)
+        if transfer is None or transfer in session.uploads:
+            return
+        if offset > transfer.size:
+            raise ProtokollFehler(0, f"Msg 18 mit Offset {offset} hinter dem Dateiende")
+        if offset:
+            self.on_event(session.name, f"{transfer.filename} wird ab Byte {offset} fortgesetzt")
+        transfer.offset = transfer.resumed_from = offset
+        transfer.started = transfer.reported = time.perf_counter()
+        if transfer.done():
+            self._finish_upload(session, transfer)
+            return
+        session.uploads.append(transfer)
+        if session.sending is None and not session.outbuf:
+            self._flush(session)
+
+    def _file_rejected(self, session, transfer_id):  # Msg 20
+        transfer = session.outgoing.get(transfer_id)
+        if transfer is None or transfer in session.uploads:
+            return
+        del session.outgoing[transfer_id]
+        transfer.close()
+        self.on_event(session.name, f"{transfer.filename} abgelehnt")
+
+    def _next_chunk(self, session):
+        transfer = session.uploads[0]
+        length = min(CHUNK_SIZE, transfer.size - transfer.offset)
+        session.sending = [transfer, encode_file_chunk(transfer.id, transfer.offset, length), transfer.offset + length]
+
+    def _send_chunk(self, session):
+        # Header und Daten des laufenden Stücks; BlockingIOError, solange der Socket voll ist
+        transfer, header, end = session.sending
+        sock = session.sock
+        while header:
+            header = header[sock.send(header):]
+            session.sending[1] = header
+        while transfer.offset < end:
+            sent = _send_file_data(sock, transfer, end - transfer.offset)
+            if sent == 0:
+                raise OSError(f"{transfer.filename} ist während des Sendens kürzer geworden")
+            transfer.advance(sent)
+        session.sending = None
+        if transfer.done():
+            session.uploads.popleft()
+            self._finish_upload(session, transfer)
+        else:
+            self._report_progress(session, transfer)
+
+    def _finish_upload(self, session, transfer):
+        del session.outgoing[transfer.id]
+        transfer.close()
+        self.on_progress(session.name, transfer)
+
+    # Dateien empfangen
+
+    def _file_offered(self, session, transfer_id, size, version, name_data):  # Msg 17
+        try:
+            filename = str(name_data, 'utf-8')
+        except UnicodeDecodeError:
+            filename = ''
+        # Nur der Dateiname zählt, Pfade des Peers landen nie außerhalb von download_dir
+        filename = os.path.basename(filename.replace('\\', '/'))
+        if filename in ('', '.', '..') or '\0' in filename or transfer_id in session.incoming:
+            self._write(session, encode_file_reject(transfer_id))
+            self.on_event(session.name, f"Datei {filename!r} abgelehnt")
+            return
+        transfer = FileTransfer(transfer_id, filename, os.path.join(self.download_dir, filename), size, version, True)
+        if any(other.path == transfer.path for other in self._downloads()):
+            self._write(session, encode_file_reject(transfer_id))
+            self.on_event(session.name, f"Datei {filename} wird bereits empfangen")
+            return
+        try:
+            self._open_part(transfer)
+        except OSError as e:
+            transfer.close()
+            self._write(session, encode_file_reject(transfer_id))
+            self.on_event(session.name, f"Datei {filename} abgelehnt ({e})")
+            return
+        session.incoming[transfer_id] = transfer
+        self._write(session, encode_file_accept(transfer_id, transfer.offset))
+        if transfer.offset:
+            self.on_event(session.name, f"{filename} wird ab Byte {transfer.offset} fortgesetzt")
+        if transfer.done():
+            self._finish_download(session, transfer)
+
+    def _downloads(self):
+        return [transfer for session in self.sessions.values() for transfer in session.incoming.values()]
+
+    def _open_part(self, transfer):
+        # .part-Datei anlegen bzw. mit passender Version und Größe weiterverwenden
+        os.makedirs(self.download_dir, exist_ok=True)
+        total = transfer.size + PROGRESS.size
+        transfer.fd = fd = os.open(transfer.path + '.part', os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size == total:
+            transfer.map = mmap.mmap(fd, total)
+            version, received = PROGRESS.unpack_from(transfer.map, transfer.size)
+            if version == transfer.version and received <= transfer.size:
+                transfer.offset = transfer.resumed_from = received
+                transfer.view = memoryview(transfer.map)
+                return
+            transfer.map.close()
+            transfer.map = None
+        os.ftruncate(fd, 0)
+        try:
+            # Platz wirklich reservieren: ein volles Dateisystem wäre beim Schreiben
+            # ins mmap sonst ein SIGBUS statt einer Ablehnung hier
+            os.posix_fallocate(fd, 0, total)
+        except AttributeError:
+            os.ftruncate(fd, total)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            os.ftruncate(fd, total)
+        transfer.map = mmap.mmap(fd, total)
+        transfer.view = memoryview(transfer.map)
+        PROGRESS.pack_into(transfer.map, transfer.size, transfer.version, 0)
+
+    def _chunk_started(self, session, transfer_id, offset, data_len):  # Msg 19
+        transfer = session.incoming.get(transfer_id)
+        end = offset + data_len
+        if transfer is None or offset != transfer.offset or end > transfer.size:
+            raise ProtokollFehler(0, f"Msg 19 passt zu keiner Übertragung (ID {transfer_id}, Offset {offset})")
+        # Was schon im Lesepuffer steht, kopieren; der Rest kommt per recv_into
+        transfer.advance(session.decoder.take_raw(transfer.view[offset:end]))
+        if transfer.offset < end:
+            session.receiving = (transfer, end)
+        else:
+            self._chunk_received(session, transfer)
+
+    def _recv_chunk(self, session):
+        transfer, end = session.receiving
+        nbytes = session.sock.recv_into(transfer.view[transfer.offset:end])
+        if nbytes:
+            transfer.advance(nbytes)
+            if transfer.offset == end:
+                session.receiving = None
+                self._chunk_received(session, transfer)
+        return nbytes
+
+    def _chunk_received(self, session, transfer):
+        if transfer.done():
+            self._finish_download(session, transfer)
+        else:
+            self._report_progress(session, transfer)
+
+    def _finish_download(self, session, transfer):
+        del session.incoming[transfer.id]
+        transfer.close()
+        try:
+            os.truncate(transfer.path + '.part', transfer.size)  # PROGRESS abschneiden
+            os.replace(transfer.path + '.part', transfer.path)
+        except OSError as e:
+            self.on_event(session.name, f"{transfer.filename} nicht gespeichert ({e})")
+            return
+        self.on_progress(session.name, transfer)
+
+    def _report_progress(self, session, transfer):
+        now = time.perf_counter()
+        if now - transfer.reported >= PROGRESS_INTERVAL:
+            transfer.reported = now
+            self.on_progress(session.name, transfer)
+
+    def _write(self, session, frame):
+        if not session.outbuf and session.sending is None and session.state == CONNECTED:
+            try:
+                sent = session.sock.send(frame)
+            except BlockingIOError:
+                sent = 0
+            except OSError as e:
+                self._close_session(session.name, f"Fehler: {e}", session)
+                return
+            if sent == len(frame):
+                return
+            frame = frame[sent:]
+        session.outbuf += frame
+        self.selector.modify(session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                             self.selector.get_key(session.sock).data)
+
+    def _flush(self, session):
+        # Erst ein angefangenes Stück (Msg 19), dann outbuf, dann das nächste Stück
+        try:
+            while True:
+                if session.sending is not None:
+                    self._send_chunk(session)
+                if session.outbuf:
+                    sent = session.sock.send(session.outbuf)
+                    del session.outbuf[:sent]
+                    if session.outbuf:
+                        break
+                if not session.uploads:
+                    self.selector.modify(session.sock, selectors.EVENT_READ, self.selector.get_key(session.sock).data)
+                    return
+                self._next_chunk(session)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._close_session(session.name, f"Fehler: {e}", session)
+            return
+        self.selector.modify(session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                             self.selector.get_key(session.sock).data)
+
+    def _close_session(self, name, reason, session=None):
+        current = self.sessions.get(name)
+        if session is None:
+            session = current
+        if session is None:
+            return
+        if current is session:
+            del self.sessions[name]
+            self.on_event(name, reason)
+        self._drop(session)
+
+    def _drop(self, session):
+        if session.sock is not None:
+            self._unregister(session.sock)
+            session.sock = None
+        # Abgebrochene Übertragungen: die .part-Datei bleibt für ein erneutes send_file
+        for transfer in list(session.outgoing.values()) + list(session.incoming.values()):
+            transfer.close()
+            if transfer.size:
+                self.on_event(session.name, f"{transfer.filename} bei {transfer.offset * 100 // transfer.size} % "
+                                            f"unterbrochen")
+        session.outgoing.clear()
+        session.incoming.clear()
+        session.uploads.clear()
+        session.sending = session.receiving = None
+
+    def _unregister(self, sock):
+        self._incoming.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
@@ -0,0 +1,295 @@
+# profiling.py
+# Profiling auf Abruf im laufenden Server, ohne Neustart und ohne Clients zu trennen.
+#
+# Ein Profil-Fenster wird per SIGUSR1 (an/aus) oder über den Admin-Port
+# (--admin-port, nur 127.0.0.1) gestartet und endet nach der angegebenen Zeit oder
+# mit "stop". Während des Fensters laufen:
+#
+#   cpu       cProfile in jedem Thread, der Nachrichten verarbeitet (Lese-Threads
+#             der thread-Engine bzw. die Loop der asyncio-Engine). cProfile wirkt
+#             nur im Thread, der enable() aufruft; jeder Thread schaltet es darum
+#             bei seiner nächsten Nachricht selbst ein und nach dem Fenster wieder aus.
+#   memory    tracemalloc; am Ende die Zeilen, deren Allokationen aus dem Fenster
+#             noch leben, dazu der Spitzenwert.
+#   handlers  Laufzeit jedes Aufrufs der Handler aus MSG_HANDLERS_Server.
+#
+# Ergebnisse landen in --profile-dir als profile-<pid>-<zeit>.pstats (für pstats
+# bzw. snakeviz) und .txt, tracemalloc-<pid>-<zeit>.txt und handlers-<pid>-<zeit>.json.
+# Ohne Fenster kostet es pro Nachricht zwei Attribut-Abfragen in handel_msg.
+#
+#   python profiling.py --port 7790 start 30
+#   python profiling.py --port 7790 stop
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import socket
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+
+PROFILE_SECONDS = 30.0  # Standardlänge eines Fensters
+PROFILE_DIR = '.'
+TRACEMALLOC_FRAMES = 10  # Stack-Tiefe pro Allokation; mehr kostet während des Fensters spürbar
+TOP_LINES = 40  # Zeilen in den .txt-Auswertungen
+
+KINDS = ('cpu', 'memory', 'handlers')
+
+
+class _Snapshot:
+    # Von snapshot_stats() eingesammelte Daten für pstats.Stats.add(), ohne dass
+    # pstats create_stats() (und damit disable() im falschen Thread) aufruft
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class _Window:
+
+    def __init__(self, seconds, kinds, handlers):
+        self.seconds = seconds
+        self.kinds = kinds
+        self.started = time.time()
+        self.profiles = []  # (thread, cProfile.Profile)
+        self.samples = {msg_id: [] for msg_id in handlers}  # msg_id -> Laufzeiten in s
+        self.timer = None
+        self.tracemalloc = False  # tracemalloc für dieses Fenster gestartet
+
+
+class Profiler:
+
+    def __init__(self, handlers):
+        self.handlers = handlers  # msg_id -> Handler, für die Namen in der Auswertung
+        self.directory = PROFILE_DIR
+        self.active = False  # Fenster läuft; in handel_msg abgefragt
+        self.check = False  # active oder es laufen noch Profiles aus einem beendeten Fenster
+        self._window = None
+        self._lingering = set()  # Threads, deren cProfile noch an ist
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def status(self):
+        window = self._window
+        if window is None:
+            return "aus"
+        return (f"läuft seit {time.time() - window.started:.1f} s von {window.seconds:g} s "
+                f"({', '.join(window.kinds)}, {len(window.profiles)} Threads)")
+
+    def start(self, seconds=None, kinds=KINDS):
+        seconds = PROFILE_SECONDS if seconds is None else seconds
+        with self._lock:
+            if self._window is not None:
+                return f"Profil läuft bereits: {self.status()}"
+            window = self._window = _Window(seconds, tuple(kinds), self.handlers)
+            if 'memory' in kinds and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                window.tracemalloc = True
+            window.timer = threading.Timer(seconds, self.stop)
+            window.timer.daemon = True
+            window.timer.start()
+            self.active = self.check = True
+        print(f"Profil gestartet für {seconds:g} s ({', '.join(kinds)})")
+        return f"gestartet für {seconds:g} s"
+
+    def stop(self):
+        # Beendet das Fenster und schreibt die Dateien; gibt die Pfade zurück
+        with self._lock:
+            window = self._window
+            if window is None:
+                return []
+            self._window = None
+            self.active = False
+            window.timer.cancel()
+            self._lingering = {thread for thread in self._lingering if thread.is_alive()}
+            for thread, _ in window.profiles:
+                self._lingering.add(thread)
+            self.check = bool(self._lingering)
+            snapshot = traced = None
+            if window.tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                traced = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        paths = self._dump(window, snapshot, traced)
+        print(f"Profil geschrieben: {', '.join(paths)}")
+        return paths
+
+    def toggle(self):
+        # SIGUSR1: an mit PROFILE_SECONDS bzw. vorzeitig aus
+        if self._window is None:
+            self.start()
+        else:
+            self.stop()
+
+    # Aufrufe aus handel_msg
+
+    def enter_thread(self):
+        # Nur bei check: cProfile dieses Threads passend zum Fenster an- bzw. abschalten
+        local = self._local
+        profile = getattr(local, 'profile', None)
+        window = self._window
+        if profile is not None and local.window is not window:
+            profile.disable()  # Fenster ist vorbei
+            local.profile = profile = None
+            with self._lock:
+                self._lingering.discard(threading.current_thread())
+                self.check = self.active or bool(self._lingering)
+        if profile is None and window is not None and 'cpu' in window.kinds:
+            profile = cProfile.Profile()
+            with self._lock:
+                if window is not self._window:
+                    return
+                window.profiles.append((threading.current_thread(), profile))
+            local.profile, local.window = profile, window
+            profile.enable()
+
+    def leave_thread(self):
+        # Thread endet (Client weg): eigenes cProfile abschalten
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.disable()
+            self._local.profile = None
+            with self._lock:
+                self._lingering.discard(threading.current_thread())
+                self.check = self.active or bool(self._lingering)
+
+    def record(self, msg_id, seconds):
+        window = self._window
+        if window is not None and 'handlers' in window.kinds:
+            samples = window.samples.get(msg_id)
+            if samples is not None:
+                samples.append(seconds)
+
+    # Auswertung
+
+    def _dump(self, window, snapshot, traced):
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"{{}}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        paths = []
+        if window.profiles:
+            stats = None
+            for _, profile in window.profiles:
+                # Fremde Profiles laufen evtl. noch: nur die Daten lesen, abschalten tut
+                # jeder Thread selbst
+                profile.snapshot_stats()
+                if stats is None:
+                    stats = pstats.Stats(_Snapshot(profile.stats))
+                else:
+                    stats.add(_Snapshot(profile.stats))
+            path = prefix.format('profile') + '.pstats'
+            stats.dump_stats(path)
+            paths.append(path)
+            text = io.StringIO()
+            stats.stream = text
+            text.write(f"{len(window.profiles)} Threads, {time.time() - window.started:.1f} s\n")
+            stats.sort_stats('cumulative').print_stats(TOP_LINES)
+            stats.sort_stats('tottime').print_stats(TOP_LINES)
+            paths.append(self._write(prefix.format('profile') + '.txt', text.getvalue()))
+        if snapshot is not None:
+            current, peak = traced
+            lines = [f"Aktuell belegt: {current / 1024:.1f} KiB, Spitze: {peak / 1024:.1f} KiB "
+                     f"(nur Allokationen seit Beginn des Fensters)", ""]
+            for stat in snapshot.statistics('lineno')[:TOP_LINES]:
+                lines.append(str(stat))
+            lines.append("")
+            lines.append("Nach Aufrufpfad:")
+            for stat in snapshot.statistics('traceback')[:5]:
+                lines.append(f"{stat.size / 1024:.1f} KiB in {stat.count} Blöcken")
+                lines.extend('    ' + line for line in stat.traceback.format())
+            paths.append(self._write(prefix.format('tracemalloc') + '.txt', '\n'.join(lines) + '\n'))
+        if 'handlers' in window.kinds:
+            rows = []
+            for msg_id, samples in sorted(window.samples.items()):
+                if not samples:
+                    continue
+                samples = sorted(samples)
+                rows.append({
+                    'msg_id': msg_id,
+                    'handler': self.handlers[msg_id].__name__,
+                    'calls': len(samples),
+                    'total_ms': round(sum(samples) * 1e3, 3),
+                    'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+                    'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 1),
+                    'max_us': round(samples[-1] * 1e6, 1),
+                })
+            report = {'pid': os.getpid(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(window.started)),
+                      'seconds': round(time.time() - window.started, 3), 'handlers': rows}
+            paths.append(self._write(prefix.format('handlers') + '.json', json.dumps(report, indent=2) + '\n'))
+        return paths
+
+    @staticmethod
+    def _write(path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+
+def start_admin_server(profiler, host, port):
+    # Zeilenbasierte Steuerung in einem eigenen Daemon-Thread:
+    #   start [sekunden] [cpu] [memory] [handlers]  |  stop  |  status
+    class AdminHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                words = line.decode('utf-8', 'replace').split()
+                if not words:
+                    continue
+                try:
+                    answer = command(words)
+                except (ValueError, OSError) as e:
+                    answer = f"Fehler: {e}"
+                self.wfile.write(answer.encode('utf-8') + b'\n')
+
+    def command(words):
+        if words[0] == 'start':
+            seconds = None
+            kinds = []
+            for word in words[1:]:
+                if word in KINDS:
+                    kinds.append(word)
+                else:
+                    seconds = float(word)
+            return profiler.start(seconds, kinds or KINDS)
+        if words[0] == 'stop':
+            paths = profiler.stop()
+            return ' '.join(paths) if paths else "kein Profil aktiv"
+        if words[0] == 'status':
+            return profiler.status()
+        return "Befehle: start [sekunden] [cpu] [memory] [handlers], stop, status"
+
+    class AdminServer(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    admin = AdminServer((host, port), AdminHandler)
+    threading.Thread(target=admin.serve_forever, daemon=True).start()
+    return admin
+
+
+def main():
+    # Kleiner Client für den Admin-Port, falls kein nc zur Hand ist
+    parser = argparse.ArgumentParser(description='Profiling des laufenden Chat-Servers steuern')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Adresse des Admin-Ports (Standard: 127.0.0.1)')
+    parser.add_argument('--port', type=int, required=True, help='--admin-port des Servers')
+    parser.add_argument('command', nargs='+', help='start [sekunden] [cpu] [memory] [handlers] | stop | status')
+    args = parser.parse_args()
+
+    with socket.create_connection((args.host, args.port)) as sock:
+        sock.sendall(' '.join(args.command).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        answer = b''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            answer += data
+    sys.stdout.write(answer.decode('utf-8', 'replace'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
 # constants.py
 
+import zlib
+
+from codec import (BROADCAST, CHANNEL_MESSAGE, CLIENT_INFO, COMPRESSED, FILE_ACCEPT, FILE_CHUNK, FILE_OFFER, FILE_REJECT,
+                   P2P_REQUEST, ROSTER_HEADER, SESSION)
 
 MESSAGE_TYPES = (
     (0, "Fehler"),
@@ -10,7 +14,18 @@ MESSAGE_TYPES = (
     (6, "Broadcast"),
     (7, "Client Disconnect Message"),
     (8, "Peer-To-Peer Chat Anfrage"),
-    (9, "Peer-To-Peer Nachricht")
+    (9, "Peer-To-Peer Nachricht"),
+    (10, "Sitzungs-Token"),
+    (11, "Sitzung fortsetzen"),
+    (12, "Fähigkeiten"),
+    (13, "Komprimierte Frames"),
+    (14, "Channel beitreten"),
+    (15, "Channel verlassen"),
+    (16, "Channel-Nachricht"),
+    (17, "Peer-To-Peer Datei anbieten"),
+    (18, "Peer-To-Peer Datei annehmen"),
+    (19, "Peer-To-Peer Dateidaten"),
+    (20, "Peer-To-Peer Datei abgelehnt")
 )
 
 ERROR_CODES = (
@@ -19,5 +34,366 @@ ERROR_CODES = (
     (2, "Nickname nicht unique"),
     (3, "Länge vom Nickname > 0"),
     (4, "Name invalid UTF-8"),
-    (5, "Client Liste invalid")
+    (5, "Client Liste invalid"),
+    (6, "Sitzung unbekannt"),
+    (7, "Komprimierte Daten invalid"),
+    (8, "Rate-Limit überschritten"),
+    (9, "Zu viele Channels"),
+    (10, "Nicht im Channel"),
+    (11, "Bereits registriert")
 )
+
+
+MSG_IDS = frozenset(msg_id for msg_id, _ in MESSAGE_TYPES)
+
+MAX_INFLATED = 16 * 1024 * 1024  # Höchstgröße einer entpackten Msg 13
+
+
+class ProtokollFehler(Exception):
+    # Nicht parsebarer Datenstrom; error_code entspricht ERROR_CODES
+    def __init__(self, error_code, message):
+        super().__init__(message)
+        self.error_code = error_code
+
+
+class FrameDecoder:
+    # Inkrementeller Parser für den TCP-Datenstrom (Msg-IDs aus MESSAGE_TYPES).
+    #
+    # Es wird in großen Stücken direkt in einen wiederverwendeten bytearray gelesen
+    # (recv_into), angefangene Nachrichten bleiben zwischen zwei Reads im Puffer.
+    # messages() liefert alle vollständigen Nachrichten als (msg_id, payload):
+    #   0: error_code          1/4: (ip, udp_port, name)    2: [(ip, udp_port, name), ...]
+    #   5: name                6/9: text                    7: None
+    #   8: (tcp_port, name)      10/11: (token, roster_version)    12: flags
+    #   14/15: channel           16: (channel, text)
+    #   17: (transfer_id, size, version, name)    18: (transfer_id, offset)
+    #   19: (transfer_id, offset, data_len)        20: (transfer_id,)
+    # ip, name und text sind bytes; das Dekodieren (EC 4) übernimmt der Aufrufer.
+    # Von Msg 19 wird nur der Header geliefert: die data_len Bytes Dateidaten danach
+    # holt der Aufrufer selbst, erst per take_raw() aus dem Puffer und den Rest direkt
+    # vom Socket, bevor messages() weiterläuft.
+    # Msg 13 taucht nicht auf: sie wird entpackt und die enthaltenen Frames werden
+    # an ihrer Stelle geliefert.
+    # Msg 2 wird eintragsweise konsumiert, eine große Client-Liste muss also nie
+    # komplett im Puffer liegen. Mit roster=ClientList (clientlist.py) landen die
+    # Einträge ohne Zwischenliste direkt dort, payload von Msg 2 ist dann die Liste.
+    #
+    # Mit zero_copy=True sind name und text memoryviews direkt in den Lesepuffer statt
+    # Kopien. Sie gelten nur, bis messages() weiterläuft, und dürfen nicht
+    # aufbewahrt werden (str(name, 'utf-8') erzeugt bei Bedarf eine eigene Kopie).
+
+    def __init__(self, chunk_size=65536, zero_copy=False, roster=None):
+        self.chunk_size = chunk_size
+        self.zero_copy = zero_copy
+        self.roster = roster
+        self._buf = bytearray(chunk_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # erstes noch nicht geparstes Byte
+        self._end = 0  # Ende der empfangenen Daten
+        self._roster = None  # angefangene Msg 2: [fehlende Einträge, Einträge bzw. None mit roster]
+        self._inflated = None  # FrameDecoder für den Inhalt von Msg 13
+        self._nested = False  # Inhalt einer Msg 13: keine weitere Msg 13 erlaubt
+        self.last_frame_size = 0
+
+    def buffered(self):
+        # Noch nicht gelieferte Bytes, einschließlich entpackter Frames einer Msg 13
+        pending = self._end - self._start
+        if self._inflated is not None:
+            pending += self._inflated.buffered()
+        return pending
+
+    def pending_msg_id(self):
+        # Msg-ID einer angefangenen Nachricht im Puffer, None wenn keine
+        if self._roster is not None:
+            return 2
+        if self._start == self._end:
+            return None
+        return self._buf[self._start]
+
+    def take_raw(self, out):
+        # Bis zu len(out) bereits empfangene Bytes ungeparst nach out kopieren (Daten
+        # von Msg 19), gibt die Anzahl zurück
+        n = min(len(out), self._end - self._start)
+        out[:n] = self._view[self._start:self._start + n]
+        self._start += n
+        return n
+
+    def get_buffer(self):
+        # Freier Bereich hinter den empfangenen Daten; schiebt Reste nach vorne
+        # bzw. vergrößert den Puffer nur, wenn zu wenig Platz übrig ist.
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self.chunk_size:
+                # Nach einer großen Nachricht wieder auf die Grundgröße schrumpfen
+                self._resize(self.chunk_size)
+        free = len(self._buf) - self._end
+        if free < self.chunk_size // 4:
+            pending = self._end - self._start
+            if self._start:
+                self._buf[:pending] = self._buf[self._start:self._end]
+                self._start, self._end = 0, pending
+            if len(self._buf) - self._end < self.chunk_size // 4:
+                self._resize(len(self._buf) * 2)
+        return self._view[self._end:]
+
+    def _resize(self, size):
+        # Neuer Puffer statt extend()/del: mit zero_copy können noch Payload-Views in
+        # den alten zeigen (z.B. die Schleifenvariable des Aufrufers), und ein
+        # bytearray mit Exporten lässt sich nicht in der Größe ändern
+        pending = self._end - self._start
+        buf = bytearray(size)
+        buf[:pending] = self._view[self._start:self._end]
+        self._buf, self._view = buf, memoryview(buf)
+        self._start, self._end = 0, pending
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def recv_from(self, sock):
+        # Ein recv-Syscall; 0 bedeutet Verbindung geschlossen
+        nbytes = sock.recv_into(self.get_buffer())
+        self._end += nbytes
+        return nbytes
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            with self.get_buffer() as free:
+                n = min(len(free), len(data))
+                free[:n] = data[:n]
+            self._end += n
+            data = data[n:]
+
+    def messages(self):
+        # Die häufigen Nachrichten (Msg 6/9 und die kurzen Msg 0/1/4/5/8) werden direkt
+        # hier geparst, alle anderen über _next_message(); der Umweg kostet pro
+        # Nachricht mehr als das Parsen selbst (benchmark.py codec). Puffer und View
+        # ändern sich erst im nächsten get_buffer().
+        if self._inflated is not None and self._inflated.buffered():
+            # Rest einer Msg 13 aus einem abgebrochenen Durchlauf (FAIR_QUOTA) zuerst
+            yield from self._drain_inflated()
+        buf, view, zero_copy = self._buf, self._view, self.zero_copy
+        unpack_client_info, unpack_p2p_request = CLIENT_INFO.unpack_from, P2P_REQUEST.unpack_from
+        while True:
+            start, end = self._start, self._end
+            if self._roster is None and end - start >= 2:
+                # Ist schon der Header unvollständig, fehlt auch der Rest: return
+                msg_id = buf[start]
+                if msg_id == 6 or msg_id == 9:
+                    if end - start < 3:
+                        return
+                    stop = start + 3 + (buf[start + 1] << 8 | buf[start + 2])
+                    if stop > end:
+                        return
+                    self._start = stop
+                    self.last_frame_size = stop - start
+                    text = view[start + 3:stop]
+                    yield msg_id, text if zero_copy else bytes(text)
+                    continue
+                if msg_id == 5:
+                    stop = start + 2 + buf[start + 1]
+                    if stop > end:
+                        return
+                    self._start = stop
+                    self.last_frame_size = stop - start
+                    name = view[start + 2:stop]
+                    yield 5, name if zero_copy else bytes(name)
+                    continue
+                if msg_id == 1 or msg_id == 4:
+                    if end - start < 8:
+                        return
+                    stop = start + 8 + buf[start + 7]
+                    if stop > end:
+                        return
+                    ip, udp_port, _ = unpack_client_info(buf, start + 1)
+                    self._start = stop
+                    self.last_frame_size = stop - start
+                    name = view[start + 8:stop]
+                    yield msg_id, (ip, udp_port, name if zero_copy else bytes(name))
+                    continue
+                if msg_id == 8:
+                    if end - start < 4:
+                        return
+                    stop = start + 4 + buf[start + 3]
+                    if stop > end:
+                        return
+                    _, tcp_port, _ = unpack_p2p_request(buf, start)
+                    self._start = stop
+                    self.last_frame_size = stop - start
+                    name = view[start + 4:stop]
+                    yield 8, (tcp_port, name if zero_copy else bytes(name))
+                    continue
+                if msg_id == 0:
+                    self._start = start + 2
+                    self.last_frame_size = 2
+                    yield 0, buf[start + 1]
+                    continue
+            msg = self._next_message()
+            if msg is None:
+                return
+            # Größe der gerade gelieferten Nachricht (bei Msg 2 nur der letzte Teil)
+            self.last_frame_size = self._start - start
+            if msg[0] == 13:
+                yield from self._inflate(msg[1])
+                continue
+            yield msg
+
+    def _inflate(self, data):
+        if self._nested:
+            raise ProtokollFehler(7, "Verschachtelte Msg 13")
+        inflater = zlib.decompressobj()
+        try:
+            frames = inflater.decompress(data, MAX_INFLATED)
+        except zlib.error as e:
+            raise ProtokollFehler(7, f"Msg 13 nicht entpackbar: {e}")
+        if inflater.unconsumed_tail or not inflater.eof:
+            raise ProtokollFehler(7, "Msg 13 unvollständig oder zu groß")
+        if self._inflated is None:
+            self._inflated = FrameDecoder(self.chunk_size, self.zero_copy, self.roster)
+            self._inflated._nested = True
+        self._inflated.feed(frames)
+        yield from self._drain_inflated()
+
+    def _drain_inflated(self):
+        # Bricht der Aufrufer messages() ab, bleiben die restlichen Frames im inneren
+        # Decoder und kommen beim nächsten messages() vor allem anderen
+        yield from self._inflated.messages()
+        if self._inflated.buffered():
+            raise ProtokollFehler(7, "Msg 13 endet mitten in einem Frame")
+
+    def _take(self, n):
+        data = self._view[self._start:self._start + n]
+        self._start += n
+        return data if self.zero_copy else bytes(data)
+
+    def _client_info(self, offset):
+        # ClientInfo ab offset; None wenn noch unvollständig
+        end = self._end
+        if end - offset < CLIENT_INFO.size:
+            return None
+        ip, udp_port, name_len = CLIENT_INFO.unpack_from(self._buf, offset)
+        size = CLIENT_INFO.size + name_len
+        if end - offset < size:
+            return None
+        name = self._view[offset + CLIENT_INFO.size:offset + size]
+        return size, (ip, udp_port, name if self.zero_copy else bytes(name))
+
+    def _next_message(self):
+        if self._roster is not None:
+            return self._continue_roster()
+
+        start, available = self._start, self._end - self._start
+        if available < 1:
+            return None
+        msg_id = self._buf[start]
+
+        if msg_id == 0:
+            if available < 2:
+                return None
+            self._start += 2
+            return 0, self._buf[start + 1]
+        if msg_id in (1, 4):
+            info = self._client_info(start + 1)
+            if info is None:
+                return None
+            size, entry = info
+            self._start += 1 + size
+            return msg_id, entry
+        if msg_id == 2:
+            if available < ROSTER_HEADER.size:
+                return None
+            count = ROSTER_HEADER.unpack_from(self._buf, start)[1]
+            self._start += ROSTER_HEADER.size
+            if self.roster is not None:
+                self.roster.clear()  # Msg 2 ersetzt die komplette Liste
+                self._roster = [count, None]
+            else:
+                self._roster = [count, []]
+            return self._continue_roster()
+        if msg_id in (5, 14, 15):
+            if available < 2 or available - 2 < self._buf[start + 1]:  # Msg 14/15 wie Msg 5
+                return None
+            name_len = self._buf[start + 1]
+            self._start += 2
+            return msg_id, self._take(name_len)
+        if msg_id in (6, 9):
+            if available < BROADCAST.size:  # Msg 9 hat denselben Header
+                return None
+            msg_len = BROADCAST.unpack_from(self._buf, start)[1]
+            if available - BROADCAST.size < msg_len:
+                return None
+            self._start += BROADCAST.size
+            return msg_id, self._take(msg_len)
+        if msg_id == 7:
+            self._start += 1
+            return 7, None
+        if msg_id == 8:
+            if available < P2P_REQUEST.size or available - P2P_REQUEST.size < self._buf[start + 3]:
+                return None
+            _, tcp_port, name_len = P2P_REQUEST.unpack_from(self._buf, start)
+            self._start += P2P_REQUEST.size
+            return 8, (tcp_port, self._take(name_len))
+        if msg_id in (10, 11):
+            if available < SESSION.size:
+                return None
+            _, token, version = SESSION.unpack_from(self._buf, start)
+            self._start += SESSION.size
+            return msg_id, (token, version)
+        if msg_id == 12:
+            if available < 2:
+                return None
+            self._start += 2
+            return 12, self._buf[start + 1]
+        if msg_id == 13:
+            if available < COMPRESSED.size:
+                return None
+            data_len = COMPRESSED.unpack_from(self._buf, start)[1]
+            if data_len > MAX_INFLATED:
+                raise ProtokollFehler(7, f"Msg 13 mit {data_len} Bytes zu groß")
+            if available - COMPRESSED.size < data_len:
+                return None
+            self._start += COMPRESSED.size
+            return 13, self._take(data_len)
+        if msg_id == 16:
+            if available < CHANNEL_MESSAGE.size:
+                return None
+            _, channel_len, msg_len = CHANNEL_MESSAGE.unpack_from(self._buf, start)
+            if available - CHANNEL_MESSAGE.size < channel_len + msg_len:
+                return None
+            self._start += CHANNEL_MESSAGE.size
+            channel = self._take(channel_len)
+            return 16, (channel, self._take(msg_len))
+        if msg_id == 17:
+            if available < FILE_OFFER.size or available - FILE_OFFER.size < self._buf[start + FILE_OFFER.size - 1]:
+                return None
+            _, transfer_id, size, version, name_len = FILE_OFFER.unpack_from(self._buf, start)
+            self._start += FILE_OFFER.size
+            return 17, (transfer_id, size, version, self._take(name_len))
+        if msg_id in (18, 19, 20):
+            header = (FILE_ACCEPT, FILE_CHUNK, FILE_REJECT)[msg_id - 18]
+            if available < header.size:
+                return None
+            self._start += header.size
+            return msg_id, header.unpack_from(self._buf, start)[1:]
+        raise ProtokollFehler(0, f"Unbekannte Msg-ID {msg_id}")
+
+    def _continue_roster(self):
+        remaining, entries = self._roster
+        if entries is None:
+            self._start, parsed = self.roster.ingest(self._buf, self._start, self._end, remaining)
+            if parsed < remaining:
+                self._roster[0] = remaining - parsed
+                return None
+            self._roster = None
+            return 2, self.roster
+        while remaining:
+            info = self._client_info(self._start)
+            if info is None:
+                self._roster[0] = remaining
+                return None
+            size, entry = info
+            self._start += size
+            entries.append(entry)
+            remaining -= 1
+        self._roster = None
+        return 2, entries
@@ -0,0 +1,128 @@
+# ratelimit.py
+# Sendelimits pro Client und faire Verteilung der Broadcasts (Msg 6).
+#
+# Jeder Broadcast wird an alle anderen Clients verteilt, ein einzelner Client, der
+# Msg 6 flutet, kostet also CPU für N Sends pro Nachricht und füllt die Leitung
+# aller anderen. Dagegen gibt es zwei Stufen:
+#
+#   RateLimit   Token-Bucket pro Client für Nachrichten/s und Bytes/s (--rate-limit,
+#               --rate-limit-bytes). Broadcasts darüber werden verworfen, der Sender
+#               bekommt einmal pro Überschreitung EC 8.
+#   Fairness    Ist der Server trotzdem ausgelastet, kommen die Sender reihum dran:
+#               die thread-Engine verteilt über eine FairQueue (eine Nachricht pro
+#               Sender und Runde, volle Warteschlange bremst den Lese-Thread und
+#               damit per TCP den Sender), die asyncio-Engine verarbeitet pro Client
+#               und Durchlauf der Loop höchstens FAIR_QUOTA Nachrichten und liest
+#               danach erst wieder, wenn die anderen Clients dran waren.
+
+import collections
+import threading
+import time
+
+EC_RATE_LIMIT = 8  # Broadcast über dem Sendelimit verworfen
+
+MESSAGE_RATE = 0  # Broadcasts pro Sekunde und Client, 0 = unbegrenzt
+BYTE_RATE = 0  # Bytes Text pro Sekunde und Client, 0 = unbegrenzt
+BURST = 2.0  # Sekunden, die ein Client auf Vorrat senden darf (Größe des Buckets)
+
+FAIR_QUOTA = 16  # asyncio: Nachrichten pro Client und Durchlauf der Loop
+FAIR_BACKLOG = 16  # thread-Engine: wartende Broadcasts pro Sender, danach blockiert sein Lese-Thread
+
+
+def enabled():
+    return bool(MESSAGE_RATE or BYTE_RATE)
+
+
+class RateLimit:
+    # Token-Bucket pro Client; wird nur vom Lese-Thread bzw. der Loop dieses Clients benutzt
+    __slots__ = ('messages', 'bytes', 'stamp', 'limited')
+
+    def __init__(self):
+        self.messages = MESSAGE_RATE * BURST
+        self.bytes = BYTE_RATE * BURST
+        self.stamp = time.monotonic()
+        self.limited = False  # EC 8 schon gesendet, bis wieder etwas durchgeht
+
+    def allow(self, size):
+        # True, wenn ein Broadcast mit size Bytes Text noch ins Limit passt
+        now = time.monotonic()
+        elapsed = now - self.stamp
+        self.stamp = now
+        messages = self.messages
+        if MESSAGE_RATE:
+            messages = min(MESSAGE_RATE * BURST, messages + elapsed * MESSAGE_RATE)
+        data = self.bytes
+        if BYTE_RATE:
+            data = min(max(BYTE_RATE * BURST, size), data + elapsed * BYTE_RATE)
+        if (MESSAGE_RATE and messages < 1) or (BYTE_RATE and data < size):
+            self.messages, self.bytes = messages, data
+            return False
+        self.messages, self.bytes = messages - 1, data - size
+        self.limited = False
+        return True
+
+
+class FairQueue:
+    # Reihum-Verteilung für die thread-Engine. Ist gerade niemand am Verteilen, läuft
+    # der Job sofort im aufrufenden Thread; sonst kommt er in die Warteschlange seines
+    # Senders, und der verteilende Thread nimmt abwechselnd je einen Job pro Sender.
+    # Ein Thread verteilt so viele Jobs, wie beim Start anstanden (plus seinen eigenen);
+    # wartet dann ein gebremster Sender, übernimmt dieser, sonst geht es weiter.
+
+    def __init__(self, run, backlog=FAIR_BACKLOG):
+        self.run = run  # run(sender, job)
+        self.backlog = backlog
+        self._queues = {}  # sender -> deque mit Jobs
+        self._ring = collections.deque()  # Sender mit wartenden Jobs, in Reihenfolge
+        self._queued = 0
+        self._draining = False
+        self._waiting = 0  # gebremste Lese-Threads in submit()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._queued
+
+    def submit(self, sender, job):
+        with self._cond:
+            while self._draining and len(self._queues.get(sender, ())) >= self.backlog:
+                # Gegendruck: dieser Sender wird erst weiter gelesen, wenn Platz ist
+                self._waiting += 1
+                self._cond.wait()
+                self._waiting -= 1
+            queue = self._queues.get(sender)
+            if queue is None:
+                queue = self._queues[sender] = collections.deque()
+                self._ring.append(sender)
+            queue.append(job)
+            self._queued += 1
+            if self._draining:
+                return
+            self._draining = True
+            budget = self._queued
+        self._drain(budget)
+
+    def _drain(self, budget):
+        while True:
+            with self._cond:
+                if budget <= 0 and not self._waiting:
+                    budget = self._queued
+                if not self._ring or budget <= 0:
+                    self._draining = False
+                    if self._waiting:
+                        self._cond.notify_all()
+                    return
+                sender = self._ring.popleft()
+                queue = self._queues[sender]
+                job = queue.popleft()
+                if queue:
+                    self._ring.append(sender)
+                else:
+                    del self._queues[sender]
+                self._queued -= 1
+                if self._waiting:
+                    self._cond.notify_all()
+            budget -= 1
+            try:
+                self.run(sender, job)
+            except Exception as e:
+                print(f"Fehler beim Verteilen: {e}")
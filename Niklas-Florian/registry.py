@@ -0,0 +1,128 @@
+# registry.py
+# Verzeichnis aller registrierten Clients des Servers.
+#
+# Drei Indizes (Name, Verbindung, (IP, UDP-Port)) machen Registrierung,
+# Eindeutigkeitsprüfung (EC 1 und 2) und Disconnect O(1). Änderungen laufen unter
+# einer Sperre mit kurzen kritischen Abschnitten; Lesezugriffe brauchen keine
+# Sperre: Einzel-Lookups sind einfache dict-Zugriffe, Fan-out-Schleifen iterieren
+# über einen unveränderlichen Snapshot, der nur nach einer Änderung neu gebaut wird.
+#
+# Im Mehrprozess-Betrieb (workers.py) stehen auch Clients anderer Worker im
+# Verzeichnis, mit conn=None. Sie zählen für Roster und Eindeutigkeit, tauchen
+# aber nicht im Snapshot für den lokalen Fan-out auf.
+
+import socket
+import threading
+
+from roster import RosterCache
+
+EC_IP_PORT_NICHT_UNIQUE = 1
+EC_NICKNAME_NICHT_UNIQUE = 2
+
+
+class ClientEntry:
+    __slots__ = ('name', 'conn', 'ip', 'ip_bytes', 'udp_port')
+
+    def __init__(self, name, conn, ip_bytes, udp_port):
+        self.name = name
+        self.conn = conn
+        self.ip_bytes = ip_bytes
+        self.ip = socket.inet_ntoa(ip_bytes)
+        self.udp_port = udp_port
+
+
+class ClientRegistry:
+
+    def __init__(self):
+        self._by_name = {}
+        self._by_conn = {}
+        self._by_addr = {}
+        self._snapshot = ()
+        self._lock = threading.Lock()
+        self.roster = RosterCache()  # Msg 2, wird bei jeder Änderung mitgepflegt
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def local_count(self):
+        return len(self._by_conn)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def by_conn(self, conn):
+        return self._by_conn.get(conn)
+
+    def check(self, name, ip_bytes, udp_port):
+        # Error-Code, falls Name oder (IP, Port) schon vergeben sind, sonst None
+        if name in self._by_name:
+            return EC_NICKNAME_NICHT_UNIQUE
+        if (ip_bytes, udp_port) in self._by_addr:
+            return EC_IP_PORT_NICHT_UNIQUE
+        return None
+
+    def add(self, name, conn, ip_bytes, udp_port):
+        # Gibt den neuen Eintrag zurück oder den Error-Code, falls nicht eindeutig.
+        # conn=None trägt einen Client eines anderen Workers ein.
+        entry = ClientEntry(name, conn, ip_bytes, udp_port)
+        with self._lock:
+            error_code = self.check(name, ip_bytes, udp_port)
+            if error_code is not None:
+                return error_code
+            self._by_name[name] = entry
+            if conn is not None:
+                self._by_conn[conn] = entry
+                self._snapshot = None
+            self._by_addr[ip_bytes, udp_port] = entry
+            self.roster.add(name, ip_bytes, udp_port)
+        return entry
+
+    def remove_conn(self, conn):
+        # Entfernt den Client dieser Verbindung; None, wenn keiner registriert war
+        with self._lock:
+            entry = self._by_conn.pop(conn, None)
+            if entry is None:
+                return None
+            del self._by_name[entry.name]
+            del self._by_addr[entry.ip_bytes, entry.udp_port]
+            self._snapshot = None
+            self.roster.remove(entry.name)
+        return entry
+
+    def replace_conn(self, name, conn):
+        # Fortgesetzte Sitzung (Msg 11): der Eintrag bekommt die neue Verbindung, ohne
+        # Leave/Join. Gibt die alte Verbindung zurück, None wenn name nicht lokal ist.
+        with self._lock:
+            entry = self._by_name.get(name)
+            if entry is None or entry.conn is None:
+                return None
+            old = entry.conn
+            del self._by_conn[old]
+            entry.conn = conn
+            self._by_conn[conn] = entry
+            self._snapshot = None
+        return old
+
+    def remove_remote(self, name):
+        # Entfernt einen Client eines anderen Workers; lokale Einträge bleiben
+        with self._lock:
+            entry = self._by_name.get(name)
+            if entry is None or entry.conn is not None:
+                return None
+            del self._by_name[name]
+            del self._by_addr[entry.ip_bytes, entry.udp_port]
+            self.roster.remove(name)
+        return entry
+
+    def snapshot(self):
+        # Unveränderliches Tupel aller lokalen Einträge für Fan-out-Schleifen
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._by_conn.values())
+                snapshot = self._snapshot
+        return snapshot
@@ -0,0 +1,129 @@
+# roster.py
+# Fertig serialisierte Registrierungs-Antwort (Msg 2) des Servers.
+#
+# Statt bei jeder Registrierung die komplette Client-Liste neu zu packen, hält der
+# Server einen bytearray mit Header (Msg-ID + Anzahl) und allen ClientInfo-Einträgen.
+# Ein Join hängt einen Eintrag an, die Anzahl im Header wird direkt überschrieben.
+# Msg 2 ist dann eine einzige Kopie des Puffers.
+#
+# Ein Leave setzt wie in clientlist.py den letzten Eintrag in die Lücke, statt alle
+# folgenden nachzurücken. Weil Einträge je nach Namen verschieden lang sind, stehen
+# die Offsets nicht fest im Eintrag, sondern ergeben sich aus den Längen der Plätze
+# davor (Fenwick-Baum): ein Leave kostet O(log N) in Python plus ein memmove im
+# Puffer statt einer Schleife über alle Einträge.
+#
+# Jede Änderung erhöht die Roster-Version um eins und landet als fertiger Msg-4/5-
+# Frame in einem begrenzten Änderungslog. Ein Client, der seine Sitzung fortsetzt
+# (Msg 11), bekommt daraus nur die Änderungen seit seiner letzten Version; ist das
+# Log schon weiter gekürzt, braucht er wieder die komplette Msg 2.
+
+import collections
+import itertools
+import threading
+
+from codec import ROSTER_HEADER, encode_client_info, encode_client_left
+
+CHANGE_LOG_SIZE = 4096  # Anzahl gemerkter Joins/Leaves für Delta-Syncs
+
+
+class RosterCache:
+
+    def __init__(self, log_size=CHANGE_LOG_SIZE):
+        self._buf = bytearray(ROSTER_HEADER.pack(2, 0))
+        self._slots = {}  # name -> Platz (Reihenfolge im Puffer)
+        self._names = []  # Platz -> name
+        self._lengths = []  # Platz -> Länge des Eintrags
+        self._tree = [0]  # Fenwick-Baum über _lengths (1-basiert) für die Offsets
+        self._lock = threading.Lock()
+        self.version = 0  # zählt jeden Join und Leave
+        self._changes = collections.deque(maxlen=log_size)  # Msg 4/5 der letzten Versionen
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    def _offset(self, slot):
+        # Offset des Eintrags auf Platz slot: Header + Summe der Längen davor
+        total = ROSTER_HEADER.size
+        tree = self._tree
+        while slot:
+            total += tree[slot]
+            slot &= slot - 1
+        return total
+
+    def _grow(self, length):
+        # Neuer letzter Platz; sein Knoten deckt (i - lowbit(i), i] ab
+        i = len(self._tree)
+        low = i & -i
+        self._tree.append(length + self._offset(i - 1) - self._offset(i - low))
+        self._lengths.append(length)
+
+    def _shrink(self):
+        # Letzten Platz entfernen; kein Knoten davor deckt ihn ab
+        self._tree.pop()
+        self._lengths.pop()
+
+    def _resize_slot(self, slot, length):
+        delta = length - self._lengths[slot]
+        self._lengths[slot] = length
+        i, tree = slot + 1, self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def add(self, name, ip, udp_port):
+        # ip als 4 Byte (inet_aton)
+        record = encode_client_info(ip, udp_port, name)
+        with self._lock:
+            if name in self._slots:
+                raise KeyError(f"{name} ist bereits im Roster")
+            self._slots[name] = len(self._names)
+            self._names.append(name)
+            self._grow(len(record))
+            self._buf += record
+            ROSTER_HEADER.pack_into(self._buf, 0, 2, len(self._slots))
+            self._changes.append(b'\x04' + record)  # Msg 4 ist Msg-ID + ClientInfo
+            self.version += 1
+
+    def remove(self, name):
+        with self._lock:
+            slot = self._slots.pop(name, None)
+            if slot is None:
+                return False
+            offset, length = self._offset(slot), self._lengths[slot]
+            last = len(self._names) - 1
+            if slot == last:
+                del self._buf[offset:]
+            else:
+                # Letzten Eintrag in die Lücke setzen
+                moved = self._names[last]
+                moved_length = self._lengths[last]
+                record = bytes(self._buf[-moved_length:])
+                del self._buf[-moved_length:]
+                self._buf[offset:offset + length] = record
+                self._names[slot] = moved
+                self._slots[moved] = slot
+            self._names.pop()
+            self._shrink()
+            if slot != last:
+                self._resize_slot(slot, moved_length)
+            ROSTER_HEADER.pack_into(self._buf, 0, 2, len(self._slots))
+            self._changes.append(encode_client_left(name))
+            self.version += 1
+            return True
+
+    def frame(self):
+        # Komplette Msg 2 als unveränderliche Kopie (kann in Sende-Queues liegen)
+        with self._lock:
+            return bytes(self._buf)
+
+    def delta(self, since):
+        # Msg 4/5 aller Änderungen nach Version since, hintereinander in einem Frame;
+        # None, wenn das Log diese Versionen nicht mehr (oder noch nie) enthält
+        with self._lock:
+            missing = self.version - since
+            if missing < 0 or missing > len(self._changes):
+                return None
+            return b''.join(itertools.islice(self._changes, len(self._changes) - missing, None))
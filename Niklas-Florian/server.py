@@ -1,174 +1,661 @@
+import os
+import signal
 import socket
 import threading
-import struct
 import argparse
 import time
 
+import outbound
+import profiling
+import ratelimit
+from channels import EC_NICHT_IM_CHANNEL, EC_ZU_VIELE_CHANNELS, ChannelIndex
+from codec import (BROADCAST, CAP_SESSION, CAP_ZLIB, CHANNEL_MESSAGE, encode_broadcast, encode_capabilities, encode_channel_message,
+                   encode_client_left, encode_compressed, encode_error, encode_new_client, encode_session_token)
+from outbound import ClientConnection
+from protocol import FrameDecoder, ProtokollFehler
+from ratelimit import EC_RATE_LIMIT, FairQueue, RateLimit
+from coalesce import NotificationCoalescer
+from deadlines import DeadlineScheduler
+from journal import MAX_SEGMENTS, SEGMENT_BYTES, Journal
+from metrics import Metrics, start_http_server
+from profiling import Profiler, start_admin_server
+from registry import EC_NICKNAME_NICHT_UNIQUE, ClientRegistry
+from sessions import EC_BEREITS_REGISTRIERT, EC_SITZUNG_UNBEKANNT, SessionTokens
+
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 7777
+LISTEN_BACKLOG = 1024  # Großer Backlog, damit viele gleichzeitige Connects nicht abgewiesen werden
+
+READ_CHUNK_SIZE = 4096  # Startgröße des Lesepuffers pro Client, wächst bei großen Nachrichten
+
+# Eine angefangene Nachricht muss ab ihrem ersten Byte innerhalb dieser Zeit komplett
+# ankommen (README: Registrierung 3 s, Broadcast 5 s), sonst wird getrennt
+REGISTRATION_TIMEOUT = 3.0
+MESSAGE_TIMEOUT = 5.0
+IDLE_TIMEOUT = 0  # Sekunden ohne empfangene Bytes bis zur Trennung; 0 = aus
+# TCP-Keepalive: halb offene Verbindungen (Client weg ohne FIN) fallen nach
+# KEEPALIVE_IDLE + KEEPALIVE_COUNT * KEEPALIVE_INTERVAL Sekunden auf; 0 = aus
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+registry = ClientRegistry()  # Alle registrierten Clients, indiziert nach Name, Verbindung und (IP, Port)
+
+sitzungen = SessionTokens()  # Token -> Client, zum Fortsetzen nach einem Abbruch (Msg 10/11)
+
+fristen = DeadlineScheduler()  # Timeouts aller Verbindungen, siehe setze_frist()
+
+kanaele = ChannelIndex()  # Channel -> lokale Mitglieder (Msg 14-16)
+
+verteilung = None  # FairQueue der thread-Engine: Broadcasts mehrerer Sender reihum verteilen
+
+journal = None  # Journal aus journal.py (--journal), jeder verteilte Msg-6-Frame landet darin
+JOURNAL_REPLAY = 0  # Letzte Broadcasts aus dem Journal, die neue Clients nach Msg 2 bekommen
+
+VERBOSE = False  # Log-Zeile pro Nachricht; kostet bei viel Verkehr spürbar Durchsatz
+
+cluster = None  # WorkerBus aus workers.py (--workers) bzw. Federation aus federation.py (--peer-port)
+
+NOTIFY_WINDOW = 0.005  # Sekunden, über die Msg 4/5 gesammelt werden; 0 = sofort einzeln senden
+
+# Msg 2, Roster-Deltas und Broadcasts ab dieser Größe gehen an Clients, die per Msg 12
+# zlib angemeldet haben, komprimiert als Msg 13 raus; 0 = keine Kompression anbieten
+COMPRESS_MIN = 512
+COMPRESS_LEVEL = 1  # zlib-Level: 1 kostet pro Msg 2 nur einen Bruchteil von 6, spart fast genauso viel
+
+metrics = Metrics()
+metrics.describe('chat_messages_received_total', 'counter', 'Empfangene Nachrichten pro Msg-ID', 'msg_id')
+metrics.describe('chat_message_bytes_received_total', 'counter', 'Empfangene Bytes pro Msg-ID', 'msg_id')
+metrics.describe('chat_messages_sent_total', 'counter', 'Gesendete Nachrichten pro Msg-ID', 'msg_id')
+metrics.describe('chat_message_bytes_sent_total', 'counter', 'Gesendete Bytes pro Msg-ID', 'msg_id')
+metrics.describe('chat_errors_sent_total', 'counter', 'Gesendete Fehlermeldungen pro Error-Code', 'code')
+metrics.describe('chat_slow_clients_evicted_total', 'counter', 'Wegen voller Sende-Queue getrennte Clients')
+metrics.describe('chat_handler_seconds', 'histogram', 'Laufzeit der Handler aus MSG_HANDLERS_Server', 'msg_id')
+metrics.describe('chat_broadcast_fanout_seconds', 'histogram', 'Dauer des Fan-outs eines Broadcasts an alle Empfänger')
+metrics.describe('chat_session_resumes_total', 'counter', 'Fortgesetzte Sitzungen (Msg 11) nach Art des Roster-Syncs',
+                 'sync')
+metrics.describe('chat_roster_delta_bytes_sent_total', 'counter', 'Statt Msg 2 gesendete Msg-4/5-Bytes beim Fortsetzen')
+metrics.describe('chat_compressed_bytes_saved_total', 'counter', 'Durch Msg 13 eingesparte Bytes pro Msg-ID', 'msg_id')
+metrics.describe('chat_timeouts_total', 'counter', 'Wegen abgelaufener Frist getrennte Verbindungen', 'kind')
+metrics.describe('chat_channel_fanout_seconds', 'histogram', 'Dauer des Fan-outs einer Channel-Nachricht an die Mitglieder')
+metrics.describe('chat_rate_limited_total', 'counter', 'Wegen Sendelimit verworfene Broadcasts')
+metrics.gauge('chat_connected_clients', 'Mit diesem Prozess verbundene registrierte Clients',
+              lambda: registry.local_count())
+metrics.gauge('chat_send_queue_bytes', 'Summe aller Sende-Queues in Bytes',
+              lambda: sum(entry.conn.queued_bytes() for entry in registry.snapshot()))
+metrics.gauge('chat_channels', 'Channels mit mindestens einem lokalen Mitglied', lambda: len(kanaele))
+metrics.gauge('chat_fair_queue_length', 'Broadcasts, die in der FairQueue auf die Verteilung warten',
+              lambda: len(verteilung) if verteilung is not None else 0)
+metrics.gauge('chat_journal_records', 'Ins Journal übernommene Broadcasts',
+              lambda: len(journal) if journal is not None else 0)
+metrics.gauge('chat_journal_pending', 'Broadcasts, die noch auf den Group Commit des Journals warten',
+              lambda: journal.pending() if journal is not None else 0)
+metrics.gauge('chat_send_queue_max_bytes', 'Längste Sende-Queue in Bytes',
+              lambda: max((entry.conn.queued_bytes() for entry in registry.snapshot()), default=0))
 
-clients = {}  # Speichert die Verbindungen der Clients
-
-def recv_with_timeout(client_socket, expected_length, timeout):
-    data = b''  # Leerer Puffer für die empfangenen Daten
-    start_time = time.time()  # Zeitstempel für Timeout
-
-    while len(data) < expected_length:
-        remaining_time = timeout - (time.time() - start_time)
-        if remaining_time <= 0:
-            print("Timeout erreicht, bevor die erwarteten Daten empfangen wurden.")
-            return None
-
-        # Empfange Daten mit der verbleibenden Zeit
-        chunk = client_socket.recv(min(1024, expected_length - len(data)))
-
-        if not chunk:  # Verbindung wurde geschlossen oder ein Fehler ist aufgetreten
-            print("Verbindung geschlossen oder Fehler beim Empfangen.")
-            return None
-        
-        data += chunk
-    return data
 
 def handle_client(client_socket):
+    # Dieser Thread liest nur; gesendet wird über die Queue der ClientConnection
+    setze_keepalive(client_socket)
+    conn = ClientConnection(client_socket, trenne_langsamen_client)
+    decoder = FrameDecoder(READ_CHUNK_SIZE, zero_copy=True)  # Handler bewahren Payloads nicht auf
+    setze_frist(conn, decoder, True)
     try:
         while True:
-            if handel_msg(client_socket) != None:
-                break
+            if decoder.recv_from(client_socket) == 0:
+                raise ConnectionError("Verbindung geschlossen")
+            fertig = False
+            for msg_id, payload in decoder.messages():
+                fertig = True
+                if handel_msg(conn, msg_id, payload, decoder.last_frame_size) != None:
+                    return
+            setze_frist(conn, decoder, fertig)
     except Exception as e:
         print(f"Error handling client: {e}")
-        for name, (sock, _, _) in list(clients.items()):
-            if sock == client_socket:
-                del clients[name]
-                print(f"Client {name} wurde entfernt.")
-                handel_disconnected_notification(name)
-                break
-        client_socket.close()
-        
-        
-
-def handel_msg(client_socket):
-    # liest die msg-ID
-    msg_id = recv_with_timeout(client_socket, expected_length=1, timeout=5)
-    handler = MSG_HANDLERS_Server.get(msg_id[0])
+        if isinstance(e, ProtokollFehler):
+            sende_fehler(conn, e.error_code)
+        entferne_client(conn)
+        conn.close()
+    finally:
+        fristen.cancel(conn)
+        if profil.check:
+            profil.leave_thread()
+
+
+def setze_keepalive(sock):
+    # Heartbeat ohne Protokolländerung: der Kernel prüft stille Verbindungen selbst
+    if not KEEPALIVE_IDLE:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux; sonst bleibt es bei den Vorgaben des Systems
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+
+
+def setze_frist(conn, decoder, fertig):
+    # Nach jedem Read (und beim Verbindungsaufbau): eine angefangene Nachricht muss
+    # innerhalb ihres Timeouts komplett sein, die Frist läuft ab ihrem ersten Byte
+    # (fertig=False: keine Nachricht abgeschlossen, die laufende Frist bleibt).
+    # Ohne angefangene Nachricht gilt nur IDLE_TIMEOUT.
+    msg_id = decoder.pending_msg_id()
+    if msg_id is not None:
+        timeout = REGISTRATION_TIMEOUT if msg_id == 1 else MESSAGE_TIMEOUT
+        fristen.set(conn, timeout, nachricht_unvollstaendig, keep=not fertig)
+    elif IDLE_TIMEOUT:
+        fristen.set(conn, IDLE_TIMEOUT, verbindung_inaktiv)
+    else:
+        fristen.cancel(conn)
+
+
+def nachricht_unvollstaendig(conn):
+    trenne_nach_timeout(conn, 'message', "Nachricht nicht rechtzeitig vollständig")
+
+
+def verbindung_inaktiv(conn):
+    trenne_nach_timeout(conn, 'idle', f"Seit {IDLE_TIMEOUT} s nichts empfangen")
+
+
+def trenne_nach_timeout(conn, kind, grund):
+    # Läuft im Fristen-Thread bzw. auf der Loop; die anderen bekommen Msg 5 sofort,
+    # der Lese-Thread bzw. connection_lost räumt danach nur noch auf
+    print(f"{grund}, Verbindung wird getrennt.")
+    metrics.inc('chat_timeouts_total', kind)
+    conn.abort()
+    entferne_client(conn)
+
+
+def trenne_langsamen_client(conn):
+    # Empfänger liest nicht mehr schnell genug: trennen, die anderen bekommen Msg 5
+    print("Client liest zu langsam, Verbindung wird getrennt.")
+    metrics.inc('chat_slow_clients_evicted_total')
+    conn.abort()
+    entferne_client(conn)
+
+
+def entferne_client(client_socket):
+    # Entfernt den Client mit diesem Socket und benachrichtigt alle anderen (Msg-Id 5)
+    with benachrichtigungen.lock:
+        entry = registry.remove_conn(client_socket)
+        if entry is None:
+            return None
+        kanaele.remove(entry)
+        if VERBOSE:
+            print(f"Client {entry.name} wurde entfernt.")
+        if cluster is not None:
+            cluster.leave(entry.name)
+        handel_disconnected_notification(entry.name)
+    return entry.name
+
+
+def handel_msg(client_socket, msg_id, payload, size=0):
+    # Nachricht kommt bereits vollständig geparst aus dem FrameDecoder
+    metrics.inc('chat_messages_received_total', msg_id)
+    metrics.inc('chat_message_bytes_received_total', msg_id, size)
+    handler = MSG_HANDLERS_Server.get(msg_id)
     if handler:
-        return handler(client_socket)
+        if profil.check:
+            profil.enter_thread()  # Profil-Fenster: cProfile in diesem Thread an bzw. wieder aus
+        start = time.perf_counter()
+        try:
+            return handler(client_socket, payload)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('chat_handler_seconds', elapsed, msg_id)
+            if profil.active:
+                profil.record(msg_id, elapsed)
     else:
         print(f"Kein Handler für msg_id {msg_id} gefunden!")
 
 
-def handel_fehler(client_socket):  # Msg-Id: 0
-    error_code = recv_with_timeout(client_socket, expected_length=1, timeout=5)
-    print(f"Fehler behandeln - Code: {error_code}")
+def gesendet(msg_id, frame, recipients=1):
+    # Zählt einen an recipients Clients verteilten Frame
+    if recipients:
+        metrics.inc('chat_messages_sent_total', msg_id, recipients)
+        metrics.inc('chat_message_bytes_sent_total', msg_id, len(frame) * recipients)
 
 
-def handel_registrierung(client_socket):  # Msg-Id: 1
-    try:
-        data = recv_with_timeout(client_socket, expected_length=7, timeout=5)
-        ip, udp_port, name_len = struct.unpack('!4sH B', data)
-        data = recv_with_timeout(client_socket, name_len, 5)
-        name = data.decode('utf-8')
+def sende_fehler(client_socket, error_code):  # Msg-Id: 0
+    frame = encode_error(error_code)
+    client_socket.send(frame)
+    metrics.inc('chat_errors_sent_total', error_code)
+    gesendet(0, frame)
 
-        if name in clients:
-            client_socket.send(struct.pack('!BB', 0, 2))  # Fehler: Nickname nicht unique
-            return
 
-        clients[name] = (client_socket, socket.inet_ntoa(ip), udp_port)  
-        print(f"Neuer Client registriert: {name}, IP: {socket.inet_ntoa(ip)}, UDP Port: {udp_port}")
+def sende_komprimierbar(client_socket, msg_id, frame):
+    # Große Frames an Clients mit CAP_ZLIB als Msg 13, sonst unverändert
+    if client_socket.compress and COMPRESS_MIN and len(frame) >= COMPRESS_MIN:
+        compressed = encode_compressed(frame, COMPRESS_LEVEL)
+        if compressed is not None:
+            metrics.inc('chat_compressed_bytes_saved_total', msg_id, len(frame) - len(compressed))
+            frame = compressed
+    client_socket.send(frame)
+    gesendet(msg_id, frame)
 
-        handel_registrierung_response(client_socket)
-        handel_neuer_client_connected(client_socket, name, socket.inet_ntoa(ip), udp_port)
+
+def handel_fehler(client_socket, error_code):  # Msg-Id: 0
+    print(f"Fehler behandeln - Code: {error_code}")
+
+
+def handel_registrierung(client_socket, client_info):  # Msg-Id: 1
+    try:
+        ip, udp_port, name = client_info
+        name = str(name, 'utf-8')  # name ist ein memoryview in den Lesepuffer
+
+        registriere_client(client_socket, ip, udp_port, name)
 
     except Exception as e:
         print(f"Registrierungsfehler: {e}")
 
 
+def registriere_client(client_socket, ip, udp_port, name, resume=None):
+    # Gemeinsamer Teil der Registrierung für alle Engines (ip als 4 Byte);
+    # resume = (token, roster_version) bei einer fortgesetzten Sitzung (Msg 11)
+    if cluster is not None:
+        # Mehrere Worker bzw. Knoten: Name und (IP, Port) erst beim Broker bzw. bei den
+        # anderen Knoten reservieren, registrierung_abschliessen() folgt asynchron
+        error_code = registry.check(name, ip, udp_port)
+        if error_code is not None:
+            sende_fehler(client_socket, error_code)
+            return
+        cluster.claim(client_socket, name, ip, udp_port, resume)
+        return
+    registrierung_abschliessen(client_socket, ip, udp_port, name, resume)
+
+
+def registrierung_abschliessen(client_socket, ip, udp_port, name, resume=None):
+    # Unter der Sperre der Bündelung: Msg 2 und die Position des eigenen Msg 4 im
+    # Puffer passen dann zusammen, kein Join fehlt oder kommt doppelt
+    with benachrichtigungen.lock:
+        entry = registry.add(name, client_socket, ip, udp_port)
+        if isinstance(entry, int):
+            sende_fehler(client_socket, entry)  # Fehler: Nickname bzw. (IP, Port) nicht unique
+            return
 
-def handel_registrierung_response(client_socket):  # Msg-Id: 2
-    client_list = b''
-    for nick, (sock, ip, port) in clients.items():
-        client_list += struct.pack('!4sH B', socket.inet_aton(ip), port, len(nick)) + nick.encode('utf-8')
+        if VERBOSE:
+            print(f"Neuer Client registriert: {name}, IP: {entry.ip}, UDP Port: {udp_port}")
 
-    response = struct.pack('!B I', 2, len(clients)) + client_list
-    client_socket.send(response)
-    print(f"Registrierungsantwort gesendet: {len(clients)} Clients")
+        if resume is None:
+            handel_registrierung_response(client_socket)
+            # Msg 10 nur an Clients, die sie per Msg 12 angemeldet haben: Clients mit
+            # dem ursprünglichen Protokoll kennen sie nicht
+            if client_socket.sessions:
+                handel_sitzungs_token(client_socket, sitzungen.issue(name, ip, udp_port))
+        else:
+            token, since = resume
+            sende_roster_seit(client_socket, since)
+            handel_sitzungs_token(client_socket, token)  # Msg 11: der Client kennt Msg 10
+        if resume is None and journal is not None and JOURNAL_REPLAY:
+            sende_verlauf(client_socket)
+        handel_neuer_client_connected(client_socket, name, ip, udp_port)
 
 
 
-def handel_neuer_client_connected(client_socket, new_client_name, new_client_ip, new_client_port):  # Msg-Id: 4
-    for client_name, (sock, client_ip, client_port) in clients.items():
-        if sock != client_socket:  # Nachricht nicht an den neuen Client senden
-            try:
-                name_encoded = new_client_name.encode('utf-8')
-                name_len = len(name_encoded)
-                print("namelen: ", name_len)
+def sende_verlauf(client_socket):
+    # Die letzten JOURNAL_REPLAY Broadcasts als ein Paket hintereinander (bzw. eine Msg 13)
+    frames = journal.tail(JOURNAL_REPLAY)
+    if frames:
+        sende_komprimierbar(client_socket, 6, b''.join(frames))
+
 
-                ip_as_int = struct.unpack('!I', socket.inet_aton(new_client_ip))[0]  # Wandelt die IP in einen Integer um
+def handel_registrierung_response(client_socket):  # Msg-Id: 2
+    # Der Roster liegt bereits serialisiert vor, es wird nur der Puffer gesendet
+    sende_komprimierbar(client_socket, 2, registry.roster.frame())
+    if VERBOSE:
+        print(f"Registrierungsantwort gesendet: {len(registry.roster)} Clients")
+
+
+def handel_sitzungs_token(client_socket, token):  # Msg-Id: 10
+    # Token und Roster-Version direkt nach Msg 2 bzw. dem Delta; jede danach
+    # empfangene Msg 4/5 erhöht die Version beim Client um eins
+    frame = encode_session_token(token, registry.roster.version)
+    client_socket.send(frame)
+    gesendet(10, frame)
+
+
+def sende_roster_seit(client_socket, since):
+    # Nur die Joins/Leaves nach Version since als Msg 4/5; komplette Msg 2 nur,
+    # wenn das Änderungslog so weit nicht mehr zurückreicht
+    delta = registry.roster.delta(since)
+    if delta is None:
+        metrics.inc('chat_session_resumes_total', 'full')
+        handel_registrierung_response(client_socket)
+        return
+    metrics.inc('chat_session_resumes_total', 'delta')
+    if delta:
+        sende_komprimierbar(client_socket, 4, delta)
+        metrics.inc('chat_roster_delta_bytes_sent_total', value=len(delta))
+
+
+def handel_neuer_client_connected(client_socket, new_client_name, new_client_ip, new_client_port):  # Msg-Id: 4
+    # Frame nur einmal kodieren, send() reiht ihn pro Empfänger nur noch ein (IP als 4 Byte)
+    response = encode_new_client(new_client_ip, new_client_port, new_client_name)
 
-                msg = struct.pack('!I H B', ip_as_int, new_client_port, name_len) + name_encoded
+    if benachrichtigungen.window > 0:
+        benachrichtigungen.add(4, response, client_socket)
+        return
 
-                response = struct.pack('!B', 4) + msg
-                sock.send(response)
+    recipients = 0
+    for entry in registry.snapshot():
+        if entry.conn != client_socket:  # Nachricht nicht an den neuen Client senden
+            try:
+                entry.conn.send(response)
+                recipients += 1
             except Exception as e:
-                print(f"Fehler beim Senden der Benachrichtigung an {client_name}: {e}")
+                print(f"Fehler beim Senden der Benachrichtigung an {entry.name}: {e}")
+    gesendet(4, response, recipients)
 
 
 def handel_disconnected_notification(disconnected_client_name):  # Msg-Id: 5
-    print(f"Client {disconnected_client_name} hat sich disconnected.")
+    if VERBOSE:
+        print(f"Client {disconnected_client_name} hat sich disconnected.")
+
+    message = encode_client_left(disconnected_client_name)
+
+    if benachrichtigungen.window > 0:
+        benachrichtigungen.add(5, message)
+        return
 
-    for client_name, (sock, client_ip, client_port) in clients.items():
+    recipients = 0
+    for entry in registry.snapshot():
         try:
-            message = struct.pack('!B B', 5, len(disconnected_client_name)) + disconnected_client_name.encode('utf-8')
-            sock.send(message)
-            print(f"Benachrichtigung an {client_name}, dass {disconnected_client_name} sich disconnected hat.")
+            entry.conn.send(message)
+            recipients += 1
         except Exception as e:
-            print(f"Fehler beim Senden der Disconnect-Nachricht an {client_name}: {e}")
+            print(f"Fehler beim Senden der Disconnect-Nachricht an {entry.name}: {e}")
+    gesendet(5, message, recipients)
+
+
+def verteile_benachrichtigungen(pending, joined, counts):
+    # Gesammelte Msg 4/5 mit einem send() pro Empfänger; wer sich im Fenster
+    # registriert hat, bekommt nur den Rest ab seinem eigenen Msg 4
+    view = memoryview(pending)
+    full = 0
+    partial = []
+    for entry in registry.snapshot():
+        offset = joined.get(entry.conn, 0)
+        if offset >= len(pending):
+            continue
+        try:
+            entry.conn.send(view[offset:] if offset else pending)
+        except Exception as e:
+            print(f"Fehler beim Senden der Benachrichtigungen an {entry.name}: {e}")
+            continue
+        if offset:
+            partial.append(offset)
+        else:
+            full += 1
+
+    ends = [offset for offset, _ in counts[1:]] + [len(pending)]
+    for (start, msg_id), end in zip(counts, ends):
+        recipients = full + sum(1 for offset in partial if offset <= start)
+        if recipients:
+            metrics.inc('chat_messages_sent_total', msg_id, recipients)
+            metrics.inc('chat_message_bytes_sent_total', msg_id, (end - start) * recipients)
 
 
+benachrichtigungen = NotificationCoalescer(NOTIFY_WINDOW, verteile_benachrichtigungen)
 
-def handel_broadcast(client_socket):  # Msg-Id: 6
+
+
+def handel_broadcast(client_socket, msg):  # Msg-Id: 6
     try:
-        msg_len_data = recv_with_timeout(client_socket, expected_length=2, timeout=2)
-        if not msg_len_data:  
-            print("Keine Daten für Nachrichtengröße empfangen.")
-            return
-        
-        msg_len = struct.unpack('!H', msg_len_data)[0]  
-        
-        msg = recv_with_timeout(client_socket, expected_length=msg_len, timeout=2)
-        if not msg:  
+        if not msg:
             print("Keine Nachricht empfangen.")
             return
+        if ratelimit.enabled() and ueber_limit(client_socket, len(msg)):
+            return
 
-        print("Broadcast Nachricht empfangen:", msg.decode('utf-8'))
-
-        # Broadcast an alle anderen Clients senden
-        for client_name, (sock, client_ip, client_port) in clients.items():
-            if sock != client_socket:  # Nachricht nicht an den Sender selbst senden
-                try:
-                    response = struct.pack('!B H', 6, len(msg)) + msg 
-                    sock.send(response)  
-                    print(f"Nachricht an {client_name} gesendet: {msg.decode('utf-8')}")
-                except Exception as e:
-                    print(f"Fehler beim Senden der Broadcast-Nachricht an {client_name}: {e}")
+        verteile_broadcast(client_socket, msg)
     except Exception as e:
         print(f"Fehler beim Bearbeiten der Broadcast-Nachricht: {e}")
 
 
+def ueber_limit(client_socket, size):
+    # Token-Bucket des Senders; darüber wird verworfen, EC 8 einmal pro Überschreitung
+    limit = client_socket.rate_limit
+    if limit is None:
+        limit = client_socket.rate_limit = RateLimit()
+    if limit.allow(size):
+        return False
+    metrics.inc('chat_rate_limited_total')
+    if not limit.limited:
+        limit.limited = True
+        sende_fehler(client_socket, EC_RATE_LIMIT)
+    return True
+
+
+def verteile_broadcast(client_socket, msg):
+    # Frame einmal kodieren; in der thread-Engine kommen die Sender danach reihum
+    # dran (msg zeigt in den Lesepuffer, der Frame ist eine Kopie)
+    response = encode_broadcast(msg)
+    if verteilung is not None:
+        verteilung.submit(client_socket, response)
+    else:
+        sende_broadcast(client_socket, response)
+
+
+def sende_broadcast(client_socket, response):
+    benachrichtigungen.flush()  # Offene Msg 4/5 zuerst, sonst ändert sich die Reihenfolge
+    if journal is not None:
+        journal.append(response)  # Nur anhängen, geschrieben wird im Thread des Journals
+    start = time.perf_counter()
+
+    # Frame (höchstens einmal komprimiert) an alle anderen Clients verteilen; send()
+    # blockiert nicht, ein langsamer Empfänger hält die übrigen also nicht auf
+    recipients = verteile_frame(response, client_socket)
+
+    metrics.observe('chat_broadcast_fanout_seconds', time.perf_counter() - start)
+    if cluster is not None:
+        cluster.broadcast(response)  # Die anderen Worker verteilen an ihre Clients
+    if VERBOSE:
+        print(f"Broadcast an {recipients} Clients gesendet: {str(response[BROADCAST.size:], 'utf-8', 'replace')}")
+
+
+
+def verteile_frame(response, sender=None, entries=None, msg_id=6):
+    # Fertigen Frame an alle lokalen Clients (bzw. entries) außer sender; Clients mit
+    # CAP_ZLIB bekommen dieselbe, nur einmal komprimierte Msg 13
+    if entries is None:
+        entries = registry.snapshot()
+    compressed = None
+    if COMPRESS_MIN and len(response) >= COMPRESS_MIN:
+        compressed = False  # erst komprimieren, wenn der erste Empfänger es braucht
+    plain = packed = 0
+    for entry in entries:
+        conn = entry.conn
+        if conn == sender:  # Nachricht nicht an den Sender selbst senden
+            continue
+        frame = response
+        if conn.compress and compressed is not None:
+            if compressed is False:
+                compressed = encode_compressed(response, COMPRESS_LEVEL)
+            if compressed is not None:
+                frame = compressed
+        try:
+            conn.send(frame)
+        except Exception as e:
+            print(f"Fehler beim Senden der Msg {msg_id} an {entry.name}: {e}")
+            continue
+        if frame is response:
+            plain += 1
+        else:
+            packed += 1
+    gesendet(msg_id, response, plain)
+    if packed:
+        gesendet(msg_id, compressed, packed)
+        metrics.inc('chat_compressed_bytes_saved_total', msg_id, (len(response) - len(compressed)) * packed)
+    return plain + packed
+
+
+def fremder_client_verbunden(name, ip, udp_port):
+    # Ein anderer Worker hat einen Client registriert: eintragen (ohne Verbindung) und Msg 4
+    with benachrichtigungen.lock:
+        entry = registry.add(name, None, ip, udp_port)
+        if isinstance(entry, int):
+            print(f"Client {name} eines anderen Workers ist hier schon bekannt.")
+            return
+        handel_neuer_client_connected(None, name, ip, udp_port)
+
+
+def fremder_client_getrennt(name):
+    # Client eines anderen Workers ist weg: austragen und Msg 5
+    with benachrichtigungen.lock:
+        if registry.remove_remote(name) is not None:
+            handel_disconnected_notification(name)
+
+
+def namenskonflikt(name, ip, udp_port):
+    # Föderation: ein anderer Knoten hat name mit Vorrang vergeben (z.B. nach einer
+    # Netztrennung). Der eigene Client wird mit EC 2 getrennt, der fremde eingetragen.
+    entry = registry.get(name)
+    if entry is not None and entry.conn is not None:
+        print(f"Client {name} ist auf einem anderen Knoten vorrangig registriert und wird getrennt.")
+        sende_fehler(entry.conn, EC_NICKNAME_NICHT_UNIQUE)
+        entry.conn.close()
+        entferne_client(entry.conn)
+    fremder_client_verbunden(name, ip, udp_port)
 
-def handel_disconnect_message(client_socket):  # Msg-Id: 7
-    disconnected_client_name = None
 
-    for name, (sock, ip, port) in list(clients.items()):
-        if sock == client_socket:
-            disconnected_client_name = name
-            del clients[name]
-            client_socket.close()
-            break
-    if disconnected_client_name:
-        handel_disconnected_notification(disconnected_client_name)
+def fremder_broadcast(response):
+    # Fertig kodierter Msg-6-Frame von einem anderen Worker an alle lokalen Clients
+    benachrichtigungen.flush()
+    if journal is not None:
+        journal.append(response)
+    verteile_frame(response)
+
+
+
+def kanal_mitglied(client_socket, channel):
+    # (ClientEntry, Channel als bytes) für Msg 14-16 oder None, nachdem EC gesendet wurde
+    if not channel:
+        sende_fehler(client_socket, 3)  # Länge null
+        return None
+    channel = bytes(channel)  # channel ist ein memoryview in den Lesepuffer
+    try:
+        channel.decode('utf-8')
+    except UnicodeDecodeError:
+        sende_fehler(client_socket, 4)
+        return None
+    entry = registry.by_conn(client_socket)
+    if entry is None:
+        sende_fehler(client_socket, EC_NICHT_IM_CHANNEL)  # erst nach der Registrierung
+        return None
+    return entry, channel
+
+
+def handel_channel_beitreten(client_socket, channel):  # Msg-Id: 14
+    member = kanal_mitglied(client_socket, channel)
+    if member is None:
+        return
+    if not kanaele.join(*member):
+        sende_fehler(client_socket, EC_ZU_VIELE_CHANNELS)
+    elif VERBOSE:
+        print(f"{member[0].name} ist Channel {str(member[1], 'utf-8')} beigetreten.")
+
+
+def handel_channel_verlassen(client_socket, channel):  # Msg-Id: 15
+    member = kanal_mitglied(client_socket, channel)
+    if member is None:
+        return
+    if not kanaele.leave(*member):
+        sende_fehler(client_socket, EC_NICHT_IM_CHANNEL)
+
+
+def handel_channel_nachricht(client_socket, payload):  # Msg-Id: 16
+    channel, msg = payload
+    if not msg:
+        sende_fehler(client_socket, 3)
+        return
+    member = kanal_mitglied(client_socket, channel)
+    if member is None:
+        return
+    entry, channel = member
+    if not kanaele.is_member(entry, channel):
+        sende_fehler(client_socket, EC_NICHT_IM_CHANNEL)
+        return
+    if ratelimit.enabled() and ueber_limit(client_socket, len(msg)):
+        return  # Dasselbe Sendelimit wie für Broadcasts
+    verteile_kanal(client_socket, channel, encode_channel_message(channel, msg))
+
+
+def verteile_kanal(client_socket, channel, frame):
+    # Nur an die lokalen Mitglieder: O(Mitglieder) statt O(alle Clients)
+    benachrichtigungen.flush()  # Wie bei Msg 6: offene Msg 4/5 zuerst
+    start = time.perf_counter()
+    recipients = verteile_frame(frame, client_socket, kanaele.members(channel), 16)
+    metrics.observe('chat_channel_fanout_seconds', time.perf_counter() - start)
+    if cluster is not None:
+        cluster.publish(frame)  # Die anderen Worker bzw. Knoten verteilen an ihre Mitglieder
+    if VERBOSE:
+        print(f"Channel {str(channel, 'utf-8')}: an {recipients} Mitglieder gesendet.")
+
+
+def fremde_channel_nachricht(frame):
+    # Fertig kodierter Msg-16-Frame von einem anderen Worker bzw. Knoten
+    channel_len = frame[1]
+    channel = bytes(frame[CHANNEL_MESSAGE.size:CHANNEL_MESSAGE.size + channel_len])
+    members = kanaele.members(channel)
+    if members:
+        benachrichtigungen.flush()
+        verteile_frame(frame, None, members, 16)
+
+
+def handel_disconnect_message(client_socket, _=None):  # Msg-Id: 7
+    client_socket.close()
+    name = entferne_client(client_socket)
+    if name is not None:
+        sitzungen.forget(name)  # Bewusst abgemeldet, kein Fortsetzen mehr
     return True
 
 
+def handel_faehigkeiten(client_socket, flags):  # Msg-Id: 12
+    # Client meldet vor Msg 1 bzw. Msg 11, was er kann; Antwort ist die Auswahl,
+    # die der Server benutzt (unbekannte Bits werden ignoriert)
+    accepted = (flags & CAP_ZLIB if COMPRESS_MIN else 0) | flags & CAP_SESSION
+    client_socket.compress = bool(accepted & CAP_ZLIB)
+    client_socket.sessions = bool(accepted & CAP_SESSION)
+    frame = encode_capabilities(accepted)
+    client_socket.send(frame)
+    gesendet(12, frame)
+
+
+def handel_sitzung_fortsetzen(client_socket, payload):  # Msg-Id: 11
+    token, since = payload
+    session = sitzungen.get(token)
+    if session is None:
+        sende_fehler(client_socket, EC_SITZUNG_UNBEKANNT)  # Client registriert sich neu (Msg 1)
+        return
+    name, ip, udp_port = session
+
+    with benachrichtigungen.lock:
+        if registry.by_conn(client_socket) is not None:
+            # Msg 11 nur vor abgeschlossener Registrierung: sonst würde ein Client mit
+            # seinem eigenen Token die eigene Verbindung als "alte" abbrechen
+            sende_fehler(client_socket, EC_BEREITS_REGISTRIERT)
+            return
+        entry = registry.get(name)
+        if entry is not None and entry.conn is not None:
+            # Der Abbruch der alten Verbindung ist noch nicht bemerkt worden: Eintrag
+            # übernehmen, die anderen Clients sehen weder Msg 5 noch Msg 4
+            old = registry.replace_conn(name, client_socket)
+            benachrichtigungen.mark_joined(client_socket)
+            sende_roster_seit(client_socket, since)
+            handel_sitzungs_token(client_socket, token)
+            old.abort()
+            if VERBOSE:
+                print(f"Sitzung von {name} auf neuer Verbindung fortgesetzt.")
+            return
+
+    # Alter Eintrag ist schon entfernt: wie eine Registrierung, aber mit Delta statt Msg 2
+    registriere_client(client_socket, ip, udp_port, name, (token, since))
+
+
+def handel_nur_p2p(client_socket, payload):  # Msg-Id: 17-20
+    # Dateiübertragung gibt es nur zwischen Peers. Auf den Header von Msg 19 folgen
+    # ungeparste Dateidaten, die der Decoder sonst als Frames lesen würde: EC 0 und
+    # Verbindung trennen (wie bei jedem ProtokollFehler)
+    raise ProtokollFehler(0, "Msg 17-20 nur zwischen Peers")
 
 
 MSG_HANDLERS_Server = {
@@ -176,21 +663,46 @@ MSG_HANDLERS_Server = {
     1: handel_registrierung,
     6: handel_broadcast,
     7: handel_disconnect_message,
+    11: handel_sitzung_fortsetzen,
+    12: handel_faehigkeiten,
+    14: handel_channel_beitreten,
+    15: handel_channel_verlassen,
+    16: handel_channel_nachricht,
+    17: handel_nur_p2p,
+    18: handel_nur_p2p,
+    19: handel_nur_p2p,
+    20: handel_nur_p2p,
 }
 
+profil = Profiler(MSG_HANDLERS_Server)  # Profiling auf Abruf (SIGUSR1, --admin-port), siehe profiling.py
 
-def main():
+
+def profil_umschalten(signum=None, frame=None):
+    # SIGUSR1: Fenster starten bzw. vorzeitig beenden; Auswertung nicht im Signal-Handler
+    threading.Thread(target=profil.toggle, daemon=True).start()
+
+
+def run_thread_engine(host, port, reuse_port=False):
+    # Klassische Engine: ein Thread pro Client
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((SERVER_HOST, SERVER_PORT))
-    server_socket.listen(5)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Mehrere Worker auf einem Port
+    if cluster is not None:
+        cluster.start_thread()
+    fristen.start_thread()
+    global verteilung
+    verteilung = FairQueue(sende_broadcast)
+    server_socket.bind((host, port))
+    server_socket.listen(LISTEN_BACKLOG)
     server_socket.settimeout(1.0)  # Timeout von 1 Sekunde setzen
-    print(f"Server listening on {SERVER_HOST}:{SERVER_PORT}")
+    print(f"Server listening on {host}:{port}")
 
     try:
         while True:
             try:
                 client_socket, client_address = server_socket.accept()
-                threading.Thread(target=handle_client, args=(client_socket,)).start()
+                threading.Thread(target=handle_client, args=(client_socket,), daemon=True).start()
             except socket.timeout:
                 continue  # Timeout erreicht, weiter zur nächsten Iteration
     except KeyboardInterrupt:
@@ -198,7 +710,157 @@ def main():
     finally:
         server_socket.close()
 
+
+def main():
+    global VERBOSE, COMPRESS_MIN, COMPRESS_LEVEL, IDLE_TIMEOUT, KEEPALIVE_IDLE, JOURNAL_REPLAY
+    parser = argparse.ArgumentParser(description='TCP Chat-Server')
+    parser.add_argument('--host', type=str, default=SERVER_HOST, help='Adresse zum Binden (Standard: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help='TCP-Port (Standard: 7777)')
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+                        help='thread: ein Thread pro Client, asyncio: alle Clients auf einer Event-Loop (Standard: thread)')
+    parser.add_argument('--queue-high-water', type=int, default=outbound.QUEUE_HIGH_WATER,
+                        help='Bytes in der Sende-Queue eines Clients, ab denen er als langsam gilt (Standard: 256 KiB)')
+    parser.add_argument('--queue-limit', type=int, default=outbound.QUEUE_LIMIT,
+                        help='Bytes in der Sende-Queue, ab denen sofort getrennt wird (Standard: 4 MiB)')
+    parser.add_argument('--slow-client-timeout', type=float, default=outbound.SLOW_CLIENT_TIMEOUT,
+                        help='Sekunden, die ein Client über der High-Water-Mark bleiben darf (Standard: 5)')
+    parser.add_argument('--notify-window', type=float, default=NOTIFY_WINDOW,
+                        help='Sekunden, über die Join-/Leave-Meldungen (Msg 4/5) pro Empfänger gebündelt werden, '
+                             '0 = einzeln senden (Standard: 0.005)')
+    parser.add_argument('--compress-min', type=int, default=COMPRESS_MIN,
+                        help='Ab dieser Größe in Bytes gehen Msg 2 und Broadcasts an Clients mit zlib-Fähigkeit '
+                             'komprimiert raus, 0 = aus (Standard: 512)')
+    parser.add_argument('--compress-level', type=int, choices=range(1, 10), default=COMPRESS_LEVEL,
+                        help='zlib-Level für die Kompression (Standard: 1)')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Verbindungen trennen, von denen so viele Sekunden nichts kam, 0 = aus (Standard: 0)')
+    parser.add_argument('--keepalive', type=int, default=KEEPALIVE_IDLE,
+                        help='Sekunden Stille bis zur ersten TCP-Keepalive-Probe, 0 = aus (Standard: 30)')
+    parser.add_argument('--rate-limit', type=float, default=ratelimit.MESSAGE_RATE,
+                        help='Broadcasts pro Sekunde und Client, darüber wird verworfen (EC 8), 0 = aus (Standard: 0)')
+    parser.add_argument('--rate-limit-bytes', type=int, default=ratelimit.BYTE_RATE,
+                        help='Bytes Broadcast-Text pro Sekunde und Client, 0 = aus (Standard: 0)')
+    parser.add_argument('--rate-burst', type=float, default=ratelimit.BURST,
+                        help='Sekunden des Limits, die ein Client auf Vorrat senden darf (Standard: 2)')
+    parser.add_argument('--journal', type=str, metavar='DIR',
+                        help='Alle Broadcasts in ein Journal in diesem Verzeichnis schreiben (Standard: aus)')
+    parser.add_argument('--journal-segment-size', type=int, default=SEGMENT_BYTES,
+                        help='Bytes pro Journal-Segment, danach wird rotiert (Standard: 64 MiB)')
+    parser.add_argument('--journal-segments', type=int, default=MAX_SEGMENTS,
+                        help='Höchstens so viele Segmente behalten, 0 = alle (Standard: 0)')
+    parser.add_argument('--journal-replay', type=int, default=JOURNAL_REPLAY,
+                        help='Neue Clients bekommen die letzten N Broadcasts aus dem Journal (Standard: 0)')
+    parser.add_argument('--admin-port', type=int,
+                        help='Profiling über 127.0.0.1:<port> steuern (start/stop/status, siehe profiling.py, '
+                             'Standard: aus)')
+    parser.add_argument('--profile-dir', type=str, default=profiling.PROFILE_DIR,
+                        help='Verzeichnis für Profil-Dateien (Standard: aktuelles Verzeichnis)')
+    parser.add_argument('--profile-seconds', type=float, default=profiling.PROFILE_SECONDS,
+                        help='Länge eines per SIGUSR1 gestarteten Profil-Fensters in s (Standard: 30)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Prometheus-Metriken unter http://127.0.0.1:<port>/metrics anbieten (Standard: aus)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Anzahl Worker-Prozesse, die sich per SO_REUSEPORT den Port teilen (Standard: 1)')
+    parser.add_argument('--peer-port', type=int,
+                        help='Port für Verbindungen anderer Server-Knoten (Föderation, Standard: aus)')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help='Peer-Port eines anderen Knotens, mehrfach angebbar')
+    parser.add_argument('--node-id', type=str,
+                        help='Eindeutige ID dieses Knotens, bei Konflikten gewinnt die kleinere '
+                             '(Standard: <hostname>:<peer-port>)')
+    parser.add_argument('--verbose', action='store_true', help='Eine Log-Zeile pro Nachricht ausgeben')
+    args = parser.parse_args()
+
+    VERBOSE = args.verbose
+    COMPRESS_MIN = args.compress_min
+    COMPRESS_LEVEL = args.compress_level
+    IDLE_TIMEOUT = args.idle_timeout
+    KEEPALIVE_IDLE = args.keepalive
+    JOURNAL_REPLAY = args.journal_replay
+
+    outbound.QUEUE_HIGH_WATER = args.queue_high_water
+    outbound.QUEUE_LIMIT = args.queue_limit
+    outbound.SLOW_CLIENT_TIMEOUT = args.slow_client_timeout
+    ratelimit.MESSAGE_RATE = args.rate_limit
+    ratelimit.BYTE_RATE = args.rate_limit_bytes
+    ratelimit.BURST = args.rate_burst
+    profiling.PROFILE_SECONDS = args.profile_seconds
+    profil.directory = args.profile_dir
+    benachrichtigungen.window = args.notify_window
+
+    if args.journal_replay and not args.journal:
+        parser.error('--journal-replay braucht --journal')
+    if args.peer and args.peer_port is None:
+        parser.error('--peer braucht --peer-port')
+    if args.workers > 1 and args.peer_port is not None:
+        parser.error('--workers und --peer-port lassen sich nicht kombinieren')
+    peers = []
+    for peer in args.peer:
+        host, _, port = peer.rpartition(':')
+        if not host or not port.isdigit():
+            parser.error(f'--peer {peer}: erwartet HOST:PORT')
+        peers.append((socket.gethostbyname(host), int(port)))
+
+    if args.peer_port is not None:
+        starte_knoten(args, peers)
+    elif args.workers > 1:
+        import workers
+        workers.run_workers(args.workers, lambda bus_socket, index: starte_worker(args, bus_socket, index))
+    else:
+        starte_engine(args, args.metrics_port, journal_dir=args.journal, admin_port=args.admin_port)
+
+
+def starte_worker(args, bus_socket, index):
+    # Läuft im geforkten Worker-Prozess; Metrik-Port pro Worker um index versetzt
+    global cluster
+    import server
+    import workers
+    cluster = workers.WorkerBus(bus_socket, server)
+    # Jeder Worker verteilt alle Broadcasts und führt darum ein eigenes Journal
+    journal_dir = os.path.join(args.journal, f'worker-{index}') if args.journal else None
+    starte_engine(args, args.metrics_port + index if args.metrics_port else None, reuse_port=True,
+                  journal_dir=journal_dir, admin_port=args.admin_port + index if args.admin_port else None)
+
+
+def starte_knoten(args, peers):
+    # Föderation: dieser Prozess ist ein Knoten unter mehreren, verbunden über --peer
+    global cluster
+    import federation
+    import server
+    node_id = args.node_id or f"{socket.gethostname()}:{args.peer_port}"
+    cluster = federation.Federation(server, node_id, args.host, args.peer_port, peers)
+    starte_engine(args, args.metrics_port, journal_dir=args.journal, admin_port=args.admin_port)
+
+
+def starte_engine(args, metrics_port, reuse_port=False, journal_dir=None, admin_port=None):
+    global journal
+    if metrics_port:
+        start_http_server(metrics, '127.0.0.1', metrics_port)
+        print(f"Metriken unter http://127.0.0.1:{metrics_port}/metrics")
+    if admin_port:
+        start_admin_server(profil, '127.0.0.1', admin_port)
+        print(f"Profiling-Steuerung auf 127.0.0.1:{admin_port}")
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profil_umschalten)
+    if journal_dir:
+        journal = Journal(journal_dir, args.journal_segment_size, args.journal_segments)
+        print(f"Journal in {journal_dir}: {len(journal)} Broadcasts bisher")
+
+    try:
+        if args.engine == 'asyncio':
+            import async_server
+            async_server.main(args.host, args.port, reuse_port)
+        else:
+            run_thread_engine(args.host, args.port, reuse_port)
+    finally:
+        if journal is not None:
+            journal.close()  # Ausstehende Gruppe noch schreiben
+
+
 if __name__ == "__main__":
-    main()
+    # Über den Modulnamen starten, damit async_server.py (import server) dieselben
+    # globalen Objekte (registry, metrics, VERBOSE) sieht wie dieses Skript
+    import server
+    server.main()
 
 
@@ -0,0 +1,60 @@
+# sessions.py
+# Sitzungs-Tokens für das Fortsetzen nach einem Verbindungsabbruch (Msg 10/11).
+#
+# Nach der Registrierung bekommt jeder Client ein zufälliges Token (Msg 10). Mit
+# Token und zuletzt bekannter Roster-Version kann er sich nach einem TCP-Abbruch per
+# Msg 11 wieder anmelden, statt sich neu zu registrieren: der Server kennt über das
+# Token Name, IP und UDP-Port und schickt nur die Roster-Änderungen seit dieser
+# Version. Tokens bleiben auch nach dem Abbruch gültig, bis sie von neueren
+# verdrängt werden (höchstens SESSION_LIMIT) oder der Client sich mit Msg 7 abmeldet.
+
+import collections
+import secrets
+import threading
+
+from codec import TOKEN_SIZE
+
+SESSION_LIMIT = 65536  # Höchstzahl gemerkter Tokens, älteste fallen zuerst heraus
+
+EC_SITZUNG_UNBEKANNT = 6  # Token unbekannt oder abgelaufen, Client muss sich neu registrieren
+EC_BEREITS_REGISTRIERT = 11  # Msg 11 auf einer Verbindung, die schon registriert ist
+
+
+class SessionTokens:
+
+    def __init__(self, limit=SESSION_LIMIT):
+        self.limit = limit
+        self._by_token = collections.OrderedDict()  # token -> (name, ip_bytes, udp_port)
+        self._by_name = {}  # name -> token
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_token)
+
+    def issue(self, name, ip_bytes, udp_port):
+        # Neues Token für name; ein älteres Token desselben Namens wird ungültig
+        token = secrets.token_bytes(TOKEN_SIZE)
+        with self._lock:
+            old = self._by_name.pop(name, None)
+            if old is not None:
+                del self._by_token[old]
+            self._by_token[token] = (name, ip_bytes, udp_port)
+            self._by_name[name] = token
+            while len(self._by_token) > self.limit:
+                _, (oldest, _, _) = self._by_token.popitem(last=False)
+                del self._by_name[oldest]
+        return token
+
+    def get(self, token):
+        # (name, ip_bytes, udp_port) oder None
+        with self._lock:
+            session = self._by_token.get(token)
+            if session is not None:
+                self._by_token.move_to_end(token)
+            return session
+
+    def forget(self, name):
+        with self._lock:
+            token = self._by_name.pop(name, None)
+            if token is not None:
+                del self._by_token[token]
@@ -0,0 +1,323 @@
+# workers.py
+# Mehrprozess-Betrieb des Servers (--workers N).
+#
+# Der Hauptprozess forkt N Worker, die jeweils mit SO_REUSEPORT auf demselben Port
+# lauschen; der Kernel verteilt neue Verbindungen auf sie. Damit trotzdem alle
+# Clients einen gemeinsamen Chat sehen, hängt jeder Worker über ein Unix-Socket-Paar
+# an einem Bus im Hauptprozess (Broker):
+#
+#   CLAIM       Worker -> Broker   Name/(IP, Port) global reservieren (EC 1/2)
+#   CLAIM_OK    Broker -> Worker   Registrierung darf abgeschlossen werden
+#   CLAIM_FAIL  Broker -> Worker   mit Error-Code ablehnen
+#   JOIN        Broker -> Worker   Client eines anderen Workers ist dazugekommen (Msg 4)
+#   LEAVE       beide Richtungen   Client ist weg (Msg 5)
+#   BROADCAST   beide Richtungen   fertig kodierter Msg-6-Frame für alle lokalen Clients
+#   CHANNEL     beide Richtungen   fertig kodierter Msg-16-Frame für die lokalen Mitglieder
+#
+# Der Broker ist die einzige Stelle, die Namen vergibt; er reicht Joins, Leaves,
+# Broadcasts und Channel-Nachrichten an alle anderen Worker weiter und gibt die
+# Namen eines abgestürzten Workers wieder frei.
+
+import asyncio
+import itertools
+import os
+import selectors
+import signal
+import socket
+import struct
+import threading
+
+from codec import CLIENT_INFO, encode_client_info
+
+_BUS_HEADER = struct.Struct('!IB')  # Länge ab Typ-Byte, Typ
+_REQ_ID = struct.Struct('!I')
+
+BUS_CLAIM = 1
+BUS_CLAIM_OK = 2
+BUS_CLAIM_FAIL = 3
+BUS_JOIN = 4
+BUS_LEAVE = 5
+BUS_BROADCAST = 6
+BUS_CHANNEL = 8  # 7 ist HELLO der Föderation
+
+
+def encode_bus(kind, payload):
+    return _BUS_HEADER.pack(len(payload) + 1, kind) + payload
+
+
+def decode_client_info(payload, offset=0):
+    ip, udp_port, name_len = CLIENT_INFO.unpack_from(payload, offset)
+    start = offset + CLIENT_INFO.size
+    return ip, udp_port, bytes(payload[start:start + name_len]).decode('utf-8')
+
+
+class BusDecoder:
+    # Zerlegt den Bus-Datenstrom in (typ, payload)
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        self._buf += data
+
+    def messages(self):
+        buf = self._buf
+        offset = 0
+        while len(buf) - offset >= _BUS_HEADER.size:
+            length, kind = _BUS_HEADER.unpack_from(buf, offset)
+            end = offset + 4 + length
+            if end > len(buf):
+                break
+            yield kind, bytes(buf[offset + _BUS_HEADER.size:end])
+            offset = end
+        del buf[:offset]
+
+
+# Worker-Seite -------------------------------------------------------------
+
+class WorkerBus:
+    # Verbindung eines Workers zum Broker; wird in server.cluster eingetragen.
+    # Schnittstelle für server.py: claim(), leave(), broadcast().
+
+    def __init__(self, sock, server_module):
+        self.sock = sock
+        self.server = server_module
+        self.decoder = BusDecoder()
+        self.pending = {}  # req_id -> (conn, ip, udp_port, name, resume)
+        self._req_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._write = self._write_blocking
+
+    # Aufrufe aus server.py
+
+    def claim(self, conn, name, ip, udp_port, resume=None):
+        req_id = next(self._req_ids) & 0xFFFFFFFF
+        self.pending[req_id] = (conn, ip, udp_port, name, resume)
+        self._write(encode_bus(BUS_CLAIM, _REQ_ID.pack(req_id) + encode_client_info(ip, udp_port, name)))
+
+    def leave(self, name):
+        self._write(encode_bus(BUS_LEAVE, name.encode('utf-8')))
+
+    def broadcast(self, frame):
+        self._write(encode_bus(BUS_BROADCAST, frame))
+
+    def publish(self, frame):
+        self._write(encode_bus(BUS_CHANNEL, frame))
+
+    # Anbindung an die Engines
+
+    def start_thread(self):
+        # thread-Engine: eigener Lese-Thread, Schreiben blockierend unter Lock
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    async def attach_loop(self):
+        # asyncio-Engine: Bus läuft als Protokoll auf der Event-Loop
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.connect_accepted_socket(lambda: _BusProtocol(self), self.sock)
+        self._write = transport.write
+
+    def _write_blocking(self, data):
+        with self._lock:
+            self.sock.sendall(data)
+
+    def _read_loop(self):
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            self.data_received(data)
+        print("Verbindung zum Broker verloren, Worker beendet sich.")
+        os._exit(1)
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        for kind, payload in self.decoder.messages():
+            self._dispatch(kind, payload)
+
+    def _dispatch(self, kind, payload):
+        server = self.server
+        if kind == BUS_BROADCAST:
+            server.fremder_broadcast(payload)
+        elif kind == BUS_CHANNEL:
+            server.fremde_channel_nachricht(payload)
+        elif kind == BUS_JOIN:
+            ip, udp_port, name = decode_client_info(payload)
+            server.fremder_client_verbunden(name, ip, udp_port)
+        elif kind == BUS_LEAVE:
+            server.fremder_client_getrennt(payload.decode('utf-8'))
+        elif kind in (BUS_CLAIM_OK, BUS_CLAIM_FAIL):
+            req_id = _REQ_ID.unpack_from(payload)[0]
+            conn, ip, udp_port, name, resume = self.pending.pop(req_id)
+            if kind == BUS_CLAIM_FAIL:
+                server.sende_fehler(conn, payload[_REQ_ID.size])
+            elif conn.closed:
+                self.leave(name)  # Client ist schon wieder weg
+            else:
+                server.registrierung_abschliessen(conn, ip, udp_port, name, resume)
+
+
+class _BusProtocol(asyncio.Protocol):
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def data_received(self, data):
+        self.bus.data_received(data)
+
+    def connection_lost(self, exc):
+        print("Verbindung zum Broker verloren, Worker beendet sich.")
+        os._exit(1)
+
+
+# Broker-Seite (Hauptprozess) ---------------------------------------------
+
+class _WorkerState:
+    __slots__ = ('sock', 'pid', 'decoder', 'outbuf', 'names')
+
+    def __init__(self, sock, pid):
+        self.sock = sock
+        self.pid = pid
+        self.decoder = BusDecoder()
+        self.outbuf = bytearray()
+        self.names = set()
+
+
+class Broker:
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.workers = {}  # sock -> _WorkerState
+        self.owners = {}  # name -> _WorkerState
+        self.addrs = {}  # (ip, udp_port) -> name
+
+    def add_worker(self, sock, pid):
+        sock.setblocking(False)
+        state = _WorkerState(sock, pid)
+        self.workers[sock] = state
+        self.selector.register(sock, selectors.EVENT_READ, state)
+
+    def run(self):
+        while self.workers:
+            for key, events in self.selector.select():
+                state = key.data
+                if events & selectors.EVENT_READ:
+                    self._read(state)
+                if events & selectors.EVENT_WRITE and state.sock in self.workers:
+                    self._flush(state)
+
+    def _read(self, state):
+        try:
+            data = state.sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._worker_lost(state)
+            return
+        state.decoder.feed(data)
+        for kind, payload in state.decoder.messages():
+            self._handle(state, kind, payload)
+
+    def _handle(self, state, kind, payload):
+        if kind in (BUS_BROADCAST, BUS_CHANNEL):
+            self._to_others(state, encode_bus(kind, payload))
+        elif kind == BUS_CLAIM:
+            req_id = payload[:_REQ_ID.size]
+            ip, udp_port, name = decode_client_info(payload, _REQ_ID.size)
+            if name in self.owners:
+                self._send(state, encode_bus(BUS_CLAIM_FAIL, req_id + bytes([2])))  # Nickname nicht unique
+            elif (ip, udp_port) in self.addrs:
+                self._send(state, encode_bus(BUS_CLAIM_FAIL, req_id + bytes([1])))  # (IP, Port) nicht unique
+            else:
+                self.owners[name] = state
+                self.addrs[ip, udp_port] = name
+                state.names.add((name, ip, udp_port))
+                self._send(state, encode_bus(BUS_CLAIM_OK, req_id))
+                self._to_others(state, encode_bus(BUS_JOIN, payload[_REQ_ID.size:]))
+        elif kind == BUS_LEAVE:
+            name = payload.decode('utf-8')
+            if self.owners.get(name) is state:
+                self._release(state, name)
+
+    def _release(self, state, name):
+        del self.owners[name]
+        for entry in [entry for entry in state.names if entry[0] == name]:
+            state.names.discard(entry)
+            self.addrs.pop((entry[1], entry[2]), None)
+        self._to_others(state, encode_bus(BUS_LEAVE, name.encode('utf-8')))
+
+    def _worker_lost(self, state):
+        print(f"Worker {state.pid} beendet, {len(state.names)} Clients werden freigegeben.")
+        self.selector.unregister(state.sock)
+        del self.workers[state.sock]
+        state.sock.close()
+        for name, _, _ in list(state.names):
+            self._release(state, name)
+
+    def _to_others(self, origin, data):
+        for state in self.workers.values():
+            if state is not origin:
+                self._send(state, data)
+
+    def _send(self, state, data):
+        # Nicht blockierend; Rest wird gepuffert und bei EVENT_WRITE nachgeschoben
+        if not state.outbuf:
+            try:
+                sent = state.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                return
+            if sent == len(data):
+                return
+            data = data[sent:]
+            self.selector.modify(state.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, state)
+        state.outbuf += data
+
+    def _flush(self, state):
+        try:
+            sent = state.sock.send(state.outbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            return
+        del state.outbuf[:sent]
+        if not state.outbuf:
+            self.selector.modify(state.sock, selectors.EVENT_READ, state)
+
+
+def run_workers(count, start_worker):
+    # Forkt count Worker; start_worker(bus_socket, index) läuft im Kind und kehrt nicht zurück
+    broker = Broker()
+    for index in range(count):
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for other in list(broker.workers):
+                other.close()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                start_worker(child_sock, index)
+            finally:
+                os._exit(0)
+        child_sock.close()
+        broker.add_worker(parent_sock, pid)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # terminate() fährt die Worker mit herunter
+
+    print(f"{count} Worker gestartet")
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        print("\nServer wird heruntergefahren...")
+    finally:
+        for state in list(broker.workers.values()):
+            try:
+                os.kill(state.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for state in list(broker.workers.values()):
+            try:
+                os.waitpid(state.pid, 0)
+            except ChildProcessError:
+                pass